@@ -30,22 +30,30 @@ projSysLst={
 3950 : "Lambert CC50"
 }
 
-def getShpExtent(pathShp):
+def getShpGeoms(pathShp):
+	'''Return polygons rings and polylines [[(x,y)]] of a shapefile'''
 	shp = shapefile.Reader(pathShp)
-	shapes = shp.shapes() #we expect only one feature !
-	if len(shapes) != 1:
-		return
-	else:
-		extent = shapes[0].bbox #xmin, ymin, xmax, ymax
-		return extent
+	polygons, lines = [], []
+	for shape in shp.shapes():
+		if shape.shapeType in [shapefile.POLYGON, shapefile.POLYGONZ, shapefile.POLYGONM]:
+			geoms = polygons
+		elif shape.shapeType in [shapefile.POLYLINE, shapefile.POLYLINEZ, shapefile.POLYLINEM]:
+			geoms = lines
+		else:
+			continue
+		parts = list(shape.parts) + [len(shape.points)]
+		for i1, i2 in zip(parts[:-1], parts[1:]):
+			geoms.append([tuple(pt[:2]) for pt in shape.points[i1:i2]])
+	return polygons, lines
 
-def getKmlExtent(kmlFile, crs2):
+def getKmlGeoms(kmlFile, crs2):
+	'''Return polygons rings and polylines [[(x,y)]] of a kml file reprojected to crs2'''
 
 	def formatCoor(coorText):
 		coorText = coorText.strip()
 		coordinates = []
-		for elem in str(coorText).split(" "):
-			coordinates.append(tuple(map(float, elem.split(","))))
+		for elem in str(coorText).split():
+			coordinates.append(tuple(map(float, elem.split(",")))[:2])
 		return coordinates
 
 	def namespace(element):
@@ -54,21 +62,24 @@ def getKmlExtent(kmlFile, crs2):
 
 	root = etree.parse(kmlFile).getroot()
 	ns = namespace(root)
-	polygons = []
+	polygons, lines = [], []
 	for poly in root.iter(ns+"Polygon"):
 		for attributes in poly.iter(ns+"coordinates"):
-			polygons.append(formatCoor(attributes.text))
-	if len(polygons) != 1:
+			polygons.append(reprojPts(4326, crs2, formatCoor(attributes.text)))
+	for line in root.iter(ns+"LineString"):
+		for attributes in line.iter(ns+"coordinates"):
+			lines.append(reprojPts(4326, crs2, formatCoor(attributes.text)))
+	return polygons, lines
+
+def getGeomsExtent(geoms):
+	pts = [pt for geom in geoms for pt in geom]
+	if not pts:
 		return
-	else:
-		pts = polygons[0] #first feature
-		pts = reprojPts(4326, crs2, pts)
-		xmin = min([pt[0] for pt in pts])
-		ymin = min([pt[1] for pt in pts])
-		xmax = max([pt[0] for pt in pts])
-		ymax = max([pt[1] for pt in pts])
-		extent = [xmin, ymin, xmax, ymax]
-		return list(map(round,extent))
+	xmin = min([pt[0] for pt in pts])
+	ymin = min([pt[1] for pt in pts])
+	xmax = max([pt[0] for pt in pts])
+	ymax = max([pt[1] for pt in pts])
+	return [xmin, ymin, xmax, ymax]
 
 
 
@@ -83,6 +94,7 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 			self.cbProvider.addItem(v['name'], k) #text, data
 
 		self.extent = None
+		self.polygons, self.lines = [], []
 		self.inCacheFolder.setText(tempfile.gettempdir())
 
 		self.btCacheFolder.clicked.connect(self.setCacheFolder)
@@ -94,6 +106,7 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 		self.cbProvider.currentIndexChanged.connect(self.uiDoUpdateProvider)
 		self.cbLayer.currentIndexChanged.connect(self.uiDoUpdateScales)
 		self.cbZoom.currentIndexChanged.connect(self.uiDoUpdateRes)
+		self.spBuffer.valueChanged.connect(self.uiDoUpdateBuffer)
 
 		self.chkJPG.stateChanged.connect(self.uiUpdateMaskOption)
 		self.chkSeedCache.stateChanged.connect(self.uiUpdateSeedOption)
@@ -116,6 +129,11 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 	def outProj(self):
 		return self.cbOutProj.itemData(self.cbOutProj.currentIndex())
 
+	@property
+	def buffer(self):
+		'''corridor width around lines, in source crs units'''
+		return self.spBuffer.value()
+
 	@property
 	def zoom(self):
 		z = self.cbZoom.itemData(self.cbZoom.currentIndex())
@@ -125,7 +143,7 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 	@property
 	def rq(self):
 		if self.extent is not None and self.zoom is not None:
-			rq = self.provider.srcTms.bboxRequest(self.extent, self.zoom)
+			rq = self.provider.bboxRequest(self.extent, self.zoom, dstGrid=False, polygons=self.polygons, lines=self.lines, buffer=self.buffer)
 			return rq
 
 
@@ -171,6 +189,13 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 		for k, v in projSysLst.items():
 			self.cbOutProj.addItem(v, k)
 		self.cbOutProj.setCurrentIndex(self.cbOutProj.findData(2154))
+		#buffer is expressed in the units of the provider crs
+		if self.provider.srcTms.units == 'degrees':
+			self.spBuffer.setDecimals(6)
+			self.spBuffer.setSuffix(' deg')
+		else:
+			self.spBuffer.setDecimals(1)
+			self.spBuffer.setSuffix(' m')
 		#
 		self.updateExtent()
 
@@ -188,6 +213,10 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 			self.lbRes.setText(str(round(self.rq.res, 2))+" m/px")
 			self.uiDoRequestInfos()
 
+	def uiDoUpdateBuffer(self, value):
+		'''Triggered when spBuffer value change'''
+		self.updateExtent()
+
 	def uiDoReadShpExtent(self):
 		path = str(self.setOpenFileName('Shapefile (*.shp *.kml)'))
 		self.inVectorFile.setText(path)
@@ -200,11 +229,16 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 		else:
 			ext = path[-3:]
 			if ext == 'shp':
-				self.extent = getShpExtent(path) #xmin, ymin, xmax, ymax
+				self.polygons, self.lines = getShpGeoms(path)
 			elif ext == 'kml':
-				self.extent = getKmlExtent(path, self.provider.srcTms.CRS)
+				self.polygons, self.lines = getKmlGeoms(path, self.provider.srcTms.CRS)
+			#tiles will be selected according to the geometries, the extent define the mosaic frame
+			self.extent = getGeomsExtent(self.polygons + self.lines) #xmin, ymin, xmax, ymax
+			if self.extent is not None and self.lines:
+				xmin, ymin, xmax, ymax = self.extent
+				self.extent = [xmin - self.buffer, ymin - self.buffer, xmax + self.buffer, ymax + self.buffer]
 			if not self.extent:
-				QtGui.QMessageBox.information(self, "Cannot read vector extent file", "This file must contains only one polygon")
+				QtGui.QMessageBox.information(self, "Cannot read vector extent file", "This file must contains polygons or lines")
 				return
 			#
 			self.uiDoRequestInfos()
@@ -274,7 +308,7 @@ class QtMapServiceClient(QtGui.QMainWindow, mainForm):
 
 		seedOnly = self.chkSeedCache.isChecked()
 		recurseUpZoomLevels = self.chkRecurseUpZoomLevels.isChecked()
-		self.thread = DownloadTiles(self.provider, self.layer, self.extent, self.zoom, outFile, outCRS, seedOnly, recurseUpZoomLevels)
+		self.thread = DownloadTiles(self.provider, self.layer, self.extent, self.zoom, outFile, outCRS, seedOnly, recurseUpZoomLevels, self.polygons, self.lines, self.buffer)
 		self.thread.finished.connect(self.uiProcessFinished)
 		self.thread.terminated.connect(self.uiProcessFinished)
 		self.thread.updateBar1.connect(self.uiDoUpdateBar1)
@@ -352,22 +386,21 @@ class DownloadTiles(QtCore.QThread):
 	updateBar1 = QtCore.pyqtSignal(int)
 	processInfo = QtCore.pyqtSignal(str)
 
-	def __init__(self, srv, layer, extent, zoom, outFile, outCRS, seedOnly, recurseUpZoomLevels):
+	def __init__(self, srv, layer, extent, zoom, outFile, outCRS, seedOnly, recurseUpZoomLevels, polygons=None, lines=None, buffer=0):
 		QtCore.QThread.__init__(self, None)
 		self.srv = srv
 		self.layer = layer
 		self.extent = extent
+		self.geoms = dict(polygons=polygons, lines=lines, buffer=buffer)
 
 		self.outFile = outFile
 		self.outCRS = outCRS
 		self.seedOnly = seedOnly
 		if recurseUpZoomLevels and seedOnly:
 			self.zoom = list(range(self.srv.layers[self.layer].zmin, zoom+1))
-			self.rq = BBoxRequestMZ(self.srv.srcTms, self.extent, self.zoom)
-			print(self.rq.nbTiles, self.srv.srcTms.bboxRequest(self.extent, zoom).nbTiles)
 		else:
 			self.zoom = zoom
-			self.rq = self.srv.srcTms.bboxRequest(self.extent, self.zoom)
+		self.rq = self.srv.bboxRequest(self.extent, self.zoom, dstGrid=False, **self.geoms)
 
 	def run(self):
 		self.srv.start()
@@ -389,10 +422,10 @@ class DownloadTiles(QtCore.QThread):
 		self.srv.stop()
 
 	def seedCache(self):
-		self.srv.seedCache(self.layer, self.extent, self.zoom, toDstGrid=False)
+		self.srv.seedCache(self.layer, self.extent, self.zoom, toDstGrid=False, **self.geoms)
 
 	def getImage(self):
-		self.srv.getImage(self.layer, self.extent, self.zoom, path=self.outFile, bigTiff=True, outCRS=self.outCRS, toDstGrid=False)
+		self.srv.getImage(self.layer, self.extent, self.zoom, path=self.outFile, bigTiff=True, outCRS=self.outCRS, toDstGrid=False, **self.geoms)
 
 	def cancel(self):
 		self.srv.stop()
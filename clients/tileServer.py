@@ -0,0 +1,31 @@
+# -*- coding:utf-8 -*-
+import sys, os
+sys.path.append(os.path.abspath('..'))
+
+import argparse
+import logging
+import tempfile
+
+from core.basemaps import TileServer, SOURCES
+
+#Serve BlenderGIS tiles caches as XYZ tiles for other tools
+#example of QGIS XYZ connection : http://localhost:8080/OSM/MAPNIK/{z}/{x}/{y}.png
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Local XYZ tile server exposing BlenderGIS caches')
+	parser.add_argument('--cache', default=tempfile.gettempdir(), help='folder of the GeoPackage caches')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--fetch', action='store_true', help='download missing or expired tiles from the map services')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+
+	server = TileServer(args.cache, args.host, args.port, fetch=args.fetch)
+	for srckey, src in SOURCES.items():
+		for laykey in src['layers']:
+			print(server.url + '/' + srckey + '/' + laykey + '/{z}/{x}/{y}.png')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
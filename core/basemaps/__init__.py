@@ -1,3 +1,5 @@
 from .servicesDefs import GRIDS, SOURCES
-from .mapservice import MapService, TileMatrix, BBoxRequest, BBoxRequestMZ
+from .mapservice import MapService, MapJob, TileMatrix, BBoxRequest, BBoxRequestMZ, GeomRequest
+from .mapservice import getMapService, getTileMatrix, clearMapServices
 from .gpkg import GeoPackage
+from .tileserver import TileServer
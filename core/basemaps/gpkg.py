@@ -38,9 +38,19 @@ class GeoPackage():
 
 	MAX_DAYS = 90
 
-	def __init__(self, path, tm):
+	#max number of tiles per lookup query, each tile consume 3 sql variables (sqlite limit is 999)
+	CHUNK_SIZE = 300
+
+	#when the size limit is exceeded, evict tiles until the db fit in this fraction of the limit
+	EVICT_RATIO = 0.9
+
+	#rebuild the db file when at least this fraction of pages are unused
+	VACUUM_RATIO = 0.25
+
+	def __init__(self, path, tm, maxSize=None):
 		self.dbPath = path
 		self.name = os.path.splitext(os.path.basename(path))[0]
+		self.maxSize = maxSize #in bytes, None for unlimited
 
 		#Get props from TileMatrix object
 		self.auth, self.code = tm.CRS.split(':')
@@ -59,6 +69,9 @@ class GeoPackage():
 
 			self.insertTileMatrixSet()
 
+		#databases created by older versions have no index on tiles age
+		self.createIndex()
+
 
 	def isGPKG(self):
 		if not os.path.exists(self.dbPath):
@@ -164,6 +177,14 @@ class GeoPackage():
 		db.close()
 
 
+	def createIndex(self):
+		"""Index tiles by age to speed up expiry filtering and eviction"""
+		db = sqlite3.connect(self.dbPath)
+		db.execute("CREATE INDEX IF NOT EXISTS gpkg_tiles_last_modified ON gpkg_tiles (last_modified);")
+		db.commit()
+		db.close()
+
+
 	def insertMetadata(self):
 		db = sqlite3.connect(self.dbPath)
 		query = """INSERT INTO gpkg_contents (
@@ -227,8 +248,9 @@ class GeoPackage():
 		else:
 			return False
 
-	def getTile(self, x, y, z):
-		'''return tilde_data if tile exists otherwie return None'''
+	def getTile(self, x, y, z, allowExpired=False):
+		'''return tilde_data if tile exists otherwie return None
+		Expired tiles are considered as missing unless allowExpired is True'''
 		#connect with detect_types parameter for automatically convert date to Python object
 		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
 		query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
@@ -237,10 +259,21 @@ class GeoPackage():
 		if result is None:
 			return None
 		timeDelta = datetime.datetime.now() - result[1]
-		if timeDelta.days > self.MAX_DAYS:
+		if timeDelta.days > self.MAX_DAYS and not allowExpired:
 			return None
 		return result[0]
 
+	def getTileRecord(self, x, y, z):
+		'''return (tile_data, last_modified) if tile exists, even if expired, otherwise return None'''
+		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
+		query = 'SELECT tile_data, last_modified FROM gpkg_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+		result = db.execute(query, (z, x, y)).fetchone()
+		db.close()
+		return result
+
+	def isExpired(self, lastModified):
+		return (datetime.datetime.now() - lastModified).days > self.MAX_DAYS
+
 	def putTile(self, x, y, z, data):
 		db = sqlite3.connect(self.dbPath)
 		query = """INSERT OR REPLACE INTO gpkg_tiles
@@ -250,53 +283,133 @@ class GeoPackage():
 		db.close()
 
 
-	def listExistingTiles(self, tiles):
-		"""
-		input : tiles list [(x,y,z)]
-		output : tiles list set [(x,y,z)] of existing records in cache db"""
+	@property
+	def expiryDate(self):
+		'''Tiles modified before this date are expired, formated like sqlite datetime function'''
+		date = datetime.datetime.now() - datetime.timedelta(days=self.MAX_DAYS)
+		return date.strftime('%Y-%m-%d %H:%M:%S')
 
+	def _selectTiles(self, fields, tiles, condition=None, params=()):
+		"""
+		Select some fields of the requested tiles [(x,y,z)]
+		The lookup is splitted in several queries to not exceed sqlite variables limit
+		"""
+		tiles = list(tiles)
 		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
-
-		tiles = ['_'.join(map(str, tile)) for tile in tiles]
-
-		query = "SELECT tile_column, tile_row, zoom_level FROM gpkg_tiles " \
-				"WHERE julianday() - julianday(last_modified) < " + str(self.MAX_DAYS) + " " \
-				"AND tile_column || '_' || tile_row || '_' || zoom_level IN ('" + "','".join(tiles) + "')"
-
-		result = db.execute(query).fetchall()
+		result = []
+		for i in range(0, len(tiles), self.CHUNK_SIZE):
+			chunk = tiles[i:i+self.CHUNK_SIZE]
+			query = "SELECT " + fields + " FROM gpkg_tiles " \
+					"WHERE (tile_column, tile_row, zoom_level) IN (VALUES " + ','.join(['(?,?,?)'] * len(chunk)) + ")"
+			if condition is not None:
+				query += " AND " + condition
+			values = [v for tile in chunk for v in tile]
+			result.extend(db.execute(query, values + list(params)).fetchall())
 		db.close()
+		return result
 
+	def listExistingTiles(self, tiles, allowExpired=False):
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] of existing records in cache db
+		Expired tiles are considered as missing unless allowExpired is True"""
+		if allowExpired:
+			result = self._selectTiles("tile_column, tile_row, zoom_level", tiles)
+		else:
+			result = self._selectTiles("tile_column, tile_row, zoom_level", tiles, "last_modified > ?", (self.expiryDate,))
 		return set(result)
 
-	def listMissingTiles(self, tiles):
-		existing = self.listExistingTiles(tiles)
+	def listMissingTiles(self, tiles, allowExpired=False):
+		existing = self.listExistingTiles(tiles, allowExpired)
 		return set(tiles) - existing # difference
 
+	def listExpiredTiles(self, tiles):
+		"""
+		input : tiles list [(x,y,z)]
+		output : tiles list set [(x,y,z)] of records in cache db older than MAX_DAYS"""
+		result = self._selectTiles("tile_column, tile_row, zoom_level", tiles, "last_modified <= ?", (self.expiryDate,))
+		return set(result)
 
-	def getTiles(self, tiles):
+
+	def getTiles(self, tiles, allowExpired=False):
 		"""tiles = list of (x,y,z) tuple
-		return list of (x,y,z,data) tuple"""
+		return list of (x,y,z,data) tuple
+		Expired tiles are ignored unless allowExpired is True"""
+		if allowExpired:
+			return self._selectTiles("tile_column, tile_row, zoom_level, tile_data", tiles)
+		else:
+			return self._selectTiles("tile_column, tile_row, zoom_level, tile_data", tiles, "last_modified > ?", (self.expiryDate,))
 
-		db = sqlite3.connect(self.dbPath, detect_types=sqlite3.PARSE_DECLTYPES)
 
-		tiles = ['_'.join(map(str, tile)) for tile in tiles]
+	def putTiles(self, tiles):
+		"""tiles = list of (x,y,z,data) tuple"""
+		db = sqlite3.connect(self.dbPath)
+		query = """INSERT OR REPLACE INTO gpkg_tiles
+		(tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
+		db.executemany(query, tiles)
+		db.commit()
+		db.close()
 
-		query = "SELECT tile_column, tile_row, zoom_level, tile_data FROM gpkg_tiles " \
-				"WHERE julianday() - julianday(last_modified) < " + str(self.MAX_DAYS) + " " \
-				"AND tile_column || '_' || tile_row || '_' || zoom_level IN ('" + "','".join(tiles) + "')"
 
-		result = db.execute(query).fetchall()
+	###############
+	#Maintenance
 
+	def getSize(self):
+		'''Return used and unused size of the db in bytes'''
+		db = sqlite3.connect(self.dbPath)
+		pageSize = db.execute("PRAGMA page_size").fetchone()[0]
+		pageCount = db.execute("PRAGMA page_count").fetchone()[0]
+		freeCount = db.execute("PRAGMA freelist_count").fetchone()[0]
 		db.close()
+		return (pageCount - freeCount) * pageSize, freeCount * pageSize
 
-		return result
-
+	def deleteExpired(self):
+		'''Delete expired tiles, return the number of deleted tiles'''
+		db = sqlite3.connect(self.dbPath)
+		n = db.execute("DELETE FROM gpkg_tiles WHERE last_modified <= ?", (self.expiryDate,)).rowcount
+		db.commit()
+		db.close()
+		return n
 
-	def putTiles(self, tiles):
-		"""tiles = list of (x,y,z,data) tuple"""
+	def evict(self):
+		"""
+		Delete oldest tiles until the db size fit the size limit
+		Return the number of deleted tiles
+		"""
+		if not self.maxSize:
+			return 0
+		used, free = self.getSize()
+		if used <= self.maxSize:
+			return 0
+		toFree = used - self.maxSize * self.EVICT_RATIO
 		db = sqlite3.connect(self.dbPath)
-		query = """INSERT OR REPLACE INTO gpkg_tiles
-		(tile_column, tile_row, zoom_level, tile_data) VALUES (?,?,?,?)"""
-		db.executemany(query, tiles)
+		count = db.execute("SELECT count(*) FROM gpkg_tiles").fetchone()[0]
+		if not count:
+			db.close()
+			return 0
+		#average disk usage of a tile, including rows, index and pages overhead
+		tileBytes = used / count
+		n = min(count, math.ceil(toFree / tileBytes))
+		ids = [row[0] for row in db.execute("SELECT id FROM gpkg_tiles ORDER BY last_modified LIMIT ?", (n,))]
+		for i in range(0, len(ids), self.CHUNK_SIZE):
+			chunk = ids[i:i+self.CHUNK_SIZE]
+			db.execute("DELETE FROM gpkg_tiles WHERE id IN (" + ','.join(['?'] * len(chunk)) + ")", chunk)
 		db.commit()
 		db.close()
+		log.debug("{} tiles evicted from cache {}".format(len(ids), self.name))
+		return len(ids)
+
+	def compact(self, purgeExpired=False):
+		"""
+		Delete expired tiles (if purgeExpired), enforce the size limit and reclaim
+		unused disk space if needed
+		"""
+		if purgeExpired:
+			self.deleteExpired()
+		self.evict()
+		used, free = self.getSize()
+		if free > 0 and free >= (used + free) * self.VACUUM_RATIO:
+			log.debug("Vacuum cache {}".format(self.name))
+			db = sqlite3.connect(self.dbPath)
+			db.execute("VACUUM")
+			db.close()
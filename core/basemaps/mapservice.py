@@ -26,8 +26,12 @@ import threading
 import queue
 import time
 import urllib.request
+import urllib.error
 import imghdr
 import sys, time, os
+import hashlib
+
+import numpy as np
 
 #core imports
 from .servicesDefs import GRIDS, SOURCES
@@ -48,6 +52,8 @@ MOSAIC_BKG_COLOR = (128,128,128,255)
 EMPTY_TILE_COLOR = (255,192,203,255) #color for cached tile with empty data
 CORRUPTED_TILE_COLOR = (255,0,0,255) #color for cached tile which is non valid image data
 
+DEM_NODATA = -32768 #nodata value of elevation mosaics
+
 class TileMatrix():
 	"""
 	Will inherit attributes from grid source definition
@@ -259,14 +265,122 @@ class TileMatrix():
 	def bboxRequest(self, bbox, zoom):
 		return BBoxRequest(self, bbox, zoom)
 
+def decodeTerrarium(rgb):
+	'''Decode a Terrarium RGB encoded elevation array (h,w,3) to float32 heights in meters'''
+	rgb = rgb.astype(np.float32)
+	return rgb[:,:,0] * 256 + rgb[:,:,1] + rgb[:,:,2] / 256 - 32768
+
+def decodeTerrainRGB(rgb):
+	'''Decode a Mapbox Terrain-RGB encoded elevation array (h,w,3) to float32 heights in meters'''
+	rgb = rgb.astype(np.float32)
+	return -10000 + (rgb[:,:,0] * 65536 + rgb[:,:,1] * 256 + rgb[:,:,2]) * 0.1
+
+ELEVATION_DECODERS = {
+	'terrarium': decodeTerrarium,
+	'terrainrgb': decodeTerrainRGB
+}
+
+def decodeElevationTile(data, encoding):
+	'''Return a one band float32 NpImage of heights from the bytes of an RGB encoded elevation tile'''
+	img = NpImage(data)
+	if img.isOneBand:
+		raise ValueError('Elevation tile is not RGB encoded')
+	rgb = img.data[:,:,0:3]
+	heights = ELEVATION_DECODERS[encoding](rgb)
+	if img.hasAlpha:
+		#transparent pixels have no data
+		heights[img.data[:,:,3] == 0] = DEM_NODATA
+	return NpImage(heights)
+
+
+def blendTiles(layers, tileSize):
+	"""
+	Alpha blend some tiles, from bottom to top
+	layers : list of (data, opacity) where data is the image bytes of the tile (or None if missing)
+	Return the bytes of the composited tile as PNG, or None if no layer provides data
+	"""
+	out = None
+	for data, opacity in layers:
+		if data is None:
+			continue
+		try:
+			img = NpImage(data)
+		except Exception as e:
+			log.error('Corrupted tile on cache', exc_info=True)
+			continue
+		if img.isOneBand or img.data.shape[:2] != (tileSize, tileSize):
+			continue
+		img.addAlpha()
+		rgba = img.data.astype(np.float32) / 255
+		a = rgba[:,:,3:4] * opacity
+		if out is None:
+			out = np.zeros((tileSize, tileSize, 4), dtype=np.float32)
+		#"over" operator on non premultiplied colors
+		outA = a + out[:,:,3:4] * (1 - a)
+		rgb = rgba[:,:,0:3] * a + out[:,:,0:3] * out[:,:,3:4] * (1 - a)
+		out[:,:,0:3] = np.divide(rgb, outA, out=np.zeros_like(rgb), where=outA>0)
+		out[:,:,3:4] = outA
+	if out is None:
+		return None
+	out = NpImage((out * 255).round().astype(np.uint8))
+	return out.toBLOB(ext='PNG')
+
+
+########################
+#Process-wide registry of tile matrices and map services
+#Building a TileMatrix requires reprojections, and a MapService holds open caches
+#and a tuned download throttle, so they are kept alive and shared between requests
+
+_tileMatrices = {}
+_mapServices = {}
+_registryLock = threading.Lock()
+
+def getTileMatrix(grdkey):
+	'''Return the shared TileMatrix object of a grid, build it at first request'''
+	with _registryLock:
+		tm = _tileMatrices.get(grdkey)
+		if tm is None:
+			tm = _tileMatrices[grdkey] = TileMatrix(GRIDS[grdkey])
+		return tm
+
+def getMapService(srckey, cacheFolder, dstGridKey=None):
+	"""
+	Return the shared MapService instance for a source, a cache folder and a destination grid
+	The instance is created at first request and then reused
+	"""
+	key = (srckey, os.path.abspath(cacheFolder), dstGridKey)
+	with _registryLock:
+		srv = _mapServices.get(key)
+	if srv is None:
+		#built outside the lock because it can request the tile matrix registry
+		srv = MapService(srckey, cacheFolder, dstGridKey)
+		with _registryLock:
+			srv = _mapServices.setdefault(key, srv)
+	return srv
+
+def clearMapServices():
+	'''Stop and forget all shared map services and tile matrices'''
+	with _registryLock:
+		services = list(_mapServices.values())
+		_mapServices.clear()
+		_tileMatrices.clear()
+	for srv in services:
+		srv.stop()
+		if srv.compactTimer is not None:
+			srv.compactTimer.cancel()
+
+
 class BBoxRequestMZ():
-	'''Multiple Zoom BBox request'''
-	def __init__(self, tm, bbox, zooms):
+	'''Multiple Zoom BBox request, tiles can be restricted to those intersecting some geometries (see GeomRequest)'''
+	def __init__(self, tm, bbox, zooms, polygons=None, lines=None, buffer=0):
 
 		self.tm = tm
 		self.bboxrequests = {}
 		for z in zooms:
-			self.bboxrequests[z] = BBoxRequest(tm, bbox, z)
+			if polygons or lines:
+				self.bboxrequests[z] = GeomRequest(tm, bbox, z, polygons, lines, buffer)
+			else:
+				self.bboxrequests[z] = BBoxRequest(tm, bbox, z)
 
 	@property
 	def tiles(self):
@@ -327,6 +441,227 @@ class BBoxRequest():
 	#megapixel, geosize
 
 
+class GeomRequest(BBoxRequest):
+	"""
+	Request of the tiles that intersect some polygons or buffered polylines
+	Tiles are selected by a scanline rasterisation of the geometries over the tile matrix,
+	so elongated or diagonal areas do not require all the tiles of their bounding box
+
+	polygons : list of rings [[(x,y)]], holes are handled with even-odd rule
+	lines : list of polylines [[(x,y)]]
+	buffer : distance (in tile matrix crs units) around the geometries
+	bbox : extent of the request, if None use the extent of the geometries
+	cols, rows and bbox properties still describe the whole extent (the mosaic frame)
+	"""
+
+	def __init__(self, tm, bbox, zoom, polygons=None, lines=None, buffer=0):
+		self.polygons = polygons or []
+		self.lines = lines or []
+		self.buffer = buffer
+		pts = [pt for geom in self.polygons + self.lines for pt in geom]
+		if not pts:
+			raise ValueError('No geometry defined')
+		if bbox is None:
+			xmin = min(pt[0] for pt in pts) - buffer
+			ymin = min(pt[1] for pt in pts) - buffer
+			xmax = max(pt[0] for pt in pts) + buffer
+			ymax = max(pt[1] for pt in pts) + buffer
+			bbox = (xmin, ymin, xmax, ymax)
+		BBoxRequest.__init__(self, tm, bbox, zoom)
+		self._tiles = self.rasterize()
+
+	def _colsRange(self, x1, x2):
+		'''Return the range of cols covering the x interval, clamped to the request extent'''
+		geoTileSize = self.tileSize * self.res
+		c1 = math.floor( (x1 - self.tm.originx) / geoTileSize )
+		c2 = math.floor( (x2 - self.tm.originx) / geoTileSize )
+		c1 = max(c1, self.firstCol)
+		c2 = min(c2, self.firstCol + self.nbTilesX - 1)
+		return range(c1, c2 + 1)
+
+	def rasterize(self):
+		'''Return the set of tiles (col, row, zoom) that intersect the geometries'''
+		buff = self.buffer
+		edges = []
+		for ring in self.polygons:
+			edges.extend(zip(ring, ring[1:] + ring[:1]))
+		segments = list(edges)
+		for line in self.lines:
+			segments.extend(zip(line[:-1], line[1:]))
+
+		tiles = set()
+		for row in self.rows:
+			_, y1, _, y2 = self.tm.getTileBbox(self.firstCol, row, self.zoom)
+			cols = set()
+
+			#tiles crossed by an edge or a line in this band (expanded by the buffer)
+			b1, b2 = y1 - buff, y2 + buff
+			for (xa, ya), (xb, yb) in segments:
+				if max(ya, yb) < b1 or min(ya, yb) > b2:
+					continue
+				if ya == yb:
+					xs = [xa, xb]
+				else:
+					#clip the segment to the band
+					ta = (b1 - ya) / (yb - ya)
+					tb = (b2 - ya) / (yb - ya)
+					t1, t2 = max(min(ta, tb), 0), min(max(ta, tb), 1)
+					xs = [xa + t1 * (xb - xa), xa + t2 * (xb - xa)]
+				cols.update(self._colsRange(min(xs) - buff, max(xs) + buff))
+
+			#tiles inside polygons, even-odd spans at the middle of the band
+			ym = (y1 + y2) / 2
+			inters = []
+			for (xa, ya), (xb, yb) in edges:
+				if (ya <= ym) != (yb <= ym):
+					inters.append(xa + (ym - ya) / (yb - ya) * (xb - xa))
+			inters.sort()
+			for x1, x2 in zip(inters[0::2], inters[1::2]):
+				cols.update(self._colsRange(x1, x2))
+
+			tiles.update( (col, row, self.zoom) for col in cols )
+		return tiles
+
+	@property
+	def tiles(self):
+		return sorted(self._tiles)
+
+	@property
+	def nbTiles(self):
+		return len(self._tiles)
+
+
+
+class AdaptiveThrottle():
+	"""
+	Bound the number of simultaneous http requests sent to a map service
+	The limit is tuned with an AIMD (additive increase, multiplicative decrease) rule :
+	after each window of completed requests, the limit is increased by one if the server
+	responds well, or halved if too many requests failed or if the mean latency grew too
+	much compared to the best latency observed so far (meaning the server is saturated)
+
+	Each request must be wrapped between acquire() and release()
+	"""
+
+	def __init__(self, minThreads=2, maxThreads=16, initThreads=None, window=10, maxErrorRate=0.1, latencyFactor=2):
+		self.minThreads = max(1, minThreads)
+		self.maxThreads = max(self.minThreads, maxThreads)
+		if initThreads is None:
+			initThreads = (self.minThreads + self.maxThreads) // 2
+		self.limit = min(max(initThreads, self.minThreads), self.maxThreads)
+		self.window = window #number of samples used to evaluate the server health
+		self.maxErrorRate = maxErrorRate
+		self.latencyFactor = latencyFactor
+		self.active = 0 #number of running requests
+		self.baseLatency = None #reference latency of an unloaded server
+		self._latencies = []
+		self._errors = 0
+		self.cond = threading.Condition()
+
+	def acquire(self):
+		'''Block until a new request is allowed'''
+		with self.cond:
+			while self.active >= self.limit:
+				self.cond.wait()
+			self.active += 1
+
+	def release(self, latency, success=True):
+		'''Free a slot and record the latency (seconds) and the result of the request'''
+		with self.cond:
+			self.active -= 1
+			self._latencies.append(latency)
+			if not success:
+				self._errors += 1
+			if len(self._latencies) >= self.window:
+				self._adjust()
+			self.cond.notify_all()
+
+	def _adjust(self):
+		n = len(self._latencies)
+		meanLatency = sum(self._latencies) / n
+		errorRate = self._errors / n
+		self._latencies, self._errors = [], 0
+		#the reference latency can slowly drift up to follow a server that becomes durably slower
+		if self.baseLatency is None:
+			self.baseLatency = meanLatency
+		else:
+			self.baseLatency = min(meanLatency, self.baseLatency * 1.1)
+		if errorRate > self.maxErrorRate or meanLatency > self.baseLatency * self.latencyFactor:
+			self.limit = max(self.minThreads, self.limit // 2)
+		else:
+			self.limit = min(self.maxThreads, self.limit + 1)
+		log.debug('Download concurrency set to {} (latency {:.2f}s, errors {:.0%})'.format(self.limit, meanLatency, errorRate))
+
+
+
+class MapJob():
+	"""
+	Progress, control and result of one request sent to a MapService
+	Several jobs can run concurrently against the same service, they share its
+	download throttle and cache databases but each one has its own counters.
+
+	A child job shares the cancellation token of its parent, it's used for nested
+	requests (for example source tiles needed to build a destination tile)
+
+	Status code
+		0 = no running tasks
+		1 = getting cache (create a new db if needed)
+		2 = downloading
+		3 = building mosaic
+		4 = reprojecting
+	"""
+
+	def __init__(self, parent=None):
+		self.parent = parent
+		if parent is not None:
+			self.cancelled = parent.cancelled
+		else:
+			self.cancelled = threading.Event()
+		self.finished = threading.Event()
+		self.lock = threading.Lock()
+		self.status = 0
+		self.nbTiles = 0
+		self.cptTiles = 0
+		self.result = None
+		self.error = None
+
+	def child(self):
+		return MapJob(parent=self)
+
+	@property
+	def running(self):
+		return not self.cancelled.is_set() and not self.finished.is_set()
+
+	def cancel(self):
+		self.cancelled.set()
+
+	def initProgress(self, nbTiles):
+		with self.lock:
+			self.nbTiles = nbTiles
+			self.cptTiles = 0
+
+	def incProgress(self, n=1):
+		with self.lock:
+			self.cptTiles += n
+
+	def resetProgress(self):
+		with self.lock:
+			self.status = 0
+			self.nbTiles, self.cptTiles = 0, 0
+
+	@property
+	def report(self):
+		if self.status == 0:
+			return ''
+		if self.status == 1:
+			return 'Get cache database...'
+		if self.status == 2:
+			return 'Downloading... ' + str(self.cptTiles)+'/'+str(self.nbTiles)
+		if self.status == 3:
+			return 'Building mosaic...'
+		if self.status == 4:
+			return 'Reprojecting...'
+
 
 class MapService():
 	"""
@@ -348,18 +683,36 @@ class MapService():
 			zmin & zmax
 		urlTemplate
 		referer
-
-	Service status code
-		0 = no running tasks
-		1 = getting cache (create a new db if needed)
-		2 = downloading
-		3 = building mosaic
-		4 = reprojecting
+		minThreads & maxThreads >> optional, bounds of the number of simultaneous downloads
+		metatile >> optional, WMS only. Number n of tiles requested at once as a block of n*n tiles
+		metaBuffer >> optional, WMS only. Number of pixels requested around a metatile
+		layer encoding >> optional, 'terrarium' or 'terrainrgb' for RGB encoded elevation layers.
+			getImage() then return a float32 DEM with DEM_NODATA as nodata value
+
+	Cache modes
+		DEFAULT = expired tiles are considered as missing and downloaded again
+		CACHE_ONLY = never touch the network, serve what is in the cache even if expired
+		STALE_WHILE_REVALIDATE = serve expired tiles immediately and refresh them in background
+
+	Requests progress and control are handled by MapJob objects (see MapJob for status codes)
+	Requests launched without job use the default job of the service, managed with start() and stop()
 	"""
 
 	# resampling algo for reprojection
 	RESAMP_ALG = 'BL' #NN:Nearest Neighboor, BL:Bilinear, CB:Cubic, CBS:Cubic Spline, LCZ:Lanczos
 
+	# default bounds of the adaptive download concurrency (can be overriden in source definition)
+	MIN_THREADS = 2
+	MAX_THREADS = 16
+
+	CACHE_MODES = ('DEFAULT', 'CACHE_ONLY', 'STALE_WHILE_REVALIDATE')
+
+	# number of background threads used to refresh expired tiles
+	REVALIDATE_THREADS = 2
+
+	# delay of inactivity (in seconds) before compacting the cache databases
+	COMPACT_DELAY = 30
+
 	def __init__(self, srckey, cacheFolder, dstGridKey=None):
 
 
@@ -381,7 +734,7 @@ class MapService():
 
 		#Build source tile matrix set
 		self.srcGridKey = self.grid
-		self.srcTms = TileMatrix(GRIDS[self.srcGridKey])
+		self.srcTms = getTileMatrix(self.srcGridKey)
 
 		#Build destination tile matrix set
 		self.setDstGrid(dstGridKey)
@@ -389,6 +742,8 @@ class MapService():
 		#Init cache dict
 		self.cacheFolder = cacheFolder
 		self.caches = {}
+		self.cacheMaxSize = None #maximum size of each cache db in Mb, None for unlimited
+		self.compactTimer = None
 
 		#Fake browser header
 		self.headers = {
@@ -401,62 +756,101 @@ class MapService():
 			'User-Agent' : USER_AGENT,
 			'Referer' : self.referer}
 
-		#Downloading progress
-		self.running = False #flag using to stop getTiles() / getImage() process
-		self.nbTiles = 0
-		self.cptTiles = 0
+		#Adaptive limit of simultaneous downloads for this source
+		minThreads = getattr(self, 'minThreads', self.MIN_THREADS)
+		maxThreads = getattr(self, 'maxThreads', self.MAX_THREADS)
+		self.throttle = AdaptiveThrottle(minThreads, maxThreads)
 
-		#codes that indicate the current status of the service
-		self.status = 0
+		#Cache serving mode
+		self.cacheMode = 'DEFAULT'
+
+		#Background refresh of expired tiles
+		self.revalQueue = queue.Queue()
+		self.revalPending = set()
+		self.revalThreads = []
+
+		#Default job, used by requests that do not provide their own job
+		#no request can run until start() is called
+		self.job = MapJob()
+		self.job.cancel()
+		self.nbActiveJobs = 0
 
 		self.lock = threading.RLock()
 
-	def reportLoop(self):
-		msg = self.report
-		while self.running:
+	def reportLoop(self, job):
+		msg = job.report
+		while job.running:
 			time.sleep(0.05)
-			if self.report != msg:
+			if job.report != msg:
 				#sys.stdout.write("\033[F") #back to previous line
 				sys.stdout.write("\033[K") #clear line
 				sys.stdout.flush()
-				print(self.report, end='\r') #'\r' will move the cursor back to the beginning of the line
-				msg = self.report
+				print(job.report, end='\r') #'\r' will move the cursor back to the beginning of the line
+				msg = job.report
 
 	def start(self):
-		self.running = True
-		reporter = threading.Thread(target=self.reportLoop)
+		'''Start a new default job, a previously started one is left untouched'''
+		self.job = MapJob()
+		reporter = threading.Thread(target=self.reportLoop, args=(self.job,))
 		reporter.setDaemon(True) #daemon threads will die when the main non-daemon thread have exited.
 		reporter.start()
 
 	def stop(self):
-		self.running = False
+		self.job.cancel()
+
+	#Progress and control of the default job
+	@property
+	def running(self):
+		return self.job.running
+
+	@property
+	def status(self):
+		return self.job.status
+
+	@property
+	def nbTiles(self):
+		return self.job.nbTiles
+
+	@property
+	def cptTiles(self):
+		return self.job.cptTiles
 
 	@property
 	def report(self):
-		if self.status == 0:
-			return ''
-		if self.status == 1:
-			return 'Get cache database...'
-		if self.status == 2:
-			return 'Downloading... ' + str(self.cptTiles)+'/'+str(self.nbTiles)
-		if self.status == 3:
-			return 'Building mosaic...'
-		if self.status == 4:
-			return 'Reprojecting...'
+		return self.job.report
+
+	def submit(self, func, *args, **kwargs):
+		"""
+		Run a request (a method of this service like getImage or seedCache) in its own job and thread
+		Return the job immediately, the request result will be stored in job.result
+		"""
+		job = MapJob()
+		def run():
+			try:
+				job.result = func(*args, job=job, **kwargs)
+			except Exception as e:
+				log.error('Map request failed', exc_info=True)
+				job.error = e
+			finally:
+				job.finished.set()
+		t = threading.Thread(target=run)
+		t.setDaemon(True)
+		t.start()
+		return job
 
 
 	def setDstGrid(self, grdkey):
 		'''Set destination tile matrix'''
 		if grdkey is not None and grdkey != self.srcGridKey:
 			self.dstGridKey = grdkey
-			self.dstTms = TileMatrix(GRIDS[grdkey])
+			self.dstTms = getTileMatrix(grdkey)
 		else:
 			self.dstGridKey = None
 			self.dstTms = None
 
 
-	def getCache(self, laykey, useDstGrid):
-		'''Return existing cache for requested layer or built it if not exists'''
+	def _getCacheKey(self, laykey, useDstGrid):
+		'''Return the cache key and the tile matrix of the requested layer'''
 		if useDstGrid:
 			if self.dstGridKey is not None:
 				grdkey = self.dstGridKey
@@ -466,15 +860,50 @@ class MapService():
 		else:
 			grdkey = self.srcGridKey
 			tm = self.srcTms
+		return self.srckey + '_' + laykey + '_' + grdkey, tm
 
-		mapKey = self.srckey + '_' + laykey + '_' + grdkey
-		cache = self.caches.get(mapKey)
-		if cache is None:
-			dbPath = os.path.join(self.cacheFolder, mapKey + ".gpkg")
-			self.caches[mapKey] = GeoPackage(dbPath, tm)
-			return self.caches[mapKey]
-		else:
-			return cache
+	def getCachePath(self, laykey, useDstGrid):
+		mapKey, tm = self._getCacheKey(laykey, useDstGrid)
+		return os.path.join(self.cacheFolder, mapKey + ".gpkg")
+
+	def getCache(self, laykey, useDstGrid):
+		'''Return existing cache for requested layer or built it if not exists'''
+		mapKey, tm = self._getCacheKey(laykey, useDstGrid)
+		maxSize = self.cacheMaxSize * 1024**2 if self.cacheMaxSize else None
+		with self.lock:
+			cache = self.caches.get(mapKey)
+			if cache is None:
+				dbPath = self.getCachePath(laykey, useDstGrid)
+				self.caches[mapKey] = GeoPackage(dbPath, tm, maxSize)
+				return self.caches[mapKey]
+			else:
+				cache.maxSize = maxSize
+				return cache
+
+
+	def scheduleCompaction(self):
+		'''(Re)start the countdown before compacting the caches, so compaction only occurs when the service is idle'''
+		with self.lock:
+			if self.compactTimer is not None:
+				self.compactTimer.cancel()
+			self.compactTimer = threading.Timer(self.COMPACT_DELAY, self.compactCaches)
+			self.compactTimer.setDaemon(True)
+			self.compactTimer.start()
+
+	def compactCaches(self):
+		'''Enforce size limit and reclaim disk space of all the caches opened by this service'''
+		if self.nbActiveJobs > 0 or not self.revalQueue.empty():
+			#still busy, retry later
+			self.scheduleCompaction()
+			return
+		#expired tiles are still usefull when they can be served as is
+		purgeExpired = self.cacheMode == 'DEFAULT'
+		with self.lock:
+			for cache in self.caches.values():
+				try:
+					cache.compact(purgeExpired)
+				except Exception as e:
+					log.error('Cannot compact cache {}'.format(cache.name), exc_info=True)
 
 	def getTM(self, dstGrid=False):
 		if dstGrid:
@@ -519,26 +948,38 @@ class MapService():
 			url = url.replace("{Z}", str(zoom))
 
 		if self.service == 'WMS':
-			url = self.urlTemplate['BASE_URL']
-			if url[-1] != '?' :
-				url += '?'
-			params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
-			url += '&'.join(params)
-			url = url.replace("{LAY}", lay.urlKey)
-			url = url.replace("{FORMAT}", lay.format)
-			url = url.replace("{STYLE}", lay.style)
-			url = url.replace("{CRS}", str(tm.CRS))
-			url = url.replace("{WIDTH}", str(tm.tileSize))
-			url = url.replace("{HEIGHT}", str(tm.tileSize))
-
-			xmin, ymax = tm.getTileCoords(col, row, zoom)
-			xmax = xmin + tm.tileSize * tm.getRes(zoom)
-			ymin = ymax - tm.tileSize * tm.getRes(zoom)
-			if self.urlTemplate['VERSION'] == '1.3.0' and tm.CRS == 'EPSG:4326':
-				bbox = ','.join(map(str,[ymin,xmin,ymax,xmax]))
-			else:
-				bbox = ','.join(map(str,[xmin,ymin,xmax,ymax]))
-			url = url.replace("{BBOX}", bbox)
+			bbox = tm.getTileBbox(col, row, zoom)
+			url = self.buildWmsUrl(laykey, bbox, tm.tileSize, tm.tileSize)
+
+		return url
+
+
+	def buildWmsUrl(self, laykey, bbox, width, height):
+		"""
+		Build a WMS GetMap request url for any bbox expressed in source tile matrix crs
+		and any output image size (in pixels)
+		"""
+		lay = self.layers[laykey]
+		tm = self.srcTms
+
+		url = self.urlTemplate['BASE_URL']
+		if url[-1] != '?' :
+			url += '?'
+		params = ['='.join([k,v]) for k, v in self.urlTemplate.items() if k != 'BASE_URL']
+		url += '&'.join(params)
+		url = url.replace("{LAY}", lay.urlKey)
+		url = url.replace("{FORMAT}", lay.format)
+		url = url.replace("{STYLE}", lay.style)
+		url = url.replace("{CRS}", str(tm.CRS))
+		url = url.replace("{WIDTH}", str(width))
+		url = url.replace("{HEIGHT}", str(height))
+
+		xmin, ymin, xmax, ymax = bbox
+		if self.urlTemplate['VERSION'] == '1.3.0' and tm.CRS == 'EPSG:4326':
+			bbox = ','.join(map(str,[ymin,xmin,ymax,xmax]))
+		else:
+			bbox = ','.join(map(str,[xmin,ymin,xmax,ymax]))
+		url = url.replace("{BBOX}", bbox)
 
 		return url
 
@@ -568,25 +1009,34 @@ class MapService():
 			return True
 
 
-	def downloadTile(self, laykey, col, row, zoom):
+	def downloadUrl(self, url, timeout=3):
 		"""
-		Download bytes data of requested tile in source tile matrix space
+		Download bytes data of an image
 		Return None if unable to download a valid stream
 		"""
-
-		url = self.buildUrl(laykey, col, row, zoom)
 		log.debug(url)
 
+		self.throttle.acquire()
+		t0 = time.time()
+		success = True
 		try:
 			#make request
 			req = urllib.request.Request(url, None, self.headers)
-			handle = urllib.request.urlopen(req, timeout=3)
+			handle = urllib.request.urlopen(req, timeout=timeout)
 			#open image stream
 			data = handle.read()
 			handle.close()
+		except urllib.error.HTTPError as e:
+			log.error("Can't download {}. Error {}".format(url, e))
+			data = None
+			#missing tiles are not a sign of server overload, unlike server errors or rate limiting
+			success = e.code < 500 and e.code != 429
 		except Exception as e:
-			log.error("Can't download tile x{} y{}. Error {}".format(col, row, e))
+			log.error("Can't download {}. Error {}".format(url, e))
 			data = None
+			success = False
+		finally:
+			self.throttle.release(time.time() - t0, success)
 
 		#Make sure the stream is correct
 		if data is not None:
@@ -595,15 +1045,88 @@ class MapService():
 				data = None
 
 		if data is None:
-			log.debug("Invalid tile data for request {}".format(url))
+			log.debug("Invalid image data for request {}".format(url))
 
 		return data
 
 
-	def tileRequest(self, laykey, col, row, zoom, toDstGrid=True):
+	def downloadTile(self, laykey, col, row, zoom):
+		"""
+		Download bytes data of requested tile in source tile matrix space
+		Return None if unable to download a valid stream
+		"""
+		url = self.buildUrl(laykey, col, row, zoom)
+		return self.downloadUrl(url)
+
+
+	@property
+	def useMetatiles(self):
+		"""Flag if tiles must be requested by block of n*n tiles (WMS only)"""
+		return self.service == 'WMS' and getattr(self, 'metatile', 1) > 1
+
+	def getMetatile(self, col, row):
+		"""Return the indices of the metatile that contains the given tile"""
+		return col // self.metatile, row // self.metatile
+
+	def downloadMetatile(self, laykey, mcol, mrow, zoom):
+		"""
+		Download a block of n*n tiles (in source tile matrix space) through a single GetMap request
+		and split it into tiles. An optional buffer of pixels (metaBuffer) is requested around the
+		block to avoid labels cutted at tiles boundaries.
+		Return a list of (col, row, zoom, data) for all tiles of the block within the matrix bounds
+		"""
+		tm = self.srcTms
+		n = self.metatile
+		buff = getattr(self, 'metaBuffer', 0)
+		res = tm.getRes(zoom)
+		tileSize = tm.tileSize
+		lay = self.layers[laykey]
+
+		col0, row0 = mcol * n, mrow * n
+		bboxes = {}
+		for col in range(col0, col0 + n):
+			for row in range(row0, row0 + n):
+				if self.isTileInMapsBounds(col, row, zoom, tm):
+					bboxes[(col, row)] = tm.getTileBbox(col, row, zoom)
+		if not bboxes:
+			return []
+
+		xmin = min(bb[0] for bb in bboxes.values())
+		ymin = min(bb[1] for bb in bboxes.values())
+		xmax = max(bb[2] for bb in bboxes.values())
+		ymax = max(bb[3] for bb in bboxes.values())
+		w = round((xmax - xmin) / res) + 2 * buff
+		h = round((ymax - ymin) / res) + 2 * buff
+		d = buff * res
+		url = self.buildWmsUrl(laykey, (xmin - d, ymin - d, xmax + d, ymax + d), w, h)
+
+		#rendering a large image take longer, increase timeout accordingly
+		data = self.downloadUrl(url, timeout=3*n)
+		if data is None:
+			return []
+		try:
+			img = NpImage(data)
+		except Exception as e:
+			log.error('Cannot read metatile data', exc_info=True)
+			return []
+
+		ext = 'JPEG' if lay.format == 'jpeg' else 'PNG'
+		tiles = []
+		for (col, row), bb in bboxes.items():
+			px = round((bb[0] - xmin) / res) + buff
+			py = round((ymax - bb[3]) / res) + buff
+			tile = NpImage(img.data[py:py+tileSize, px:px+tileSize])
+			if ext == 'JPEG':
+				tile.removeAlpha()
+			tiles.append( (col, row, zoom, tile.toBLOB(ext=ext)) )
+		return tiles
+
+
+	def tileRequest(self, laykey, col, row, zoom, toDstGrid=True, cacheMode=None, job=None):
 		"""
 		Return bytes data of the requested tile or None if unable to get valid data
 		Tile is downloaded from map service and, if needed, reprojected to fit the destination grid
+		cacheMode is used when source tiles are requested to build a destination tile
 		"""
 
 		#Select tile matrix set
@@ -616,13 +1139,17 @@ class MapService():
 		if not toDstGrid:
 			data = self.downloadTile(laykey, col, row, zoom)
 		else:
-			data = self.buildDstTile(laykey, col, row, zoom)
+			data = self.buildDstTile(laykey, col, row, zoom, cacheMode, job)
 
 		return data
 
 
-	def buildDstTile(self, laykey, col, row, zoom):
+	def buildDstTile(self, laykey, col, row, zoom, cacheMode=None, job=None):
 		'''build a tile that fit the destination tile matrix'''
+		if job is None:
+			job = self.job
+		#interpolating encoded elevation values would produce wrong heights
+		resamplAlg = 'NN' if getattr(self.layers[laykey], 'encoding', None) else self.RESAMP_ALG
 
 		#get tile bbox
 		bbox = self.dstTms.getTileBbox(col, row, zoom)
@@ -648,43 +1175,112 @@ class MapService():
 			return None
 
 		#list, download and merge the tiles required to build this one (recursive call)
-		mosaic = self.getImage(laykey, _bbox, _zoom, toDstGrid=False, nbThread=4, cpt=False, allowEmptyTile=False)
+		#nested request with its own progress counters but cancelled with the parent job
+		mosaic = self.getImage(laykey, _bbox, _zoom, toDstGrid=False, nbThread=4, allowEmptyTile=False, cacheMode=cacheMode, job=job.child(), decode=False)
 
 		if mosaic is None:
 			return None
 
 		#Reprojection
 		tileSize = self.dstTms.tileSize
-		img = NpImage(reprojImg(crs1, crs2, mosaic.toGDAL(), out_ul=(xmin,ymax), out_size=(tileSize,tileSize), out_res=res, sqPx=True, resamplAlg=self.RESAMP_ALG))
+		img = NpImage(reprojImg(crs1, crs2, mosaic.toGDAL(), out_ul=(xmin,ymax), out_size=(tileSize,tileSize), out_res=res, sqPx=True, resamplAlg=resamplAlg))
 
 		return img.toBLOB()
 
 
 
 
-	def seedTiles(self, laykey, tiles, toDstGrid=True, nbThread=10, buffSize=5000, cpt=True):
+	def getCacheMode(self, cacheMode=None):
+		'''Return the cache mode to use for a request, default to the mode defined for this service'''
+		if cacheMode is None:
+			cacheMode = self.cacheMode
+		if cacheMode not in self.CACHE_MODES:
+			raise ValueError('Unknow cache mode ' + str(cacheMode))
+		return cacheMode
+
+
+	def revalidate(self, laykey, tiles, toDstGrid=True):
+		"""
+		Queue expired tiles to be downloaded again in background
+		Tiles already waiting for a refresh are ignored
+		"""
+		with self.lock:
+			for col, row, zoom in tiles:
+				key = (laykey, toDstGrid, col, row, zoom)
+				if key not in self.revalPending:
+					self.revalPending.add(key)
+					self.revalQueue.put(key)
+			#(re)launch workers if needed
+			self.revalThreads = [t for t in self.revalThreads if t.is_alive()]
+			for i in range(self.REVALIDATE_THREADS - len(self.revalThreads)):
+				t = threading.Thread(target=self.revalidating)
+				t.setDaemon(True)
+				self.revalThreads.append(t)
+				t.start()
+
+	def revalidating(self):
+		'''Worker that refresh the expired tiles waiting in the revalidation queue'''
+		#refresh is not bound to the request that queued the tiles
+		job = MapJob()
+		while True:
+			try:
+				key = self.revalQueue.get(timeout=1)
+			except queue.Empty:
+				break
+			laykey, toDstGrid, col, row, zoom = key
+			try:
+				#source tiles needed to build a destination tile must be fresh too
+				data = self.tileRequest(laykey, col, row, zoom, toDstGrid, cacheMode='DEFAULT', job=job)
+				if data is not None:
+					cache = self.getCache(laykey, toDstGrid)
+					with self.lock:
+						cache.putTile(col, row, zoom, data)
+			except Exception as e:
+				log.error('Cannot refresh tile {}'.format(key), exc_info=True)
+			finally:
+				with self.lock:
+					self.revalPending.discard(key)
+				self.revalQueue.task_done()
+
+
+	def seedTiles(self, laykey, tiles, toDstGrid=True, nbThread=None, buffSize=5000, cpt=True, cacheMode=None, job=None):
 		"""
 		Seed the cache by downloading the requested tiles from map service
 		Downloads are performed through thread to speed up
 
+		nbThread : number of worker threads, if None use the maximum allowed by the service throttle.
+			In all cases the number of simultaneous http requests is bounded by the throttle
 		buffSize : maximum number of tiles keeped in memory before put them in cache database
+		cacheMode : one of CACHE_MODES, if None use the mode defined for this service
+		job : MapJob used to report progress and cancel the request, if None use the default job
 		"""
+		cacheMode = self.getCacheMode(cacheMode)
+		if job is None:
+			job = self.job
 
 		def downloading(laykey, tilesQueue, tilesData, toDstGrid):
 			'''Worker that process the queue and seed tilesData array [(x,y,z,data)]'''
 			#infinite loop that processes items into the queue
 			while not tilesQueue.empty(): #empty is True if all item was get but it not tell if all task was done
-				#cancel thread if requested
-				if not self.running:
+				#cancel thread if requested or if tiles cannot be stored anymore
+				if not job.running or seederFailed.is_set():
 					break
 				#Get a job into the queue
-				col, row, zoom = tilesQueue.get() #get() pop the item from queue
-				#do the job
-				data = self.tileRequest(laykey, col, row, zoom, toDstGrid)
-				if data is not None:
-					tilesData.put( (col, row, zoom, data) ) #will block if the queue is full
-				if cpt:
-					self.cptTiles += 1
+				if useMeta:
+					mcol, mrow, zoom, nb = tilesQueue.get() #get() pop the item from queue
+					#do the job
+					for tile in self.downloadMetatile(laykey, mcol, mrow, zoom):
+						tilesData.put(tile) #will block if the queue is full
+					if cpt:
+						job.incProgress(nb)
+				else:
+					col, row, zoom = tilesQueue.get() #get() pop the item from queue
+					#do the job
+					data = self.tileRequest(laykey, col, row, zoom, toDstGrid, cacheMode, job)
+					if data is not None:
+						tilesData.put( (col, row, zoom, data) ) #will block if the queue is full
+					if cpt:
+						job.incProgress()
 				#self.nTaskDone += 1
 				#flag it's done
 				tilesQueue.task_done() #it's just a count of finished tasks used by join() to know if the work is finished
@@ -696,108 +1292,181 @@ class MapService():
 			return not any([t.is_alive() for t in threads])
 
 		def putInCache(tilesData, jobs, cache):
+			try:
+				_putInCache(tilesData, jobs, cache)
+			except Exception:
+				log.error('Cannot put tiles in cache', exc_info=True)
+				seederFailed.set()
+
+		def _putInCache(tilesData, jobs, cache):
 			while True:
 				if tilesData.full() or \
-				( (finished() or not self.running) and not tilesData.empty()):
+				( (finished() or not job.running) and not tilesData.empty()):
 					data = [tilesData.get() for i in range(tilesData.qsize())]
 					with self.lock:
 						cache.putTiles(data)
 				if finished() and tilesData.empty():
 					break
-				if not self.running:
+				if not job.running:
 					break
 
 		if cpt:
 			#init cpt progress
-			self.nbTiles = len(tiles)
-			self.cptTiles = 0
+			job.initProgress(len(tiles))
 
 		#self.nTaskDone = 0
+		seederFailed = threading.Event()
 
 		#Get cache db
 		if cpt:
-			self.status = 1
+			job.status = 1
 		cache = self.getCache(laykey, toDstGrid)
-		missing = cache.listMissingTiles(tiles)
+		if cacheMode == 'CACHE_ONLY':
+			#offline, nothing to download
+			if cpt:
+				job.resetProgress()
+			return
+		if cacheMode == 'STALE_WHILE_REVALIDATE':
+			#expired tiles will be served as is and refreshed later
+			missing = cache.listMissingTiles(tiles, allowExpired=True)
+			expired = cache.listExpiredTiles(tiles)
+			if expired:
+				log.debug("{} expired tiles queued for refresh".format(len(expired)))
+				self.revalidate(laykey, expired, toDstGrid)
+		else:
+			missing = cache.listMissingTiles(tiles)
 		nMissing = len(missing)
-		nExists = self.nbTiles - len(missing)
-		log.debug("{} tiles requested, {} already in cache, {} remains to download".format(self.nbTiles, nExists, nMissing))
+		nExists = len(tiles) - nMissing
+		log.debug("{} tiles requested, {} already in cache, {} remains to download".format(len(tiles), nExists, nMissing))
 		if cpt:
-			self.cptTiles += nExists
+			job.incProgress(nExists)
 
 		#Downloading tiles
 		if cpt:
-			self.status = 2
+			job.status = 2
 		if len(missing) > 0:
-
-			#Result queue
-			tilesData = queue.Queue(maxsize=buffSize)
-
-			#Seed the queue
-			jobs = queue.Queue()
-			for tile in missing:
-				jobs.put(tile)
-
-			#Launch threads
-			threads = []
-			for i in range(nbThread):
-				t = threading.Thread(target=downloading, args=(laykey, jobs, tilesData, toDstGrid))
-				t.setDaemon(True)
-				threads.append(t)
-				t.start()
-
-			seeder = threading.Thread(target=putInCache, args=(tilesData, jobs, cache))
-			seeder.setDaemon(True)
-			seeder.start()
-			seeder.join()
-
-			#Make sure all threads has finished
-			for t in threads:
-				t.join()
+			with self.lock:
+				self.nbActiveJobs += 1
+			try:
+				#Result queue
+				tilesData = queue.Queue(maxsize=buffSize)
+
+				#Seed the queue
+				jobs = queue.Queue()
+				useMeta = not toDstGrid and self.useMetatiles
+				if useMeta:
+					#group missing tiles by metatile, each job will download a whole block
+					metatiles = {}
+					for col, row, zoom in missing:
+						mcol, mrow = self.getMetatile(col, row)
+						metatiles[(mcol, mrow, zoom)] = metatiles.get((mcol, mrow, zoom), 0) + 1
+					for (mcol, mrow, zoom), nb in metatiles.items():
+						jobs.put( (mcol, mrow, zoom, nb) )
+				else:
+					for tile in missing:
+						jobs.put(tile)
+
+				#Launch threads
+				if nbThread is None:
+					nbThread = self.throttle.maxThreads
+				nbThread = min(nbThread, jobs.qsize())
+				threads = []
+				for i in range(nbThread):
+					t = threading.Thread(target=downloading, args=(laykey, jobs, tilesData, toDstGrid))
+					t.setDaemon(True)
+					threads.append(t)
+					t.start()
+
+				seeder = threading.Thread(target=putInCache, args=(tilesData, jobs, cache))
+				seeder.setDaemon(True)
+				seeder.start()
+				seeder.join()
+
+				#Make sure all threads has finished, if the seeder has stopped (cancelled job or error)
+				#workers can be blocked on a full queue so drop their remaining data
+				for t in threads:
+					while t.is_alive():
+						t.join(0.1)
+						try:
+							while True:
+								tilesData.get_nowait()
+						except queue.Empty:
+							pass
+			finally:
+				#always release the job, otherwise the cache would never be compacted again
+				with self.lock:
+					self.nbActiveJobs -= 1
+			self.scheduleCompaction()
 
 		#Reinit status and cpt progress
 		if cpt:
-			self.status = 0
-			self.nbTiles, self.cptTiles = 0, 0
+			job.resetProgress()
 
 
-	def getTiles(self, laykey, tiles, toDstGrid=True, nbThread=10, cpt=True):
+	def getTiles(self, laykey, tiles, toDstGrid=True, nbThread=None, cpt=True, cacheMode=None, job=None):
 		"""
 		Return bytes data of requested tiles
 		input: [(x,y,z)] >> output: [(x,y,z,data)]
 		Tiles are downloaded from map service or directly pick up from cache database.
 		"""
+		cacheMode = self.getCacheMode(cacheMode)
 		#seed the cache
-		self.seedTiles(laykey, tiles, toDstGrid=toDstGrid, nbThread=10, cpt=cpt)
+		self.seedTiles(laykey, tiles, toDstGrid=toDstGrid, nbThread=nbThread, cpt=cpt, cacheMode=cacheMode, job=job)
 		#request the cache and return
 		cache = self.getCache(laykey, toDstGrid)
-		return cache.getTiles(tiles) #[(x,y,z,data)]
+		return cache.getTiles(tiles, allowExpired=cacheMode!='DEFAULT') #[(x,y,z,data)]
 
 
-	def getTile(self, laykey, col, row, zoom, toDstGrid=True):
-		return self.getTiles(laykey, [col, row, zoom], toDstGrid)[0]
+	def getTile(self, laykey, col, row, zoom, toDstGrid=True, cacheMode=None, job=None):
+		tiles = self.getTiles(laykey, [(col, row, zoom)], toDstGrid, cacheMode=cacheMode, job=job)
+		if not tiles:
+			return None
+		return tiles[0][3]
 
 
-	def bboxRequest(self, bbox, zoom, dstGrid=True):
+	def bboxRequest(self, bbox, zoom, dstGrid=True, polygons=None, lines=None, buffer=0):
+		"""
+		Return a request object listing the tiles covering the bbox
+		If some polygons or lines are given, only tiles intersecting these geometries are requested
+		"""
 		#Select tile matrix set
 		tm = self.getTM(dstGrid)
+		if isinstance(zoom, list):
+			return BBoxRequestMZ(tm, bbox, zoom, polygons, lines, buffer)
+		if polygons or lines:
+			return GeomRequest(tm, bbox, zoom, polygons, lines, buffer)
 		return BBoxRequest(tm, bbox, zoom)
 
 
-	def seedCache(self, laykey, bbox, zoom, toDstGrid=True, nbThread=10, buffSize=5000):
+	def getCachedZoom(self, laykey, bbox, zoom, toDstGrid=True, maxResFac=8):
 		"""
-		Seed the cache with the tiles covering the requested bbox
+		Return the closest zoom level, from the requested one to coarser ones, for which all
+		the tiles covering the bbox are available in cache (expired tiles are accepted)
+		Levels whose resolution is more than maxResFac times coarser are not considered
+		Return None if no level match
 		"""
-		#Select tile matrix set
 		tm = self.getTM(toDstGrid)
-		if isinstance(zoom, list):
-			rq = BBoxRequestMZ(tm, bbox, zoom)
-		else:
-			rq = BBoxRequest(tm, bbox, zoom)
-		self.seedTiles(laykey, rq.tiles, toDstGrid=toDstGrid, nbThread=10, buffSize=5000)
+		cache = self.getCache(laykey, toDstGrid)
+		zmin = getattr(self.layers[laykey], 'zmin', 0)
+		for z in range(zoom, max(zmin, 0) - 1, -1):
+			if tm.getFromToResFac(zoom, z) > maxResFac:
+				break
+			rq = BBoxRequest(tm, bbox, z)
+			if not cache.listMissingTiles(rq.tiles, allowExpired=True):
+				return z
+		return None
 
 
-	def getImage(self, laykey, bbox, zoom, path=None, bigTiff=False, outCRS=None, toDstGrid=True, nbThread=10, cpt=True):
+	def seedCache(self, laykey, bbox, zoom, toDstGrid=True, nbThread=None, buffSize=5000, cacheMode=None, polygons=None, lines=None, buffer=0, job=None):
+		"""
+		Seed the cache with the tiles covering the requested bbox
+		or intersecting the requested polygons or lines (buffered by buffer distance)
+		"""
+		rq = self.bboxRequest(bbox, zoom, toDstGrid, polygons, lines, buffer)
+		self.seedTiles(laykey, rq.tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=buffSize, cacheMode=cacheMode, job=job)
+
+
+	def getImage(self, laykey, bbox, zoom, path=None, bigTiff=False, outCRS=None, toDstGrid=True, nbThread=None, cpt=True, allowEmptyTile=True, cacheMode=None, polygons=None, lines=None, buffer=0, job=None, decode=True):
 		"""
 		Build a mosaic of tiles covering the requested bounding box
 		#laykey (str)
@@ -810,29 +1479,137 @@ class MapService():
 		#outCRS : destination CRS if a reprojection if expected (require GDAL support)
 		#toDstGrid (bool) : decide if the function will seed the destination tile matrix sets for this MapService instance
 		(different from the source tile matrix set)
-		#nbThread (int) : nimber of threads that will be used for downloading tiles
+		#nbThread (int) : number of threads that will be used for downloading tiles, if None the adaptive
+		throttle of the service will decide
 		#cpt (bool) : define if the service must report or not tiles downloading count for this request
+		#allowEmptyTile (bool) : if False, return None when a requested tile is not available
+		#cacheMode (str) : one of CACHE_MODES, if None use the mode defined for this service
+		#polygons, lines (list of [(x,y)]) : if defined, only the tiles intersecting these geometries buffered by
+		buffer distance are requested, others are left empty in the mosaic. bbox can be None to use the geometries extent
+		#job (MapJob) : used to report progress and cancel the request, if None use the default job of the service
+		#decode (bool) : for RGB encoded elevation layers, decide if tiles are decoded to build a float DEM
+		or merged as is
 		"""
+		cacheMode = self.getCacheMode(cacheMode)
+		if job is None:
+			job = self.job
 
 		#Select tile matrix set
 		tm = self.getTM(toDstGrid)
 
 		#Get request
-		rq = BBoxRequest(tm, bbox, zoom)
-		tileSize = rq.tileSize
-		res = rq.res
-		cols, rows = rq.cols, rq.rows
-		rqTiles = rq.tiles #[(x,y,z)]
+		rq = self.bboxRequest(bbox, zoom, toDstGrid, polygons, lines, buffer)
 
 		##method 1) Seed the cache with all required tiles
-		self.seedCache(laykey, bbox, zoom, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=5000)
+		self.seedTiles(laykey, rq.tiles, toDstGrid=toDstGrid, nbThread=nbThread, buffSize=5000, cpt=cpt, cacheMode=cacheMode, job=job)
 		cache = self.getCache(laykey, toDstGrid)
 
-		if not self.running:
+		if not job.running:
 			if cpt:
-				self.status = 0
+				job.status = 0
 			return
 
+		encoding = getattr(self.layers[laykey], 'encoding', None) if decode else None
+		return self._buildMosaic(cache, tm, rq, path, bigTiff, outCRS, cpt, allowEmptyTile, cacheMode!='DEFAULT', job, encoding)
+
+
+	def getCompositeImage(self, layers, bbox, zoom, path=None, bigTiff=False, outCRS=None, toDstGrid=True, nbThread=None, cpt=True, job=None):
+		"""
+		Build a mosaic blending several layers, possibly from other sources, over the tile matrix used by this service
+		#layers : ordered list (bottom to top) of (srckey, laykey, opacity) tuples, opacity from 0 to 1
+		Layers are seeded concurrently, then blended tile by tile and the composited tiles are stored in a
+		dedicated cache so that no full size intermediate mosaic is built. Other parameters are the same as getImage()
+		"""
+		if job is None:
+			job = self.job
+
+		tm = self.getTM(toDstGrid)
+		grdkey = self.dstGridKey if toDstGrid else self.srcGridKey
+		rq = BBoxRequest(tm, bbox, zoom)
+		cache = self.getCompositeCache(layers, toDstGrid)
+		missing = sorted(cache.listMissingTiles(rq.tiles))
+
+		if missing:
+			#Get the services that provide each layer over the same grid
+			sources = []
+			for srckey, laykey, opacity in layers:
+				if srckey == self.srckey:
+					srv = self
+				else:
+					srv = getMapService(srckey, self.cacheFolder, grdkey)
+				sources.append( (srv, laykey, opacity, srv.srcGridKey != grdkey) )
+
+			#Seed all layers at the same time, the throttle of each service bound its own downloads
+			if cpt:
+				job.initProgress(len(missing))
+				job.status = 2
+			threads = []
+			for srv, laykey, opacity, srvToDstGrid in sources:
+				t = threading.Thread(target=srv.seedTiles, args=(laykey, missing),
+					kwargs={'toDstGrid':srvToDstGrid, 'nbThread':nbThread, 'cpt':False, 'job':job.child()})
+				t.setDaemon(True)
+				threads.append(t)
+				t.start()
+			for t in threads:
+				t.join()
+
+			if not job.running:
+				if cpt:
+					job.resetProgress()
+				return None
+
+			#Blend tiles by chunk
+			chunkSize = 50
+			for i in range(0, len(missing), chunkSize):
+				chunkTiles = missing[i:i+chunkSize]
+				layersData = []
+				for srv, laykey, opacity, srvToDstGrid in sources:
+					tiles = srv.getCache(laykey, srvToDstGrid).getTiles(chunkTiles, allowExpired=True)
+					layersData.append( {(col, row, z):data for col, row, z, data in tiles} )
+				composited = []
+				for tile in chunkTiles:
+					data = blendTiles([(layerData.get(tile), layer[2]) for layerData, layer in zip(layersData, layers)], tm.tileSize)
+					if data is not None:
+						composited.append( tile + (data,) )
+				with self.lock:
+					cache.putTiles(composited)
+				if cpt:
+					job.incProgress(len(chunkTiles))
+				if not job.running:
+					if cpt:
+						job.resetProgress()
+					return None
+
+		return self._buildMosaic(cache, tm, rq, path, bigTiff, outCRS, cpt, job=job)
+
+
+	def getCompositeCache(self, layers, toDstGrid):
+		'''Return the cache of composited tiles, its key is derived from the layers definition'''
+		tm = self.getTM(toDstGrid)
+		grdkey = self.dstGridKey if toDstGrid else self.srcGridKey
+		definition = ';'.join('{}:{}:{}'.format(srckey, laykey, opacity) for srckey, laykey, opacity in layers)
+		mapKey = 'COMPOSITE_' + hashlib.md5(definition.encode('utf-8')).hexdigest()[:12] + '_' + grdkey
+		maxSize = self.cacheMaxSize * 1024**2 if self.cacheMaxSize else None
+		with self.lock:
+			cache = self.caches.get(mapKey)
+			if cache is None:
+				dbPath = os.path.join(self.cacheFolder, mapKey + ".gpkg")
+				cache = self.caches[mapKey] = GeoPackage(dbPath, tm, maxSize)
+			return cache
+
+
+	def _buildMosaic(self, cache, tm, rq, path=None, bigTiff=False, outCRS=None, cpt=True, allowEmptyTile=True, allowExpired=False, job=None, encoding=None):
+		"""
+		Merge the cached tiles of a request into a mosaic, see getImage() for parameters
+		If encoding is defined, tiles are RGB encoded elevation data and the mosaic will be a float32 DEM
+		"""
+		if job is None:
+			job = self.job
+		tileSize = rq.tileSize
+		res = rq.res
+		cols, rows = rq.cols, rq.rows
+		rqTiles = rq.tiles #[(x,y,z)]
+
 		#Get georef parameters
 		img_w, img_h = len(cols) * tileSize, len(rows) * tileSize
 		xmin, ymin, xmax, ymax = rq.bbox
@@ -841,7 +1618,15 @@ class MapService():
 		if bigTiff and path is None:
 			raise ValueError('No output path defined for creating bigTiff')
 
-		if not bigTiff:
+		if bigTiff and encoding is not None:
+			raise ValueError('Elevation layers cannot be written as bigTiff')
+
+		if encoding is not None:
+			#Create an empty DEM in memory
+			data = np.full((img_h, img_w), DEM_NODATA, dtype=np.float32)
+			mosaic = NpImage(data, noData=DEM_NODATA, georef=georef)
+			chunkSize = rq.nbTiles
+		elif not bigTiff:
 			#Create numpy image in memory
 			mosaic = NpImage.new(img_w, img_h, bkgColor=MOSAIC_BKG_COLOR, georef=georef)
 			chunkSize = rq.nbTiles
@@ -856,24 +1641,37 @@ class MapService():
 			chunkTiles = rqTiles[i:i+chunkSize]
 
 			##method 1) Get cached tiles
-			tiles = cache.getTiles(chunkTiles) #[(x,y,z,data)]
+			tiles = cache.getTiles(chunkTiles, allowExpired=allowExpired) #[(x,y,z,data)]
+			if not allowEmptyTile and len(tiles) < len(chunkTiles):
+				if cpt:
+					job.status = 0
+				return None
 
 			##method 2) Get tiles from www or cache (all tiles must fit in memory)
 			#tiles = self.getTiles(laykey, chunkTiles, toDstGrid, nbThread, cpt)
 
 			if cpt:
-				self.status = 3
+				job.status = 3
 			for tile in tiles:
 
-				if not self.running:
+				if not job.running:
 					if cpt:
-						self.status = 0
+						job.status = 0
 					return None
 
 				col, row, z, data = tile
 
 				#TODO corrupted or empty tiles must be deleted from cache are fetched again
-				if data is None:
+				if encoding is not None:
+					#missing or corrupted elevation data are left as nodata
+					if data is None:
+						continue
+					try:
+						img = decodeElevationTile(data, encoding)
+					except Exception as e:
+						log.error('Corrupted elevation tile on cache', exc_info=True)
+						continue
+				elif data is None:
 					#create an empty tile
 					img = NpImage.new(tileSize, tileSize, bkgColor=EMPTY_TILE_COLOR)
 				else:
@@ -889,15 +1687,15 @@ class MapService():
 				posy = abs((row - rq.firstRow)) * tileSize
 				mosaic.paste(img, posx, posy)
 
-		if not self.running:
+		if not job.running:
 			if cpt:
-				self.status = 0
+				job.status = 0
 			return None
 
 		#Reproject if needed
 		if outCRS is not None and outCRS != tm.CRS:
 			if cpt:
-				self.status = 4
+				job.status = 4
 			time.sleep(0.1) #make sure client have enough time to get the new status...
 
 			if not bigTiff:
@@ -916,7 +1714,7 @@ class MapService():
 
 		#Finish
 		if cpt:
-			self.status = 0
+			job.status = 0
 		if path is None:
 			return mosaic
 		else:
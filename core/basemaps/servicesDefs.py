@@ -123,9 +123,14 @@ GRIDS = {
 
 ####################################
 
+#Optional "minThreads" and "maxThreads" keys define the bounds of the adaptive number of
+#simultaneous downloads allowed for a source (default values are defined in MapService class)
+
 #With TMS or WMTS, grid must match the one used by the service
 #With WMS you can use any grid you want but the grid CRS must
 #match one of those provided by the WMS service
+#With WMS, optional "metatile" key allows to request blocks of n*n tiles in a single
+#GetMap request (and "metaBuffer" a number of pixels requested around the block)
 
 #The grid associated to the source define the CRS
 #A source can have multiple layers but have only one grid
@@ -168,6 +173,22 @@ SOURCES = {
 	},
 
 
+	#RGB encoded elevation tiles, see "encoding" layer key
+	#height = (red * 256 + green + blue / 256) - 32768
+	"TERRAIN" : {
+		"name" : 'Terrain tiles',
+		"description" : 'Mapzen terrain tiles hosted on AWS (SRTM, GMTED, ETOPO1...)',
+		"service": 'TMS',
+		"grid": 'WM',
+		"quadTree": False,
+		"layers" : {
+			"TERRARIUM" : {"urlKey" : '', "name" : 'Terrarium', "description" : 'Elevation encoded in RGB', "format" : 'png', "zmin" : 0, "zmax" : 15, "encoding" : 'terrarium'}
+		},
+		"urlTemplate": "https://s3.amazonaws.com/elevation-tiles-prod/terrarium/{Z}/{X}/{Y}.png",
+		"referer": "https://registry.opendata.aws/terrain-tiles/"
+	},
+
+
 	"BING" : {
 		"name" : 'Bing',
 		"description" : 'Microsoft Bing Map',
@@ -213,7 +234,10 @@ SOURCES = {
 			"HEIGHT" : '{HEIGHT}',
 			"TRANSPARENT" : "False"
 			},
-		"referer": "http://www.osm-wms.de/"
+		"referer": "http://www.osm-wms.de/",
+		"maxThreads": 4, #WMS renders on demand, avoid flooding the server
+		"metatile": 4, #request blocks of 4x4 tiles
+		"metaBuffer": 32 #pixels
 	},
 
 
@@ -0,0 +1,204 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+
+#built-in imports
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import threading
+import hashlib
+import imghdr
+import datetime
+import email.utils
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#core imports
+from .servicesDefs import SOURCES
+from .mapservice import getMapService, MapJob
+
+#Half size of the web mercator square extent
+WM_EXTENT = 20037508.342789244
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+	"""
+	Serve cached tiles with url like /{srckey}/{laykey}/{z}/{x}/{y}(.ext)
+	Tiles are expressed as XYZ web mercator tiles, sources using another grid are not served
+	"""
+
+	protocol_version = 'HTTP/1.1' #keep-alive
+
+	def log_message(self, format, *args):
+		log.debug(format % args)
+
+	def sendStatus(self, code, msg=None):
+		self.send_response(code, msg)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def parsePath(self):
+		'''Return (srckey, laykey, x, y, z) or None if the path is not a valid tile url'''
+		parts = self.path.split('?')[0].strip('/').split('/')
+		if len(parts) != 5:
+			return None
+		srckey, laykey, z, x, y = parts
+		y = y.split('.')[0]
+		try:
+			x, y, z = int(x), int(y), int(z)
+		except ValueError:
+			return None
+		if srckey not in SOURCES or laykey not in SOURCES[srckey]['layers']:
+			return None
+		return srckey, laykey, x, y, z
+
+	def isNotModified(self, etag, lastModified):
+		'''Evaluate conditional request headers, If-None-Match takes precedence over If-Modified-Since'''
+		ifNoneMatch = self.headers.get('If-None-Match')
+		if ifNoneMatch is not None:
+			return etag in [tag.strip() for tag in ifNoneMatch.split(',')] or ifNoneMatch.strip() == '*'
+		ifModifiedSince = self.headers.get('If-Modified-Since')
+		if ifModifiedSince is not None:
+			try:
+				date = email.utils.parsedate_to_datetime(ifModifiedSince)
+			except (TypeError, ValueError):
+				return False
+			return lastModified <= date
+		return False
+
+	def do_GET(self, body=True):
+		rq = self.parsePath()
+		if rq is None:
+			self.sendStatus(404)
+			return
+		srckey, laykey, x, y, z = rq
+
+		try:
+			record = self.server.getTileRecord(srckey, laykey, x, y, z)
+		except Exception as e:
+			log.error('Cannot get tile {}'.format(self.path), exc_info=True)
+			self.sendStatus(500)
+			return
+		if record is None:
+			self.sendStatus(404)
+			return
+		data, lastModified = record
+
+		etag = '"' + hashlib.md5(data).hexdigest() + '"'
+		#cache dates are naive local times
+		lastModified = lastModified.astimezone().astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+		#Conditional GET
+		if self.isNotModified(etag, lastModified):
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'image/' + (imghdr.what(None, data) or 'png'))
+		self.send_header('Content-Length', str(len(data)))
+		self.send_header('ETag', etag)
+		self.send_header('Last-Modified', email.utils.format_datetime(lastModified, usegmt=True))
+		self.send_header('Cache-Control', 'max-age={}'.format(self.server.maxAge))
+		self.send_header('Access-Control-Allow-Origin', '*')
+		self.end_headers()
+		if body:
+			self.wfile.write(data)
+
+	def do_HEAD(self):
+		self.do_GET(body=False)
+
+
+class TileServer(ThreadingHTTPServer):
+	"""
+	Lightweight local http server that expose the BlenderGIS tiles caches as XYZ tiles,
+	so they can be reused by other tools (QGIS, scripts...)
+
+	cacheFolder : the folder containing the GeoPackage caches
+	fetch : if True missing or expired tiles are requested to the map service, otherwise
+		only the tiles available in cache are served (even if expired)
+	maxAge : value of the Cache-Control header (seconds)
+
+	Usage : TileServer(cacheFolder, port=8080).start()
+	then tiles are available at http://localhost:8080/{srckey}/{laykey}/{z}/{x}/{y}.png
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, cacheFolder, host='127.0.0.1', port=8080, fetch=False, maxAge=86400):
+		self.cacheFolder = cacheFolder
+		self.fetch = fetch
+		self.maxAge = maxAge
+		self.thread = None
+		ThreadingHTTPServer.__init__(self, (host, port), TileRequestHandler)
+
+	@property
+	def url(self):
+		host, port = self.server_address[:2]
+		return 'http://{}:{}'.format(host, port)
+
+	@staticmethod
+	def toGridTile(tm, x, y, z):
+		'''
+		Convert a XYZ tile index (web mercator, origin north west) to the tile index of a grid
+		Return None if the grid is not the standard web mercator grid or if the tile is outside
+		'''
+		if not tm.crs.isWM or tm.tileSize != 256 or hasattr(tm, 'resolutions') or tm.resFactor != 2:
+			return None
+		if any(abs(abs(v) - WM_EXTENT) > 1 for v in tm.globalbbox) or abs(tm.initRes * 256 - 2 * WM_EXTENT) > 1:
+			return None
+		n = 2**z
+		if not (0 <= x < n and 0 <= y < n):
+			return None
+		if tm.originLoc == 'SW':
+			y = n - 1 - y
+		return x, y, z
+
+	def getTileRecord(self, srckey, laykey, x, y, z):
+		'''Return (data, lastModified) of a tile, fetched from the map service if needed and allowed'''
+		srv = getMapService(srckey, self.cacheFolder)
+		tile = self.toGridTile(srv.srcTms, x, y, z)
+		if tile is None:
+			return None
+		col, row, zoom = tile
+		#do not create empty caches when only cached tiles are served
+		if not self.fetch and not os.path.exists(srv.getCachePath(laykey, False)):
+			return None
+		cache = srv.getCache(laykey, False)
+		record = cache.getTileRecord(col, row, zoom)
+		if self.fetch and (record is None or cache.isExpired(record[1])):
+			srv.getTile(laykey, col, row, zoom, toDstGrid=False, cacheMode='DEFAULT', job=MapJob())
+			record = cache.getTileRecord(col, row, zoom) or record
+		return record
+
+	def start(self):
+		'''Serve in a background thread'''
+		self.thread = threading.Thread(target=self.serve_forever)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		log.info('Tile server listening on {}'.format(self.url))
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
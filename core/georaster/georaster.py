@@ -254,3 +254,13 @@ class GeoRaster():
 		else:
 			img = NpImage(self.path, noData=self.noData, georef=self.georef)
 		return img
+
+	def readWindowAsNpArray(self, subBoxPx):
+		'''Read only the pixels inside a subbox in pixel coordinates space (y counting from top)
+		Note that the window is read directly from the file only with GDAL, others engines load the whole image'''
+		return NpImage(self.path, subBoxPx=subBoxPx, noData=self.noData)
+
+	@property
+	def canReadWindow(self):
+		'''True if the current image engine can read a window without loading the whole image'''
+		return NpImage._getIFACE() == 'GDAL'
@@ -21,6 +21,8 @@
 
 import math
 
+import numpy as np
+
 from ..proj import SRS
 from ..utils import XY as xy, BBOX
 from ..errors import OverlapError
@@ -342,6 +344,45 @@ class GeoRef():
 			xPx, yPx = math.floor(xPx), math.floor(yPx)
 		return xy(xPx, yPx)
 
+	def geoFromPxArray(self, xPx, yPx, reverseY=False, pxCenter=True):
+		"""
+		Same as geoFromPx() but takes and returns numpy arrays of coordinates
+		return a tuple (xs, ys) of arrays
+		"""
+		xPx = np.asarray(xPx, dtype=np.float64)
+		yPx = np.asarray(yPx, dtype=np.float64)
+		if pxCenter:
+			xPx, yPx = np.floor(xPx), np.floor(yPx)
+			ox, oy = self.origin.x, self.origin.y
+		else:
+			ox = self.origin.x - abs(self.pxSize.x/2)
+			oy = self.origin.y + abs(self.pxSize.y/2)
+		if reverseY:
+			yPx = (self.rSize.y - 1) - yPx
+		x = self.pxSize.x * xPx + self.rotation.y * yPx + ox
+		y = self.pxSize.y * yPx + self.rotation.x * xPx + oy
+		return x, y
+
+	def pxFromGeoArray(self, x, y, reverseY=False, round2Floor=False):
+		"""
+		Same as pxFromGeo() but takes and returns numpy arrays of coordinates
+		return a tuple (xPx, yPx) of arrays, integer arrays if round2Floor
+		"""
+		x = np.asarray(x, dtype=np.float64)
+		y = np.asarray(y, dtype=np.float64)
+		pxSizex, pxSizey = self.pxSize
+		rotx, roty = self.rotation
+		offx = self.origin.x - abs(self.pxSize.x/2)
+		offy = self.origin.y + abs(self.pxSize.y/2)
+		det = pxSizex*pxSizey - rotx*roty
+		xPx = (pxSizey*x - rotx*y + rotx*offy - pxSizey*offx) / det
+		yPx = (-roty*x + pxSizex*y + roty*offx - pxSizex*offy) / det
+		if reverseY:
+			yPx = (self.rSize.y - 1) - yPx + 1
+		if round2Floor:
+			xPx, yPx = np.floor(xPx).astype(int), np.floor(yPx).astype(int)
+		return xPx, yPx
+
 	#Alias
 	def pxToGeo(self, xPx, yPx, reverseY=False):
 		return self.geoFromPx(xPx, yPx, reverseY)
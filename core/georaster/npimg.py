@@ -30,7 +30,7 @@ from ..proj.reproj import reprojImg
 from ..maths.fillnodata import replace_nans #inpainting function (ie fill nodata)
 from ..utils import XY as xy
 from ..checkdeps import HAS_GDAL, HAS_PIL, HAS_IMGIO
-from ..settings import getSettings
+from ..settings import getSettings, subscribe
 
 if HAS_PIL:
 	from PIL import Image
@@ -42,10 +42,29 @@ if HAS_IMGIO:
 	from ..lib import imageio
 
 
+#Resolved image engine, reset when the img_engine setting change
+_iface = None
+
+def _onSettingsChanged(changed):
+	global _iface
+	if 'img_engine' in changed:
+		_iface = None
+
+subscribe(_onSettingsChanged)
+
+
 class NpImage():
 	'''Represent an image as Numpy array'''
 
-	def _getIFACE(self):
+	@classmethod
+	def _getIFACE(cls):
+		global _iface
+		if _iface is None:
+			_iface = cls._resolveIFACE()
+		return _iface
+
+	@classmethod
+	def _resolveIFACE(cls):
 
 		prefs = getSettings()
 		engine = prefs['img_engine']
@@ -357,6 +376,9 @@ class NpImage():
 			for bandIdx in range(n):
 				bandArray = self.data[:,:,bandIdx]
 				mem.GetRasterBand(bandIdx+1).WriteArray(bandArray)
+		if self.noData is not None:
+			for bandIdx in range(n):
+				mem.GetRasterBand(bandIdx+1).SetNoDataValue(self.noData)
 		#write georef
 		if self.isGeoref:
 			mem.SetGeoTransform(self.georef.toGDAL())
@@ -365,6 +387,24 @@ class NpImage():
 		return mem
 
 
+	def toRGBAFloat(self):
+		'''
+		Return a flat float32 array of RGBA values normalized from 0 to 1, rows ordered from bottom to top
+		This is the layout expected by Blender image pixels buffer
+		'''
+		data = self.data
+		if data.ndim == 2:
+			data = data[:, :, np.newaxis]
+		if data.shape[2] <= 2: #gray or gray + alpha
+			data = np.dstack([data[:, :, 0]]*3 + [data[:, :, 1:]])
+		if data.shape[2] == 3:
+			alpha = np.full(data.shape[:2] + (1,), np.iinfo(data.dtype).max if not self.isFloat else 1, dtype=data.dtype)
+			data = np.append(data, alpha, axis=2)
+		data = data[::-1].astype(np.float32)
+		if not self.isFloat:
+			data /= np.iinfo(self.dtype).max
+		return data.ravel()
+
 	def removeAlpha(self):
 		if self.hasAlpha:
 			self.data = self.data[:, :, 0:3]
@@ -387,8 +427,13 @@ class NpImage():
 		imgFormat = path[-3:]
 
 		if self.IFACE == 'PIL':
-			self.toPIL().save(path)
+			if imgFormat == 'tif' and self.noData is not None:
+				#write nodata in the GDAL_NODATA tiff tag, as read by GeoRaster
+				self.toPIL().save(path, tiffinfo={42113: str(self.noData)})
+			else:
+				self.toPIL().save(path)
 		elif self.IFACE == 'IMGIO':
+			#nodata value cannot be written with freeimage
 			if imgFormat == 'jpg' and self.hasAlpha:
 				self.removeAlpha()
 			imageio.imwrite(path, self.data)#float32 support ok
@@ -421,6 +466,7 @@ class NpImage():
 
 		if img.isOneBand and self.isOneBand:
 			self.data[y:y+h, x:x+w] = data
+			return
 		elif (not img.isOneBand and self.isOneBand) or (img.isOneBand and not self.isOneBand):
 			raise ValueError('Paste error, cannot mix one band with multiband')
 
@@ -456,7 +502,7 @@ class NpImage():
 			# Cast to float
 			self.cast2float()
 			# Fill mask with NaN (warning NaN is a special value for float arrays only)
-			self.data =  np.ma.filled(self.data, np.NaN)
+			self.data =  np.ma.filled(self.data, np.nan)
 			# Inpainting
 			self.data = replace_nans(self.data, max_iter=5, tolerance=0.5, kernel_size=2, method='localmean')
 
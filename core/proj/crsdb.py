@@ -0,0 +1,253 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import re
+import shutil
+import sqlite3
+import threading
+
+from .srv import EPSGIO
+from ..checkdeps import HAS_GDAL, HAS_PYPROJ
+from ..settings import getUserDir
+
+if HAS_GDAL:
+	from osgeo import osr
+
+if HAS_PYPROJ:
+	import pyproj
+
+
+######################################
+# Local database of EPSG crs definitions
+# The crs list is built once from the PROJ database shipped with pyproj or GDAL,
+# or from a small set of seed definitions when none of them is available.
+# Proj4 and wkt definitions are resolved on first request and stored in the db,
+# so lookups and searches do not need any network access.
+# The db is written in the user folder, a db shipped with the addon is only used read-only as seed.
+
+DB_NAME = 'crs.db'
+SEED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), DB_NAME)
+
+#Seed definitions : code, name, area of use, proj4
+SEEDS = [
+	(4326, 'WGS 84', 'World', '+proj=longlat +datum=WGS84 +no_defs'),
+	(3857, 'WGS 84 / Pseudo-Mercator', 'World between 85.06S and 85.06N', '+proj=merc +a=6378137 +b=6378137 +lat_ts=0 +lon_0=0 +x_0=0 +y_0=0 +k=1 +units=m +nadgrids=@null +wktext +no_defs'),
+	(4258, 'ETRS89', 'Europe', '+proj=longlat +ellps=GRS80 +no_defs'),
+	(4269, 'NAD83', 'North America', '+proj=longlat +datum=NAD83 +no_defs'),
+	(3035, 'ETRS89-extended / LAEA Europe', 'Europe', '+proj=laea +lat_0=52 +lon_0=10 +x_0=4321000 +y_0=3210000 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs'),
+	(2154, 'RGF93 / Lambert-93', 'France', '+proj=lcc +lat_0=46.5 +lon_0=3 +lat_1=49 +lat_2=44 +x_0=700000 +y_0=6600000 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs'),
+	(27700, 'OSGB 1936 / British National Grid', 'United Kingdom', '+proj=tmerc +lat_0=49 +lon_0=-2 +k=0.9996012717 +x_0=400000 +y_0=-100000 +ellps=airy +towgs84=446.448,-125.157,542.06,0.15,0.247,0.842,-20.489 +units=m +no_defs'),
+	(2056, 'CH1903+ / LV95', 'Switzerland', '+proj=somerc +lat_0=46.95240555555556 +lon_0=7.439583333333333 +k_0=1 +x_0=2600000 +y_0=1200000 +ellps=bessel +towgs84=674.374,15.056,405.346,0,0,0,0 +units=m +no_defs'),
+	(31370, 'Belge 1972 / Belgian Lambert 72', 'Belgium', '+proj=lcc +lat_1=51.16666723333333 +lat_2=49.8333339 +lat_0=90 +lon_0=4.367486666666666 +x_0=150000.013 +y_0=5400088.438 +ellps=intl +towgs84=-106.869,52.2978,-103.724,0.3366,-0.457,1.8422,-1.2747 +units=m +no_defs'),
+	(28992, 'Amersfoort / RD New', 'Netherlands', '+proj=sterea +lat_0=52.15616055555555 +lon_0=5.38763888888889 +k=0.9999079 +x_0=155000 +y_0=463000 +ellps=bessel +towgs84=565.417,50.3319,465.552,-0.398957,0.343988,-1.8774,4.0725 +units=m +no_defs')
+]
+#ETRS89 and WGS84 UTM zones
+SEEDS += [(25800 + z, 'ETRS89 / UTM zone {}N'.format(z), 'Europe', '+proj=utm +zone={} +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs'.format(z)) for z in range(28, 39)]
+SEEDS += [(32600 + z, 'WGS 84 / UTM zone {}N'.format(z), 'World - N hemisphere', '+proj=utm +zone={} +datum=WGS84 +units=m +no_defs'.format(z)) for z in range(1, 61)]
+SEEDS += [(32700 + z, 'WGS 84 / UTM zone {}S'.format(z), 'World - S hemisphere', '+proj=utm +zone={} +south +datum=WGS84 +units=m +no_defs'.format(z)) for z in range(1, 61)]
+
+
+class CrsDB():
+
+	def __init__(self, path=None):
+		self.dbPath = path or os.path.join(getUserDir(), DB_NAME)
+		self.hasFTS = False
+		if not self.isValid() and self.isValid(SEED_PATH) and self.dbPath != SEED_PATH:
+			shutil.copyfile(SEED_PATH, self.dbPath)
+		if not self.isValid():
+			self.create()
+			self.build()
+		else:
+			self.hasFTS = self._checkFTS()
+
+	def connect(self):
+		return sqlite3.connect(self.dbPath, timeout=10)
+
+	def isValid(self, path=None):
+		path = path or self.dbPath
+		if not os.path.exists(path):
+			return False
+		db = sqlite3.connect(path, timeout=10)
+		try:
+			n = db.execute('SELECT count(*) FROM crs').fetchone()[0]
+		except sqlite3.Error:
+			return False
+		else:
+			return n > 0
+		finally:
+			db.close()
+
+	def _checkFTS(self):
+		db = self.connect()
+		try:
+			db.execute('SELECT rowid FROM crs_fts LIMIT 1')
+		except sqlite3.Error:
+			return False
+		else:
+			return True
+		finally:
+			db.close()
+
+	def create(self):
+		db = self.connect()
+		db.execute("DROP TABLE IF EXISTS crs")
+		db.execute("DROP TABLE IF EXISTS crs_fts")
+		db.execute("""
+			CREATE TABLE crs (
+				code INTEGER NOT NULL PRIMARY KEY,
+				name TEXT NOT NULL,
+				area TEXT,
+				proj4 TEXT,
+				wkt TEXT);
+		""")
+		#full text search index, fts5 can be missing from some sqlite builds
+		try:
+			db.execute("CREATE VIRTUAL TABLE crs_fts USING fts5(name, area, content='crs', content_rowid='code')")
+			self.hasFTS = True
+		except sqlite3.OperationalError:
+			log.warning('SQLite FTS5 not available, crs search will be slower')
+			self.hasFTS = False
+		db.commit()
+		db.close()
+
+	def listFromLibs(self):
+		'''Return a list of (code, name, area) from the PROJ database available through pyproj or GDAL'''
+		if HAS_PYPROJ:
+			try:
+				from pyproj.database import query_crs_info
+				return [(int(info.code), info.name, info.area_of_use.name if info.area_of_use else None)
+					for info in query_crs_info(auth_name='EPSG') if info.code.isdigit()]
+			except Exception as e: #pyproj < 3
+				log.debug('Cannot list crs from pyproj : {}'.format(e))
+		if HAS_GDAL:
+			try:
+				return [(int(info.code), info.name, info.area_name)
+					for info in osr.GetCRSInfoListFromDatabase('EPSG') if info.code.isdigit()]
+			except Exception as e: #gdal < 3.1
+				log.debug('Cannot list crs from gdal : {}'.format(e))
+		return []
+
+	def build(self):
+		rows = [(code, name, area, proj4, None) for code, name, area, proj4 in SEEDS]
+		rows += [(code, name, area, None, None) for code, name, area in self.listFromLibs()]
+		db = self.connect()
+		db.executemany("INSERT OR IGNORE INTO crs (code, name, area, proj4, wkt) VALUES (?, ?, ?, ?, ?)", rows)
+		if self.hasFTS:
+			db.execute("INSERT INTO crs_fts (crs_fts) VALUES ('rebuild')")
+		db.commit()
+		log.info('CRS database built with {} definitions'.format(db.execute('SELECT count(*) FROM crs').fetchone()[0]))
+		db.close()
+
+	def search(self, query, limit=50):
+		'''
+		Search crs by code, name or area of use
+		return a list of dict with 'code' and 'name' keys, same as epsg.io search results
+		'''
+		query = str(query).strip()
+		if ':' in query:
+			query = query.split(':', 1)[1]
+		db = self.connect()
+		if query.isdigit():
+			rows = db.execute("SELECT code, name, area FROM crs WHERE code = ?", (int(query),)).fetchall()
+		else:
+			words = re.findall(r'\w+', query)
+			if not words:
+				rows = []
+			elif self.hasFTS:
+				match = ' '.join('"{}"*'.format(w) for w in words)
+				rows = db.execute("SELECT code, name, area FROM crs WHERE code IN (SELECT rowid FROM crs_fts WHERE crs_fts MATCH ? ORDER BY rank LIMIT ?)", (match, limit)).fetchall()
+			else:
+				where = ' AND '.join(["(name || ' ' || ifnull(area, '')) LIKE ?"] * len(words))
+				rows = db.execute("SELECT code, name, area FROM crs WHERE " + where + " LIMIT ?", ['%' + w + '%' for w in words] + [limit]).fetchall()
+		db.close()
+		return [{'code': str(code), 'name': name, 'area': area} for code, name, area in rows]
+
+	def getName(self, code):
+		db = self.connect()
+		row = db.execute("SELECT name FROM crs WHERE code = ?", (int(code),)).fetchone()
+		db.close()
+		return row[0] if row else None
+
+	def _getField(self, code, field):
+		db = self.connect()
+		row = db.execute("SELECT " + field + " FROM crs WHERE code = ?", (int(code),)).fetchone()
+		db.close()
+		return row[0] if row else None
+
+	def _setField(self, code, field, value):
+		db = self.connect()
+		db.execute("UPDATE crs SET " + field + " = ? WHERE code = ?", (value, int(code)))
+		db.commit()
+		db.close()
+
+	def getProj4(self, code):
+		'''Return the proj4 string of an EPSG code, resolved once with pyproj or GDAL then stored, None if unknown'''
+		proj4 = self._getField(code, 'proj4')
+		if proj4:
+			return proj4
+		try:
+			if HAS_PYPROJ:
+				proj4 = pyproj.CRS.from_epsg(int(code)).to_proj4()
+			elif HAS_GDAL:
+				prj = osr.SpatialReference()
+				prj.ImportFromEPSG(int(code))
+				proj4 = prj.ExportToProj4()
+		except Exception as e:
+			log.warning('Cannot resolve proj4 of EPSG:{} : {}'.format(code, e))
+			return None
+		if proj4:
+			self._setField(code, 'proj4', proj4)
+		return proj4
+
+	def getWKT(self, code):
+		'''Return the ESRI flavored wkt (as used in .prj files) of an EPSG code, None if unknown'''
+		wkt = self._getField(code, 'wkt')
+		if wkt:
+			return wkt
+		try:
+			if HAS_GDAL:
+				prj = osr.SpatialReference()
+				prj.ImportFromEPSG(int(code))
+				prj.MorphToESRI()
+				wkt = prj.ExportToWkt()
+			elif HAS_PYPROJ:
+				wkt = pyproj.CRS.from_epsg(int(code)).to_wkt('WKT1_ESRI')
+			elif EPSGIO.ping():
+				wkt = EPSGIO.getEsriWkt(code)
+		except Exception as e:
+			log.warning('Cannot resolve wkt of EPSG:{} : {}'.format(code, e))
+			return None
+		if wkt:
+			self._setField(code, 'wkt', wkt)
+		return wkt
+
+
+_crsdb = None
+_crsdbLock = threading.Lock()
+
+def getCrsDB():
+	'''Return the shared crs database, build it on first call'''
+	global _crsdb
+	with _crsdbLock:
+		if _crsdb is None:
+			_crsdb = CrsDB()
+		return _crsdb
@@ -9,8 +9,58 @@ class Ellps():
 		self.f = (self.a-self.b)/self.a#inverse flat
 		self.perimeter = (2*math.pi*self.a)#perimeter at equator
 
+	@classmethod
+	def fromInvFlat(cls, a, rf):
+		"""build from equatorial radius and inverse flattening"""
+		return cls(a, a * (1 - 1 / rf))
+
+	@property
+	def e2(self):
+		"""first eccentricity squared"""
+		return 1 - (self.b / self.a)**2
+
+	@classmethod
+	def fromProj4(cls, params):
+		"""build from a dict of proj4 parameters as returned by SRS.loadProj4()"""
+		if '+a' in params:
+			a = params['+a']
+			if '+b' in params:
+				return cls(a, params['+b'])
+			elif '+rf' in params:
+				return cls.fromInvFlat(a, params['+rf'])
+			else:
+				return cls(a, a) #sphere
+		name = params.get('+ellps', DATUMS_ELLPS.get(params.get('+datum'), 'WGS84'))
+		if name not in ELLIPSOIDS:
+			raise ValueError('Unknown ellipsoid ' + str(name))
+		return ELLIPSOIDS[name]
+
 GRS80 = Ellps(6378137, 6356752.314245)
 
+#proj4 ellipsoid names
+ELLIPSOIDS = {
+	'GRS80' : GRS80,
+	'WGS84' : Ellps.fromInvFlat(6378137, 298.257223563),
+	'intl' : Ellps.fromInvFlat(6378388, 297),
+	'bessel' : Ellps.fromInvFlat(6377397.155, 299.1528128),
+	'airy' : Ellps.fromInvFlat(6377563.396, 299.3249646),
+	'mod_airy' : Ellps(6377340.189, 6356034.446),
+	'clrk66' : Ellps(6378206.4, 6356583.8),
+	'clrk80' : Ellps.fromInvFlat(6378249.145, 293.4663),
+	'clrk80ign' : Ellps.fromInvFlat(6378249.2, 293.4660212936269),
+	'krass' : Ellps.fromInvFlat(6378245, 298.3),
+	'aust_SA' : Ellps.fromInvFlat(6378160, 298.25)
+}
+
+#ellipsoid of proj4 datum names
+DATUMS_ELLPS = {
+	'WGS84' : 'WGS84',
+	'NAD83' : 'GRS80',
+	'NAD27' : 'clrk66',
+	'OSGB36' : 'airy',
+	'potsdam' : 'bessel'
+}
+
 def dd2meters(dst):
 	"""
 	Basic function to approximaly convert a short distance in decimal degrees to meters
@@ -0,0 +1,280 @@
+# -*- coding:utf-8 -*-
+
+#  ***** GPL LICENSE BLOCK *****
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#  All rights reserved.
+#  ***** GPL LICENSE BLOCK *****
+import logging
+log = logging.getLogger(__name__)
+
+import math
+
+import numpy as np
+
+from .ellps import Ellps, ELLIPSOIDS
+from .utm import zone_number_to_central_longitude
+
+
+######################################
+# Vectorized map projections built from proj4 parameters, used by the builtin reprojection engine
+# All functions take and return numpy arrays, geographic coordinates are WGS84 longitudes and latitudes
+# formulas : Snyder, Map Projections - A Working Manual (USGS PP 1395)
+
+#datum shifts of proj4 datum names
+DATUMS_TOWGS84 = {
+	'WGS84' : '0,0,0',
+	'NAD83' : '0,0,0',
+	'OSGB36' : '446.448,-125.157,542.06,0.15,0.247,0.842,-20.489',
+	'potsdam' : '598.1,73.7,418.2,0.202,0.045,-2.455,6.7'
+}
+
+SEC_TO_RAD = math.pi / (180 * 3600)
+
+
+class Helmert():
+	'''
+	7 parameters datum shift (proj4 +towgs84, position vector convention)
+	Translations in meters, rotations in arc seconds, scale in ppm
+	'''
+
+	def __init__(self, towgs84, ellps):
+		params = [float(v) for v in str(towgs84).split(',')] + [0] * 7
+		self.tx, self.ty, self.tz = params[:3]
+		self.rx, self.ry, self.rz = (v * SEC_TO_RAD for v in params[3:6])
+		self.s = params[6] * 1e-6
+		self.ellps = ellps
+		self.wgs84 = ELLIPSOIDS['WGS84']
+
+	@property
+	def isNull(self):
+		return not any([self.tx, self.ty, self.tz, self.rx, self.ry, self.rz, self.s])
+
+	@staticmethod
+	def geoToECEF(lon, lat, ellps):
+		lon, lat = np.radians(lon), np.radians(lat)
+		sinLat = np.sin(lat)
+		n = ellps.a / np.sqrt(1 - ellps.e2 * sinLat**2)
+		x = n * np.cos(lat) * np.cos(lon)
+		y = n * np.cos(lat) * np.sin(lon)
+		z = n * (1 - ellps.e2) * sinLat
+		return x, y, z
+
+	@staticmethod
+	def ECEFToGeo(x, y, z, ellps):
+		#Bowring closed form, sub millimeter near the ellipsoid surface
+		a, b, e2 = ellps.a, ellps.b, ellps.e2
+		ep2 = e2 / (1 - e2)
+		p = np.hypot(x, y)
+		theta = np.arctan2(z * a, p * b)
+		lat = np.arctan2(z + ep2 * b * np.sin(theta)**3, p - e2 * a * np.cos(theta)**3)
+		lon = np.arctan2(y, x)
+		return np.degrees(lon), np.degrees(lat)
+
+	def _transform(self, x, y, z, sign):
+		tx, ty, tz = sign * self.tx, sign * self.ty, sign * self.tz
+		rx, ry, rz, s = sign * self.rx, sign * self.ry, sign * self.rz, 1 + sign * self.s
+		return (tx + s * (x - rz * y + ry * z),
+			ty + s * (rz * x + y - rx * z),
+			tz + s * (-ry * x + rx * y + z))
+
+	def toWGS84(self, lon, lat):
+		x, y, z = self.geoToECEF(lon, lat, self.ellps)
+		return self.ECEFToGeo(*self._transform(x, y, z, 1), self.wgs84)
+
+	def fromWGS84(self, lon, lat):
+		#inverse with negated parameters, accurate enough for the small rotations used by datums
+		x, y, z = self.geoToECEF(lon, lat, self.wgs84)
+		return self.ECEFToGeo(*self._transform(x, y, z, -1), self.ellps)
+
+
+class Projection():
+	'''Base class, handle ellipsoid, false easting and northing, units and datum shift'''
+
+	def __init__(self, params):
+		self.ellps = Ellps.fromProj4(params)
+		self.a = self.ellps.a
+		self.e2 = self.ellps.e2
+		self.e = math.sqrt(self.e2)
+		self.lon0 = params.get('+lon_0', 0)
+		self.lat0 = params.get('+lat_0', 0)
+		self.k0 = params.get('+k_0', params.get('+k', 1))
+		self.x0 = params.get('+x_0', 0)
+		self.y0 = params.get('+y_0', 0)
+		self.toMeter = params.get('+to_meter', 1)
+		if params.get('+units', 'm') not in ('m', 'degrees'):
+			raise NotImplementedError('Unsupported units ' + str(params['+units']))
+		#datum free fast path when no shift is defined, like proj4 the geographic coordinates
+		#are then considered to be the same on both datums
+		towgs84 = params.get('+towgs84', DATUMS_TOWGS84.get(params.get('+datum'), '0,0,0'))
+		helmert = Helmert(towgs84, self.ellps)
+		self.helmert = None if helmert.isNull else helmert
+
+	def fromLonLat(self, lons, lats):
+		'''WGS84 longitudes and latitudes to projected coordinates'''
+		lons, lats = np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+		if self.helmert is not None:
+			lons, lats = self.helmert.fromWGS84(lons, lats)
+		x, y = self.forward(np.radians(lons - self.lon0), np.radians(lats))
+		return (x + self.x0) / self.toMeter, (y + self.y0) / self.toMeter
+
+	def toLonLat(self, xs, ys):
+		'''Projected coordinates to WGS84 longitudes and latitudes'''
+		xs = np.asarray(xs, dtype=np.float64) * self.toMeter - self.x0
+		ys = np.asarray(ys, dtype=np.float64) * self.toMeter - self.y0
+		lam, phi = self.inverse(xs, ys)
+		lons, lats = np.degrees(lam) + self.lon0, np.degrees(phi)
+		if self.helmert is not None:
+			lons, lats = self.helmert.toWGS84(lons, lats)
+		return lons, lats
+
+	def forward(self, lam, phi):
+		'''Radians, relative to central meridian, to meters without false origin'''
+		raise NotImplementedError
+
+	def inverse(self, x, y):
+		raise NotImplementedError
+
+
+class LongLat(Projection):
+
+	def __init__(self, params):
+		Projection.__init__(self, params)
+		self.x0 = self.y0 = 0
+		self.toMeter = 1
+
+	def forward(self, lam, phi):
+		return np.degrees(lam) + self.lon0, np.degrees(phi)
+
+	def inverse(self, x, y):
+		return np.radians(x - self.lon0), np.radians(y)
+
+
+class TMerc(Projection):
+	'''Transverse Mercator (ellipsoidal form), also used for proj4 utm definitions'''
+
+	def __init__(self, params):
+		if params.get('+proj') == 'utm':
+			params = dict(params)
+			params['+lon_0'] = zone_number_to_central_longitude(int(params['+zone']))
+			params['+k_0'] = 0.9996
+			params['+x_0'] = 500000
+			params['+y_0'] = 10000000 if params.get('+south') else 0
+		Projection.__init__(self, params)
+		e2 = self.e2
+		self.ep2 = e2 / (1 - e2)
+		self.m1 = 1 - e2/4 - 3*e2**2/64 - 5*e2**3/256
+		self.m2 = 3*e2/8 + 3*e2**2/32 + 45*e2**3/1024
+		self.m3 = 15*e2**2/256 + 45*e2**3/1024
+		self.m4 = 35*e2**3/3072
+		self.M0 = self.meridianDist(math.radians(self.lat0))
+		e1 = (1 - math.sqrt(1 - e2)) / (1 + math.sqrt(1 - e2))
+		self.p2 = 3*e1/2 - 27*e1**3/32
+		self.p4 = 21*e1**2/16 - 55*e1**4/32
+		self.p6 = 151*e1**3/96
+		self.p8 = 1097*e1**4/512
+
+	def meridianDist(self, phi):
+		return self.a * (self.m1 * phi - self.m2 * np.sin(2*phi) + self.m3 * np.sin(4*phi) - self.m4 * np.sin(6*phi))
+
+	def forward(self, lam, phi):
+		e2, ep2, k0 = self.e2, self.ep2, self.k0
+		sinPhi, cosPhi, tanPhi = np.sin(phi), np.cos(phi), np.tan(phi)
+		n = self.a / np.sqrt(1 - e2 * sinPhi**2)
+		t = tanPhi**2
+		c = ep2 * cosPhi**2
+		a = lam * cosPhi
+		m = self.meridianDist(phi)
+		x = k0 * n * (a + (1 - t + c) * a**3 / 6 + (5 - 18*t + t**2 + 72*c - 58*ep2) * a**5 / 120)
+		y = k0 * (m - self.M0 + n * tanPhi * (a**2 / 2 + (5 - t + 9*c + 4*c**2) * a**4 / 24
+			+ (61 - 58*t + t**2 + 600*c - 330*ep2) * a**6 / 720))
+		return x, y
+
+	def inverse(self, x, y):
+		e2, ep2, k0 = self.e2, self.ep2, self.k0
+		m = self.M0 + y / k0
+		mu = m / (self.a * self.m1)
+		phi1 = mu + self.p2 * np.sin(2*mu) + self.p4 * np.sin(4*mu) + self.p6 * np.sin(6*mu) + self.p8 * np.sin(8*mu)
+		sinPhi1, cosPhi1, tanPhi1 = np.sin(phi1), np.cos(phi1), np.tan(phi1)
+		c1 = ep2 * cosPhi1**2
+		t1 = tanPhi1**2
+		n1 = self.a / np.sqrt(1 - e2 * sinPhi1**2)
+		r1 = self.a * (1 - e2) / (1 - e2 * sinPhi1**2)**1.5
+		d = x / (n1 * k0)
+		phi = phi1 - (n1 * tanPhi1 / r1) * (d**2 / 2 - (5 + 3*t1 + 10*c1 - 4*c1**2 - 9*ep2) * d**4 / 24
+			+ (61 + 90*t1 + 298*c1 + 45*t1**2 - 252*ep2 - 3*c1**2) * d**6 / 720)
+		lam = (d - (1 + 2*t1 + c1) * d**3 / 6 + (5 - 2*c1 + 28*t1 - 3*c1**2 + 8*ep2 + 24*t1**2) * d**5 / 120) / cosPhi1
+		return lam, phi
+
+
+class LCC(Projection):
+	'''Lambert Conformal Conic, one standard parallel (1SP) or two standard parallels (2SP)'''
+
+	def __init__(self, params):
+		Projection.__init__(self, params)
+		lat1 = math.radians(params.get('+lat_1', self.lat0))
+		lat2 = math.radians(params.get('+lat_2', params.get('+lat_1', self.lat0)))
+		m1, m2 = self._m(lat1), self._m(lat2)
+		t1, t2 = self._t(lat1), self._t(lat2)
+		if abs(lat1 - lat2) > 1e-10:
+			self.n = (math.log(m1) - math.log(m2)) / (math.log(t1) - math.log(t2))
+		else:
+			self.n = math.sin(lat1)
+		self.F = m1 / (self.n * t1**self.n)
+		self.rho0 = self.a * self.k0 * self.F * self._t(math.radians(self.lat0))**self.n
+
+	def _m(self, phi):
+		return np.cos(phi) / np.sqrt(1 - self.e2 * np.sin(phi)**2)
+
+	def _t(self, phi):
+		esin = self.e * np.sin(phi)
+		return np.tan(math.pi/4 - phi/2) / ((1 - esin) / (1 + esin))**(self.e/2)
+
+	def forward(self, lam, phi):
+		rho = self.a * self.k0 * self.F * self._t(phi)**self.n
+		theta = self.n * lam
+		return rho * np.sin(theta), self.rho0 - rho * np.cos(theta)
+
+	def inverse(self, x, y):
+		sign = 1 if self.n > 0 else -1
+		rho = sign * np.hypot(x, self.rho0 - y)
+		theta = np.arctan2(sign * x, sign * (self.rho0 - y))
+		t = (rho / (self.a * self.k0 * self.F))**(1 / self.n)
+		phi = math.pi/2 - 2 * np.arctan(t)
+		for i in range(15):
+			esin = self.e * np.sin(phi)
+			_phi = math.pi/2 - 2 * np.arctan(t * ((1 - esin) / (1 + esin))**(self.e/2))
+			if np.all(np.abs(_phi - phi) < 1e-12):
+				phi = _phi
+				break
+			phi = _phi
+		return theta / self.n, phi
+
+
+PROJECTIONS = {
+	'longlat' : LongLat,
+	'latlong' : LongLat,
+	'tmerc' : TMerc,
+	'utm' : TMerc,
+	'lcc' : LCC
+}
+
+def getProjection(params):
+	'''Return a projection object from a dict of proj4 parameters, raise NotImplementedError if unsupported'''
+	proj = params.get('+proj')
+	if proj not in PROJECTIONS:
+		raise NotImplementedError('Projection not supported by the builtin engine : ' + str(proj))
+	if '+nadgrids' in params and params['+nadgrids'] != '@null':
+		log.warning('Grid based datum shift is not supported by the builtin engine, ignoring ' + str(params['+nadgrids']))
+	return PROJECTIONS[proj](params)
@@ -18,17 +18,26 @@
 #  ***** GPL LICENSE BLOCK *****
 
 
+import os
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+log = logging.getLogger(__name__)
+from collections import OrderedDict
+
+import numpy as np
 
 from .srs import SRS
-from .utm import UTM, UTM_EPSG_CODES
+from .utm import UTM
+from .projections import getProjection
 from .ellps import GRS80
 from .srv import EPSGIO
 
 from ..errors import ReprojError
 from ..utils import BBOX
 from ..checkdeps import HAS_GDAL, HAS_PYPROJ
-from ..settings import getSettings
+from ..settings import getSettings, getSetting, subscribe
 
 if HAS_GDAL:
 	from osgeo import osr, gdal
@@ -54,6 +63,22 @@ def lonLatToWebMerc(lon, lat):
 	y = lat * k
 	return x, y
 
+#Vectorized versions, take and return numpy arrays
+
+def webMercToLonLatArray(xs, ys):
+	k = GRS80.perimeter/360
+	lon = np.asarray(xs, dtype=np.float64) / k
+	lat = np.asarray(ys, dtype=np.float64) / k
+	lat = 180 / math.pi * (2 * np.arctan( np.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
+	return lon, lat
+
+def lonLatToWebMercArray(lons, lats):
+	k = GRS80.perimeter/360
+	x = np.asarray(lons, dtype=np.float64) * k
+	lat = np.log( np.tan((90 + np.asarray(lats, dtype=np.float64)) * math.pi / 360.0 )) / (math.pi / 180.0)
+	y = lat * k
+	return x, y
+
 
 ######################################
 # Raster reproj using GDAL
@@ -184,10 +209,48 @@ def reprojImg(crs1, crs2, ds1, out_ul=None, out_size=None, out_res=None, sqPx=Fa
 
 
 
+def getBuiltinProj(crs):
+	'''
+	Return a tuple of functions (toLonLat, fromLonLat) that convert numpy arrays of coordinates
+	between this crs and WGS84 longitudes and latitudes, or None if not supported by the builtin engine
+	'''
+	if crs.isWGS84:
+		return None, None
+	#fast paths
+	if crs.isWM:
+		return webMercToLonLatArray, lonLatToWebMercArray
+	if crs.isUTM:
+		utm = UTM.init_from_epsg(crs)
+		return utm.utm_to_lonlat_array, utm.lonlat_to_utm_array
+	try:
+		prj = getProjection(crs.loadProj4())
+	except (NotImplementedError, ValueError, KeyError) as e:
+		log.debug('Builtin engine cannot handle {} : {}'.format(crs, e))
+		return None
+	return prj.toLonLat, prj.fromLonLat
+
+
+def _bilinear(c00, c10, c01, c11, u, v):
+	'''Interpolate between 4 corners values, u and v are normalized coords (0 to 1)'''
+	return c00 * (1-u) * (1-v) + c10 * u * (1-v) + c01 * (1-u) * v + c11 * u * v
+
+
 class Reproj():
 
+	#approximate transformer : bellow this number of points a cell is exactly reprojected
+	APPROX_MIN_PTS = 64
+	#approximate transformer : maximum number of cell subdivisions
+	APPROX_MAX_DEPTH = 10
+	#array reprojection : number of points transformed at once by a worker thread
+	CHUNK_SIZE = 100000
+	#bbox reprojection : default number of points sampled along each edge
+	BBOX_SAMPLES = 21
+
 	def __init__(self, crs1, crs2):
 
+		#transforms objects (osr) are not thread safe
+		self.lock = threading.Lock()
+
 		#init CRS class
 		try:
 			crs1, crs2 = SRS(crs1), SRS(crs2)
@@ -204,30 +267,36 @@ class Reproj():
 		if self.iproj not in ['AUTO', 'GDAL', 'PYPROJ', 'BUILTIN', 'EPSGIO']:
 			raise ReprojError('Wrong engine name')
 
+		#builtin projections, resolved once for both the engine selection and the builtin engine
+		prj1 = prj2 = None
+
 		if self.iproj == 'AUTO':
 			# Init proj4 interface for this instance
 			if HAS_GDAL:
 				self.iproj = 'GDAL'
 			elif HAS_PYPROJ:
 				 self.iproj = 'PYPROJ'
-			elif ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)):
-				self.iproj = 'BUILTIN'
-			elif EPSGIO.ping():
-				#this is the slower solution, not suitable for reproject lot of points
-				self.iproj = 'EPSGIO'
 			else:
-				raise ReprojError('Too limited reprojection capabilities.')
+				prj1, prj2 = getBuiltinProj(crs1), getBuiltinProj(crs2)
+				if prj1 is not None and prj2 is not None:
+					self.iproj = 'BUILTIN'
+				elif EPSGIO.ping():
+					#this is the slower solution, not suitable for reproject lot of points
+					self.iproj = 'EPSGIO'
+				else:
+					raise ReprojError('Too limited reprojection capabilities.')
 		else:
 			if (self.iproj == 'GDAL' and not HAS_GDAL) or (self.iproj == 'PYPROJ' and not HAS_PYPROJ):
 				raise ReprojError('Missing reproj engine')
-			if self.iproj == 'BUILTIN':
-				if not ( ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)) ):
-					raise ReprojError('Too limited built in reprojection capabilities')
 			if self.iproj == 'EPSGIO':
 				if not  EPSGIO.ping():
 					raise ReprojError('Cannot access epsg.io service')
 
 
+		#keep srs to build per thread transforms
+		self.srs1, self.srs2 = crs1, crs2
+		self._local = threading.local()
+
 		if self.iproj == 'GDAL':
 			self.crs1 = crs1.getOgrSpatialRef()
 			self.crs2 = crs2.getOgrSpatialRef()
@@ -244,16 +313,14 @@ class Reproj():
 				raise ReprojError('EPSG.io support only EPSG code')
 
 		elif self.iproj == 'BUILTIN':
-			if ((crs1.isWM or crs1.isUTM) and crs2.isWGS84) or (crs1.isWGS84 and (crs2.isWM or crs2.isUTM)):
-				#just store codes
-				self.crs1, self.crs2 = crs1.code, crs2.code
-			else:
-				raise ReprojError('Not implemented transformation')
-			#init UTM class
-			if crs1.isUTM:
-				self.utm = UTM.init_from_epsg(crs1)
-			elif crs2.isUTM:
-				self.utm = UTM.init_from_epsg(crs2)
+			#transformations are chained through WGS84 longitudes and latitudes
+			self.crs1, self.crs2 = crs1.code, crs2.code
+			if prj1 is None:
+				prj1, prj2 = getBuiltinProj(crs1), getBuiltinProj(crs2)
+			if prj1 is None or prj2 is None:
+				raise ReprojError('Too limited built in reprojection capabilities')
+			self.toLonLat, _ = prj1
+			_, self.fromLonLat = prj2
 
 
 	def pts(self, pts):
@@ -267,7 +334,8 @@ class Reproj():
 			return pts
 
 		if self.iproj == 'GDAL':
-			xs, ys, _zs = zip(*self.osrTransfo.TransformPoints(pts))
+			with self.lock:
+				xs, ys, _zs = zip(*self.osrTransfo.TransformPoints(pts))
 			return list(zip(xs, ys))
 
 		elif self.iproj == 'PYPROJ':
@@ -279,16 +347,146 @@ class Reproj():
 			return EPSGIO.reprojPts(self.crs1, self.crs2, pts)
 
 		elif self.iproj == 'BUILTIN':
-			#Web Mercator
-			if self.crs1 == 4326 and self.crs2 == 3857:
-				return [lonLatToWebMerc(*pt) for pt in pts]
-			elif self.crs1 == 3857 and self.crs2 == 4326:
-				return [webMercToLonLat(*pt) for pt in pts]
-			#UTM
-			if self.crs1 == 4326 and self.crs2 in UTM_EPSG_CODES:
-				return [self.utm.lonlat_to_utm(*pt) for pt in pts]
-			elif self.crs1 in UTM_EPSG_CODES and self.crs2 == 4326:
-				return [self.utm.utm_to_lonlat(*pt) for pt in pts]
+			xs, ys = self._builtin(*np.asarray(pts, dtype=np.float64).T)
+			return list(zip(xs.tolist(), ys.tolist()))
+
+	def _builtin(self, xs, ys):
+		if self.toLonLat is not None:
+			xs, ys = self.toLonLat(xs, ys)
+		if self.fromLonLat is not None:
+			xs, ys = self.fromLonLat(xs, ys)
+		return np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+
+
+	def ptsArray(self, pts, maxErr=None, nbThreads=None):
+		'''
+		Reproject a numpy array of points of shape (n, 2) and return a new array
+		Large arrays are transformed by chunks on a pool of threads (GDAL, pyproj and numpy
+		release the GIL) and written into a preallocated output array
+		nbThreads : number of worker threads, default to the number of cpu
+		maxErr : if defined, use an approximate transformer. Points are exactly reprojected
+		only on an adaptive grid over their extent and bilinearly interpolated in between,
+		cells are subdivided until the error is lower than maxErr (in destination crs units).
+		This is suitable for dense regular inputs like dem vertices or uv coordinates
+		'''
+		pts = np.asarray(pts, dtype=np.float64)
+		if pts.ndim != 2 or pts.shape[1] != 2:
+			raise ReprojError('Points must be an array of shape (n, 2)')
+		if self.iproj == 'NO_REPROJ':
+			return pts.copy()
+		#builtin engine is already vectorized, the approximation would not be faster
+		if maxErr is None or self.iproj == 'BUILTIN' or len(pts) <= self.APPROX_MIN_PTS:
+			return self._ptsArray(pts, nbThreads)
+		try:
+			return self._ptsApprox(pts, maxErr)
+		except (ReprojError, ValueError) as e:
+			#control points can fall outside the projection domain
+			log.debug('Approximate reprojection failed, fallback to exact transform : {}'.format(e))
+			return self._ptsArray(pts, nbThreads)
+
+	def _ptsArray(self, pts, nbThreads=None):
+		out = np.empty((len(pts), 2))
+		if len(pts) <= self.CHUNK_SIZE or self.iproj == 'EPSGIO':
+			self._transformChunk(pts, out)
+			return out
+		chunks = [slice(i, i + self.CHUNK_SIZE) for i in range(0, len(pts), self.CHUNK_SIZE)]
+		nbThreads = min(nbThreads or os.cpu_count() or 1, len(chunks))
+		with ThreadPoolExecutor(max_workers=nbThreads) as pool:
+			#consume the results to raise workers exceptions
+			list(pool.map(lambda chunk: self._transformChunk(pts[chunk], out[chunk]), chunks))
+		return out
+
+	def _transformChunk(self, pts, out):
+		'''Transform an array of points and write the result into out array'''
+		if len(pts) == 0:
+			return
+		if self.iproj == 'BUILTIN':
+			out[:,0], out[:,1] = self._builtin(pts[:,0], pts[:,1])
+		elif self.iproj == 'GDAL':
+			out[:] = np.array(self._getOsrTransfo().TransformPoints(pts), dtype=np.float64)[:,:2]
+		elif self.iproj == 'PYPROJ':
+			crs1, crs2 = self._getPyProjs()
+			out[:,0], out[:,1] = pyproj.transform(crs1, crs2, pts[:,0], pts[:,1])
+		else:
+			out[:] = self.pts(pts.tolist())
+
+	def _getOsrTransfo(self):
+		'''osr transforms are not thread safe, each thread get its own one'''
+		transfo = getattr(self._local, 'osrTransfo', None)
+		if transfo is None:
+			transfo = osr.CoordinateTransformation(self.srs1.getOgrSpatialRef(), self.srs2.getOgrSpatialRef())
+			self._local.osrTransfo = transfo
+		return transfo
+
+	def _getPyProjs(self):
+		projs = getattr(self._local, 'projs', None)
+		if projs is None:
+			projs = self._local.projs = (self.srs1.getPyProj(), self.srs2.getPyProj())
+		return projs
+
+	def _ptsApprox(self, pts, maxErr):
+		xs, ys = pts[:,0], pts[:,1]
+		out = np.empty_like(pts)
+		exact = []
+		#relative position of control points inside a cell, first the 4 corners then the checkpoints
+		checks = [(0.5, 0), (0.5, 1), (0, 0.5), (1, 0.5), (0.5, 0.5)]
+		uv = np.array([(0, 0), (1, 0), (0, 1), (1, 1)] + checks)
+		#cells extents [xmin, ymin, xmax, ymax] and cell index of each pending point
+		cells = np.array([[xs.min(), ys.min(), xs.max(), ys.max()]])
+		pending = np.arange(len(pts))
+		cellOf = np.zeros(len(pts), dtype=int)
+		depth = 0
+		while len(pending):
+			#exactly reproject the control points of all cells at once
+			xmin, ymin, xmax, ymax = cells.T
+			ctrlX = xmin[:,None] + uv[:,0] * (xmax - xmin)[:,None]
+			ctrlY = ymin[:,None] + uv[:,1] * (ymax - ymin)[:,None]
+			ctrl = self._ptsArray(np.column_stack((ctrlX.ravel(), ctrlY.ravel()))).reshape(len(cells), len(uv), 2)
+			corners = ctrl[:,:4]
+			#compare with bilinear estimation at checkpoints
+			est = np.stack([_bilinear(*corners.transpose(1,0,2), u, v) for u, v in checks], axis=1)
+			err = np.hypot(*(est - ctrl[:,4:]).transpose(2,0,1)).max(axis=1)
+			accepted = (err <= maxErr)[cellOf]
+
+			#interpolate the points of accepted cells
+			if accepted.any():
+				idx, cid = pending[accepted], cellOf[accepted]
+				ext = cells[cid]
+				w, h = ext[:,2] - ext[:,0], ext[:,3] - ext[:,1]
+				u = np.divide(xs[idx] - ext[:,0], w, out=np.zeros(len(idx)), where=w>0)
+				v = np.divide(ys[idx] - ext[:,1], h, out=np.zeros(len(idx)), where=h>0)
+				out[idx] = _bilinear(*corners[cid].transpose(1,0,2), u[:,None], v[:,None])
+
+			#small cells or too deep subdivisions are exactly reprojected
+			pending, cellOf = pending[~accepted], cellOf[~accepted]
+			if depth >= self.APPROX_MAX_DEPTH:
+				exact.append(pending)
+				break
+			small = (np.bincount(cellOf, minlength=len(cells)) <= self.APPROX_MIN_PTS)[cellOf]
+			exact.append(pending[small])
+			pending, cellOf = pending[~small], cellOf[~small]
+
+			#split remaining cells in 4 sub cells
+			ext = cells[cellOf]
+			xmid, ymid = (ext[:,0] + ext[:,2]) / 2, (ext[:,1] + ext[:,3]) / 2
+			quad = cellOf * 4 + (xs[pending] >= xmid) + 2 * (ys[pending] >= ymid)
+			#only keep non empty sub cells
+			used = np.bincount(quad, minlength=len(cells) * 4) > 0
+			cellOf = (np.cumsum(used) - 1)[quad]
+			quad = np.flatnonzero(used)
+			parent, right, top = cells[quad // 4], (quad % 2) == 1, (quad % 4) >= 2
+			xmid, ymid = (parent[:,0] + parent[:,2]) / 2, (parent[:,1] + parent[:,3]) / 2
+			cells = np.column_stack((
+				np.where(right, xmid, parent[:,0]),
+				np.where(top, ymid, parent[:,1]),
+				np.where(right, parent[:,2], xmid),
+				np.where(top, parent[:,3], ymid)))
+			depth += 1
+
+		if exact:
+			idx = np.concatenate(exact)
+			out[idx] = self._ptsArray(pts[idx])
+		return out
 
 	def pt(self, x, y):
 		if x is None or y is None:
@@ -296,15 +494,30 @@ class Reproj():
 		return self.pts([(x,y)])[0]
 
 
-	def bbox(self, bbox):
-		'''io type = BBOX() class'''
+	def bbox(self, bbox, samples=None):
+		'''
+		io type = BBOX() class
+		Edges are densified with samples points (corners included) so that the result contains
+		the whole footprint of curved projections, all points are reprojected in a single call
+		'''
 		if not isinstance(bbox, BBOX):
 			bbox = BBOX(*bbox) #list must be ordered from bottom left upper right
-		corners = self.pts(bbox.corners)
-		_xmin = min( pt[0] for pt in corners )
-		_xmax = max( pt[0] for pt in corners )
-		_ymin = min( pt[1] for pt in corners )
-		_ymax = max( pt[1] for pt in corners )
+		samples = max(2, samples or self.BBOX_SAMPLES)
+		t = np.linspace(0, 1, samples)
+		xs = bbox.xmin + t * (bbox.xmax - bbox.xmin)
+		ys = bbox.ymin + t * (bbox.ymax - bbox.ymin)
+		xmin, xmax = np.full(samples, bbox.xmin), np.full(samples, bbox.xmax)
+		ymin, ymax = np.full(samples, bbox.ymin), np.full(samples, bbox.ymax)
+		pts = np.column_stack((
+			np.concatenate((xs, xmax, xs, xmin)),
+			np.concatenate((ymin, ys, ymax, ys))))
+		pts = self.ptsArray(pts)
+		#points outside the projection domain can be returned as inf or nan
+		pts = pts[np.isfinite(pts).all(axis=1)]
+		if len(pts) == 0:
+			raise ReprojError('Cannot reproject bbox {}'.format(bbox))
+		_xmin, _ymin = pts.min(axis=0).tolist()
+		_xmax, _ymax = pts.max(axis=0).tolist()
 		if bbox.hasZ:
 			return BBOX(_xmin, _ymin, bbox.zmin, _xmax, _ymax, bbox.zmax)
 		else:
@@ -312,13 +525,56 @@ class Reproj():
 
 
 
+######################################
+# Reproj instances cache
+# Reproj() init is slow (settings file reading, srs parsing, transforms building)
+# so instances are shared and reused, keyed by crs pair and projection engine
+
+REPROJ_CACHE_SIZE = 32
+
+_reprojCache = OrderedDict()
+_reprojLock = threading.Lock()
+
+def getReproj(crs1, crs2):
+	"""
+	Return a cached Reproj instance for this crs pair, create it if needed
+	Changing the projection engine in settings invalidates previous instances
+	"""
+	try:
+		key = (str(SRS(crs1)), str(SRS(crs2)), getSetting('proj_engine'))
+	except Exception as e:
+		raise ReprojError(str(e))
+	with _reprojLock:
+		rprj = _reprojCache.get(key)
+		if rprj is not None:
+			_reprojCache.move_to_end(key)
+			return rprj
+	#build outside the lock, init can be slow (epsg.io ping)
+	rprj = Reproj(crs1, crs2)
+	with _reprojLock:
+		_reprojCache[key] = rprj
+		_reprojCache.move_to_end(key)
+		while len(_reprojCache) > REPROJ_CACHE_SIZE:
+			_reprojCache.popitem(last=False)
+	return rprj
+
+def clearReprojCache():
+	with _reprojLock:
+		_reprojCache.clear()
+
+def _onSettingsChanged(changed):
+	if 'proj_engine' in changed:
+		clearReprojCache()
+
+subscribe(_onSettingsChanged)
+
+
 def reprojPt(crs1, crs2, x, y):
 	"""
 	Reproject x1,y1 coords from crs1 to crs2
 	crs can be an EPSG code (interger or string) or a proj4 string
-	WARN : do not use this function in a loop because Reproj() init is slow
 	"""
-	rprj = Reproj(crs1, crs2)
+	rprj = getReproj(crs1, crs2)
 	return rprj.pt(x, y)
 
 
@@ -327,11 +583,14 @@ def reprojPts(crs1, crs2, pts):
 	Reproject [pts] from crs1 to crs2
 	crs can be an EPSG code (integer or srid string) or a proj4 string
 	pts must be [(x,y)]
-	WARN : do not use this function in a loop because Reproj() init is slow
 	"""
-	rprj = Reproj(crs1, crs2)
+	rprj = getReproj(crs1, crs2)
 	return rprj.pts(pts)
 
-def reprojBbox(crs1, crs2, bbox):
-	rprj = Reproj(crs1, crs2)
-	return rprj.bbox(bbox)
+def reprojBbox(crs1, crs2, bbox, samples=None):
+	"""
+	Reproject a bbox from crs1 to crs2
+	samples : number of points sampled along each edge, default to Reproj.BBOX_SAMPLES
+	"""
+	rprj = getReproj(crs1, crs2)
+	return rprj.bbox(bbox, samples)
@@ -21,6 +21,7 @@ log = logging.getLogger(__name__)
 
 from .utm import UTM, UTM_EPSG_CODES
 from .srv import EPSGIO
+from .crsdb import getCrsDB
 
 from ..checkdeps import HAS_GDAL, HAS_PYPROJ
 
@@ -170,12 +171,21 @@ class SRS():
 			raise ValueError('Cannot initialize pyproj object for projection {}. Error : {}'.format(self.proj4, e))
 
 
+	def getProj4(self):
+		'''Return the full proj4 definition, EPSG codes are resolved with the local crs database'''
+		if self.isEPSG:
+			proj4 = getCrsDB().getProj4(self.code)
+			if proj4:
+				return proj4
+		return self.proj4
+
 	def loadProj4(self):
 		'''Return a Python dict of proj4 parameters'''
 		dc = {}
-		if self.proj4 is None:
+		proj4 = self.getProj4()
+		if proj4 is None:
 			return dc
-		for param in self.proj4.split(' '):
+		for param in proj4.split(' '):
 			if param.count('=') == 1:
 				k, v = param.split('=')
 				try:
@@ -183,8 +193,9 @@ class SRS():
 				except ValueError:
 					pass
 				dc[k] = v
-			else:
-				pass
+			elif param.startswith('+'):
+				#flags like +south or +no_defs
+				dc[param] = True
 		return dc
 
 	@property
@@ -209,6 +220,9 @@ class SRS():
 			prj = self.getOgrSpatialRef()
 			return prj.ExportToWkt()
 		elif self.isEPSG:
-			return EPSGIO.getEsriWkt(self.code)
+			wkt = getCrsDB().getWKT(self.code)
+			if wkt is None:
+				raise ValueError('No wkt definition found for EPSG:{}'.format(self.code))
+			return wkt
 		else:
 			raise NotImplementedError
@@ -20,10 +20,17 @@ import logging
 log = logging.getLogger(__name__)
 
 
+import os
+import time
+import json
+import sqlite3
+import threading
+import http.client
 from urllib.request import Request, urlopen
 from urllib.error import URLError, HTTPError
-import json
-from ..settings import getSetting
+from urllib.parse import urlsplit, quote
+from concurrent.futures import ThreadPoolExecutor
+from ..settings import getSetting, getUserDir
 
 USER_AGENT = getSetting('user_agent')
 
@@ -32,114 +39,276 @@ USER_AGENT = getSetting('user_agent')
 # https://github.com/klokantech/epsg.io
 
 
-class EPSGIO():
-
-	@staticmethod
-	def ping():
-		url = "http://epsg.io"
-		try:
-			rq = Request(url, headers={'User-Agent': USER_AGENT})
-			urlopen(rq, timeout=1)
-			return True
-		except URLError as e:
-			log.error('Cannot ping {} web service, {}'.format(url, e.reason))
-			return False
-		except HTTPError as e:
-			lor.error('Cannot ping {} web service, http error {}'.format(url, e.code))
-			return False
-		except:
-			raise
-
-
-	@staticmethod
-	def reprojPt(epsg1, epsg2, x1, y1):
+class EPSGIOCache():
+	'''
+	On disk cache of epsg.io responses and transformed coordinates
+	Points are stored with the same rounding as the one used in requests,
+	they expire after maxAge seconds and the oldest ones are removed above maxPts
+	Responses expire after maxAge seconds too, empty responses are not cached
+	'''
+
+	def __init__(self, path, maxPts=500000, maxAge=30*24*3600):
+		self.dbPath = path
+		self.maxPts = maxPts
+		self.maxAge = maxAge
+		self.lock = threading.Lock()
+		db = self.connect()
+		db.execute("CREATE TABLE IF NOT EXISTS pts (crs1 TEXT, crs2 TEXT, x REAL, y REAL, rx REAL, ry REAL, t REAL, PRIMARY KEY (crs1, crs2, x, y))")
+		db.execute("CREATE INDEX IF NOT EXISTS pts_t ON pts (t)")
+		db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, data TEXT, t REAL)")
+		#caches created by older versions have no time column, their responses are considered expired
+		if 't' not in [row[1] for row in db.execute("PRAGMA table_info(responses)")]:
+			db.execute("ALTER TABLE responses ADD COLUMN t REAL")
+		db.commit()
+		db.close()
+
+	def connect(self):
+		return sqlite3.connect(self.dbPath, timeout=10)
+
+	def getPts(self, crs1, crs2, pts):
+		'''Return a dict {(x,y):(rx,ry)} of the cached points'''
+		result = {}
+		db = self.connect()
+		#chunked to stay under sqlite variables limit
+		for i in range(0, len(pts), 400):
+			chunk = pts[i:i+400]
+			where = ' OR '.join(['(x = ? AND y = ?)'] * len(chunk))
+			params = [str(crs1), str(crs2), time.time() - self.maxAge] + [v for pt in chunk for v in pt]
+			for x, y, rx, ry in db.execute("SELECT x, y, rx, ry FROM pts WHERE crs1 = ? AND crs2 = ? AND t > ? AND (" + where + ")", params):
+				result[(x, y)] = (rx, ry)
+		db.close()
+		return result
 
-		url = "http://epsg.io/trans?x={X}&y={Y}&z={Z}&s_srs={CRS1}&t_srs={CRS2}"
+	def putPts(self, crs1, crs2, pts, results):
+		with self.lock:
+			db = self.connect()
+			t = time.time()
+			db.executemany("INSERT OR REPLACE INTO pts VALUES (?, ?, ?, ?, ?, ?, ?)",
+				[(str(crs1), str(crs2), x, y, rx, ry, t) for (x, y), (rx, ry) in zip(pts, results)])
+			self._prune(db, t)
+			db.commit()
+			db.close()
+
+	def _prune(self, db, t):
+		'''Remove expired points and the oldest ones above the size limit'''
+		db.execute("DELETE FROM pts WHERE t < ?", (t - self.maxAge,))
+		n = db.execute("SELECT count(*) FROM pts").fetchone()[0]
+		if n > self.maxPts:
+			db.execute("DELETE FROM pts WHERE rowid IN (SELECT rowid FROM pts ORDER BY t LIMIT ?)", (n - self.maxPts,))
+
+	def getResponse(self, url):
+		db = self.connect()
+		row = db.execute("SELECT data FROM responses WHERE url = ? AND t > ?", (url, time.time() - self.maxAge)).fetchone()
+		db.close()
+		return row[0] if row else None
+
+	def putResponse(self, url, data):
+		if not data or not data.strip():
+			return
+		with self.lock:
+			db = self.connect()
+			t = time.time()
+			db.execute("INSERT OR REPLACE INTO responses (url, data, t) VALUES (?, ?, ?)", (url, data, t))
+			db.execute("DELETE FROM responses WHERE t IS NULL OR t < ?", (t - self.maxAge,))
+			db.commit()
+			db.close()
+
+	def clear(self):
+		'''Remove all cached responses and points'''
+		with self.lock:
+			db = self.connect()
+			db.execute("DELETE FROM responses")
+			db.execute("DELETE FROM pts")
+			db.commit()
+			db.close()
 
-		url = url.replace("{X}", str(x1))
-		url = url.replace("{Y}", str(y1))
-		url = url.replace("{Z}", '0')
-		url = url.replace("{CRS1}", str(epsg1))
-		url = url.replace("{CRS2}", str(epsg2))
 
-		log.debug(url)
+class EPSGIO():
 
+	#can be redirected to a mirror or a local server
+	BASE_URL = "http://epsg.io"
+	#cache of responses and transformed coordinates, stored in the user folder if no path is defined
+	CACHE_ENABLED = True
+	CACHE_PATH = None
+	#max number of cached points and their lifetime (seconds)
+	CACHE_MAX_PTS = 500000
+	CACHE_MAX_AGE = 30*24*3600
+	#delay during which a ping result is reused (seconds)
+	PING_TTL = 300
+	#number of concurrent requests
+	MAX_THREADS = 4
+	#max length of points data in a single url (limit is 4094)
+	MAX_URL_DATA = 4000
+	#coordinates precision of requests
+	PRECISION = 4
+	TIMEOUT = 10
+
+	_ping = (None, 0) #last ping result and its time
+	_local = threading.local() #per thread http connection
+	_cache = None
+	_cacheLock = threading.Lock()
+	#workers are kept alive across calls so that their connections are reused
+	_pool = None
+	_poolLock = threading.Lock()
+
+	@classmethod
+	def getCache(cls):
+		if not cls.CACHE_ENABLED:
+			return None
+		path = cls.CACHE_PATH or os.path.join(getUserDir(), 'epsgio.db')
+		with cls._cacheLock:
+			if cls._cache is None or cls._cache.dbPath != path:
+				cls._cache = EPSGIOCache(path, cls.CACHE_MAX_PTS, cls.CACHE_MAX_AGE)
+			return cls._cache
+
+	@classmethod
+	def clearCache(cls):
+		cache = cls.getCache()
+		if cache is not None:
+			cache.clear()
+
+	@classmethod
+	def getPool(cls):
+		'''Return the shared pool of request workers'''
+		with cls._poolLock:
+			if cls._pool is None:
+				cls._pool = ThreadPoolExecutor(max_workers=cls.MAX_THREADS, thread_name_prefix='epsgio')
+			return cls._pool
+
+	@classmethod
+	def ping(cls):
+		result, t = cls._ping
+		if result is not None and time.time() - t < cls.PING_TTL:
+			return result
+		url = cls.BASE_URL
 		try:
 			rq = Request(url, headers={'User-Agent': USER_AGENT})
-			response = urlopen(rq).read().decode('utf8')
-		except (URLError, HTTPError) as err:
-			log.error('Http request fails url:{}, code:{}, error:{}'.format(url, err.code, err.reason))
-			raise
-
-		obj = json.loads(response)
-
-		return (float(obj['x']), float(obj['y']))
-
-	@staticmethod
-	def reprojPts(epsg1, epsg2, points):
-
-		if len(points) == 1:
-			x, y = points[0]
-			return [EPSGIO.reprojPt(epsg1, epsg2, x, y)]
-
-		urlTemplate = "http://epsg.io/trans?data={POINTS}&s_srs={CRS1}&t_srs={CRS2}"
-
-		urlTemplate = urlTemplate.replace("{CRS1}", str(epsg1))
-		urlTemplate = urlTemplate.replace("{CRS2}", str(epsg2))
-
-		#data = ';'.join([','.join(map(str, p)) for p in points])
+			urlopen(rq, timeout=1)
+			result = True
+		except HTTPError as e:
+			log.error('Cannot ping {} web service, http error {}'.format(url, e.code))
+			result = False
+		except (URLError, OSError) as e:
+			log.error('Cannot ping {} web service, {}'.format(url, getattr(e, 'reason', e)))
+			result = False
+		cls._ping = (result, time.time())
+		return result
 
-		precision = 4
-		data = [','.join( [str(round(v, precision)) for v in p] ) for p in points ]
-		part, parts = [], []
-		for i,p in enumerate(data):
-			l = sum([len(p) for p in part]) + len(';'*len(part))
-			if l + len(p) < 4000: #limit is 4094
-				part.append(p)
+	@classmethod
+	def _connect(cls):
+		'''Return the http connection of the current thread, connections are kept alive between requests'''
+		scheme, netloc, _, _, _ = urlsplit(cls.BASE_URL)
+		conn = getattr(cls._local, 'conn', None)
+		if conn is None or getattr(cls._local, 'netloc', None) != netloc:
+			if scheme == 'https':
+				conn = http.client.HTTPSConnection(netloc, timeout=cls.TIMEOUT)
 			else:
-				parts.append(part)
-				part = [p]
-			if i == len(data)-1:
-				parts.append(part)
-		parts = [';'.join(part) for part in parts]
-
-		result = []
-		for part in parts:
-			url = urlTemplate.replace("{POINTS}", part)
-			log.debug(url)
-
+				conn = http.client.HTTPConnection(netloc, timeout=cls.TIMEOUT)
+			cls._local.conn, cls._local.netloc = conn, netloc
+		return conn
+
+	@classmethod
+	def _get(cls, path):
+		'''Send a GET request through the pooled connection and return the decoded response'''
+		url = cls.BASE_URL.rstrip('/') + path
+		log.debug(url)
+		urlPath = urlsplit(url).path or '/'
+		query = urlsplit(url).query
+		if query:
+			urlPath += '?' + query
+		for attempt in range(2):
+			conn = cls._connect()
 			try:
-				rq = Request(url, headers={'User-Agent': USER_AGENT})
-				response = urlopen(rq).read().decode('utf8')
-			except (URLError, HTTPError) as err:
-				log.error('Http request fails url:{}, code:{}, error:{}'.format(url, err.code, err.reason))
-				raise
-
-			obj = json.loads(response)
-			result.extend( [(float(p['x']), float(p['y'])) for p in obj] )
-
-		return result
-
-	@staticmethod
-	def search(query):
-		query = str(query).replace(' ', '+')
-		url = "http://epsg.io/?q={QUERY}&format=json"
-		url = url.replace("{QUERY}", query)
-		log.debug('Search crs : {}'.format(url))
-		rq = Request(url, headers={'User-Agent': USER_AGENT})
-		response = urlopen(rq).read().decode('utf8')
+				conn.request('GET', urlPath, headers={'User-Agent': USER_AGENT})
+				response = conn.getresponse()
+				data = response.read().decode('utf8')
+			except (http.client.HTTPException, OSError) as e:
+				#the server may have closed the kept alive connection, retry once with a new one
+				conn.close()
+				cls._local.conn = None
+				if attempt:
+					log.error('Http request fails url:{}, error:{}'.format(url, e))
+					raise
+				continue
+			if response.status != 200:
+				log.error('Http request fails url:{}, code:{}, error:{}'.format(url, response.status, response.reason))
+				raise HTTPError(url, response.status, response.reason, response.headers, None)
+			return data
+
+	@classmethod
+	def _getCached(cls, path):
+		cache = cls.getCache()
+		if cache is not None:
+			data = cache.getResponse(path)
+			if data is not None:
+				return data
+		data = cls._get(path)
+		if cache is not None:
+			cache.putResponse(path, data)
+		return data
+
+	@classmethod
+	def reprojPt(cls, epsg1, epsg2, x1, y1):
+		return cls.reprojPts(epsg1, epsg2, [(x1, y1)])[0]
+
+	@classmethod
+	def _fetchPt(cls, epsg1, epsg2, pt):
+		x, y = pt
+		obj = json.loads(cls._get("/trans?x={}&y={}&z=0&s_srs={}&t_srs={}".format(x, y, epsg1, epsg2)))
+		return [(float(obj['x']), float(obj['y']))]
+
+	@classmethod
+	def _fetchPts(cls, epsg1, epsg2, pts):
+		if len(pts) == 1:
+			return cls._fetchPt(epsg1, epsg2, pts[0])
+		data = ';'.join([','.join(map(str, p)) for p in pts])
+		obj = json.loads(cls._get("/trans?data={}&s_srs={}&t_srs={}".format(data, epsg1, epsg2)))
+		return [(float(p['x']), float(p['y'])) for p in obj]
+
+	@classmethod
+	def reprojPts(cls, epsg1, epsg2, points):
+
+		precision = cls.PRECISION
+		points = [(round(x, precision), round(y, precision)) for x, y in points]
+
+		#only request points that are not already cached
+		cache = cls.getCache()
+		unique = list(dict.fromkeys(points))
+		known = cache.getPts(epsg1, epsg2, unique) if cache is not None else {}
+		missing = [p for p in unique if p not in known]
+
+		#split the points into url of limited length
+		parts, part, l = [], [], 0
+		for p in missing:
+			n = len(','.join(map(str, p))) + 1
+			if part and l + n >= cls.MAX_URL_DATA:
+				parts.append(part)
+				part, l = [], 0
+			part.append(p)
+			l += n
+		if part:
+			parts.append(part)
+
+		if parts:
+			results = list(cls.getPool().map(lambda part: cls._fetchPts(epsg1, epsg2, part), parts))
+			for part, result in zip(parts, results):
+				known.update(zip(part, result))
+				if cache is not None:
+					cache.putPts(epsg1, epsg2, part, result)
+
+		return [known[p] for p in points]
+
+	@classmethod
+	def search(cls, query):
+		query = quote(str(query)).replace('%20', '+')
+		response = cls._getCached("/?q={}&format=json".format(query))
 		obj = json.loads(response)
 		log.debug('Search results : {}'.format([ (r['code'], r['name']) for r in obj['results'] ]))
 		return obj['results']
 
-	@staticmethod
-	def getEsriWkt(epsg):
-		url = "http://epsg.io/{CODE}.esriwkt"
-		url = url.replace("{CODE}", str(epsg))
-		log.debug(url)
-		rq = Request(url, headers={'User-Agent': USER_AGENT})
-		wkt = urlopen(rq).read().decode('utf8')
-		return wkt
+	@classmethod
+	def getEsriWkt(cls, epsg):
+		return cls._getCached("/{}.esriwkt".format(epsg))
 
 
 
@@ -2,6 +2,9 @@
 
 import os
 import json
+import logging
+import threading
+log = logging.getLogger(__name__)
 
 from .checkdeps import HAS_GDAL, HAS_PYPROJ, HAS_IMGIO, HAS_PIL
 #from .proj import EPSGIO #WARN this one causes circular import because proj.reproj is imported in proj.__init__ and it also import settings.py
@@ -9,14 +12,81 @@ from .checkdeps import HAS_GDAL, HAS_PYPROJ, HAS_IMGIO, HAS_PIL
 cfgFile = os.path.dirname(os.path.abspath(__file__)) + '/settings.json'
 #cfgFile = os.path.join(os.path.dirname(__file__), "settings.json")
 
+#In memory copy of the settings file, reloaded only when the file mtime changes
+_settings = None
+_mtime = None
+_lock = threading.RLock()
+
+#Callbacks notified with the set of changed keys
+_subscribers = []
+
+def subscribe(callback):
+	'''Register a function called as callback(changedKeys) whenever settings change'''
+	if callback not in _subscribers:
+		_subscribers.append(callback)
+
+def unsubscribe(callback):
+	if callback in _subscribers:
+		_subscribers.remove(callback)
+
+def _notify(old, new):
+	if old is None:
+		return
+	changed = {k for k in set(old) | set(new) if old.get(k) != new.get(k)}
+	if not changed:
+		return
+	for callback in list(_subscribers):
+		try:
+			callback(changed)
+		except Exception:
+			log.error('Settings subscriber failed', exc_info=True)
+
+def _update(prefs, mtime):
+	global _settings, _mtime
+	old = _settings
+	_settings, _mtime = prefs, mtime
+	return old
+
 def getSettings():
-	with open(cfgFile, 'r') as cfg:
-		prefs = json.load(cfg)
-	return prefs
+	with _lock:
+		mtime = os.path.getmtime(cfgFile)
+		if _settings is not None and mtime == _mtime:
+			return dict(_settings)
+		with open(cfgFile, 'r') as cfg:
+			prefs = json.load(cfg)
+		old = _update(prefs, mtime)
+	_notify(old, prefs)
+	return dict(prefs)
 
 def setSettings(prefs):
-	with open(cfgFile, 'w') as cfg:
-		json.dump(prefs, cfg, indent='\t')
+	prefs = dict(prefs)
+	with _lock:
+		with open(cfgFile, 'w') as cfg:
+			json.dump(prefs, cfg, indent='\t')
+		old = _update(prefs, os.path.getmtime(cfgFile))
+	_notify(old, prefs)
+
+def reloadSettings():
+	'''Force reading the settings file on next access'''
+	global _mtime
+	with _lock:
+		_mtime = None
+
+def getUserDir():
+	'''
+	Return a writable folder for user data like local databases, created if needed
+	Use the Blender user config folder when available so data are kept across addon updates
+	'''
+	folder = None
+	try:
+		import bpy
+		folder = bpy.utils.user_resource('CONFIG', path='blendergis', create=True)
+	except (ImportError, AttributeError, TypeError):
+		pass
+	if not folder:
+		folder = os.path.join(os.path.expanduser('~'), '.blendergis')
+		os.makedirs(folder, exist_ok=True)
+	return folder
 
 def getSetting(k):
 	prefs = getSettings()
@@ -15,11 +15,17 @@ from bpy.props import StringProperty, IntProperty, FloatProperty, BoolProperty,
 from ..geoscene import GeoScene
 from .utils import adjust3Dview, getBBOX, isTopView
 from ..core.proj import SRS, reprojBbox
+from ..core.basemaps import getMapService, MapJob, BBoxRequest
 
 from ..core.settings import getSetting
 
 USER_AGENT = getSetting('user_agent')
 
+PKG, SUBPKG = __package__.split('.', maxsplit=1)
+
+#max number of elevation tiles requested at once
+MAX_TERRAIN_TILES = 400
+
 
 class IMPORTGIS_OT_srtm_query(Operator):
 	"""Import NASA SRTM elevation data from OpenTopography RESTful Web service"""
@@ -29,6 +35,13 @@ class IMPORTGIS_OT_srtm_query(Operator):
 	bl_label = "Get SRTM"
 	bl_options = {"UNDO"}
 
+	dataset: EnumProperty(
+		name = "Dataset",
+		description = "Choose the elevation data provider",
+		items = [ ('OPENTOPO', 'SRTM (OpenTopography)', 'Download SRTM 90m GeoTIFF from OpenTopography web service'),
+		('TERRARIUM', 'Terrain tiles', 'Get cached and tiled elevation data through the basemaps service') ]
+		)
+
 	def invoke(self, context, event):
 
 		#check georef
@@ -40,7 +53,7 @@ class IMPORTGIS_OT_srtm_query(Operator):
 				self.report({'ERROR'}, "Scene georef is broken, please fix it beforehand")
 				return {'CANCELLED'}
 
-		return self.execute(context)#context.window_manager.invoke_props_dialog(self)
+		return context.window_manager.invoke_props_dialog(self)
 
 	@classmethod
 	def poll(cls, context):
@@ -69,6 +82,9 @@ class IMPORTGIS_OT_srtm_query(Operator):
 			self.report({'ERROR'}, "Too large extent")
 			return {'CANCELLED'}
 
+		if self.dataset == 'TERRARIUM':
+			return self.importTerrainTiles(context, bbox, onMesh)
+
 		bbox = reprojBbox(geoscn.crs, 4326, bbox)
 
 		if bbox.ymin > 60:
@@ -113,12 +129,62 @@ class IMPORTGIS_OT_srtm_query(Operator):
 			self.report({'ERROR'}, "Cannot reach OpenTopography web service, check logs for more infos")
 			return {'CANCELLED'}
 
+		self.importDEM(context, filePath, 'EPSG:4326', onMesh)
+
+		return {'FINISHED'}
+
+
+	def importTerrainTiles(self, context, bbox, onMesh):
+		'''Build the DEM from RGB encoded elevation tiles, downloaded in parallel and cached by the basemaps service'''
+		prefs = context.preferences.addons[PKG].preferences
+		cacheFolder = prefs.cacheFolder
+		if cacheFolder == "" or not os.path.exists(cacheFolder):
+			self.report({'ERROR'}, "Please define a valid cache folder path in addon's preferences")
+			return {'CANCELLED'}
+
+		geoscn = GeoScene(context.scene)
+		srv = getMapService('TERRAIN', cacheFolder)
+		srv.cacheMode = prefs.cacheMode
+		laykey = 'TERRARIUM'
+		lay = srv.layers[laykey]
+		tm = srv.srcTms
+		bbox = reprojBbox(geoscn.crs, tm.CRS, bbox)
+		bbox = (bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax)
+
+		#Choose a zoom level close to SRTM 30m resolution, but limit the number of tiles
+		zoom = min(tm.getNearestZoom(30), lay.zmax)
+		while zoom > lay.zmin and BBoxRequest(tm, bbox, zoom).nbTiles > MAX_TERRAIN_TILES:
+			zoom -= 1
+
+		w = context.window
+		w.cursor_set('WAIT')
+
+		mosaic = srv.getImage(laykey, bbox, zoom, toDstGrid=False, job=MapJob())
+		if mosaic is None:
+			self.report({'ERROR'}, "Cannot get elevation tiles, check logs for more infos")
+			return {'CANCELLED'}
+
+		if bpy.data.is_saved:
+			filePath = os.path.join(os.path.dirname(bpy.data.filepath), 'terrain.tif')
+		else:
+			filePath = os.path.join(bpy.app.tempdir, 'terrain.tif')
+		#fill the holes of missing tiles, a nodata value cannot be written by all image engines
+		mosaic.fillNodata()
+		mosaic.save(filePath) #georef will be written in a worldfile
+
+		self.importDEM(context, filePath, tm.CRS, onMesh)
+
+		return {'FINISHED'}
+
+
+	def importDEM(self, context, filePath, rastCRS, onMesh):
+		scn = context.scene
 		if not onMesh:
 			bpy.ops.importgis.georaster(
 			'EXEC_DEFAULT',
 			filepath = filePath,
 			reprojection = True,
-			rastCRS = 'EPSG:4326',
+			rastCRS = rastCRS,
 			importMode = 'DEM',
 			subdivision = 'subsurf')
 		else:
@@ -126,7 +192,7 @@ class IMPORTGIS_OT_srtm_query(Operator):
 			'EXEC_DEFAULT',
 			filepath = filePath,
 			reprojection = True,
-			rastCRS = 'EPSG:4326',
+			rastCRS = rastCRS,
 			importMode = 'DEM',
 			subdivision = 'subsurf',
 			demOnMesh = True,
@@ -137,8 +203,6 @@ class IMPORTGIS_OT_srtm_query(Operator):
 		bbox = getBBOX.fromScn(scn)
 		adjust3Dview(context, bbox, zoomToSelect=False)
 
-		return {'FINISHED'}
-
 
 def register():
 	bpy.utils.register_class(IMPORTGIS_OT_srtm_query)
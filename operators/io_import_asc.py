@@ -6,6 +6,7 @@ import string
 import bpy
 import math
 import string
+import numpy as np
 
 import logging
 log = logging.getLogger(__name__)
@@ -14,7 +15,7 @@ from bpy_extras.io_utils import ImportHelper #helper class defines filename and
 from bpy.props import StringProperty, BoolProperty, EnumProperty, IntProperty
 from bpy.types import Operator
 
-from ..core.proj import Reproj
+from ..core.proj import Reproj, SRS, meters2dd
 from ..core.utils import XY
 from ..geoscene import GeoScene, georefManagerLayout
 from ..prefs import PredefCRS
@@ -25,6 +26,9 @@ from .utils import rasterExtentToMesh, geoRastUVmap, setDisplacer
 
 PKG, SUBPKG = __package__.split('.', maxsplit=1)
 
+#maximum error allowed when reprojecting grid vertices with the approximate transformer (meters)
+REPROJ_MAX_ERR = 0.01
+
 
 class IMPORTGIS_OT_ascii_grid(Operator, ImportHelper):
     """Import ESRI ASCII grid file"""
@@ -253,10 +257,6 @@ class IMPORTGIS_OT_ascii_grid(Operator, ImportHelper):
                 # TODO: exclude nodata values (implications for face generation)
                 if not (self.importMode == 'CLOUD' and coldata[x] == nodata):
                     pt = (x * cellsize + offset.x, y * cellsize + offset.y)
-                    if rprj:
-                        # reproject world-space source coordinate, then transform back to target local-space
-                        pt = rprjToScene.pt(pt[0] + reprojection['from'].x, pt[1] + reprojection['from'].y)
-                        pt = (pt[0] - reprojection['to'].x, pt[1] - reprojection['to'].y)
                     try:
                         vertices.append(pt + (float(coldata[x]),))
                     except ValueError as e:
@@ -264,6 +264,18 @@ class IMPORTGIS_OT_ascii_grid(Operator, ImportHelper):
                         self.report({'ERROR'}, 'Cannot convert value to float')
                         return {'CANCELLED'}
 
+        if rprj and vertices:
+            # reproject world-space source coordinates all at once, then transform back to target local-space
+            verts = np.array(vertices)
+            pts = verts[:, :2] + (reprojection['from'].x, reprojection['from'].y)
+            #the tolerance is expressed in scene crs units
+            maxErr = REPROJ_MAX_ERR
+            if SRS(geoscn.crs).isGeo:
+                maxErr = meters2dd(maxErr)
+            pts = rprjToScene.ptsArray(pts, maxErr=maxErr)
+            verts[:, :2] = pts - (reprojection['to'].x, reprojection['to'].y)
+            vertices = verts.tolist()
+
         if self.importMode == 'MESH':
             step_ncols = math.ceil(ncols / step)
             for r in range(0, math.ceil(nrows / step) - 1):
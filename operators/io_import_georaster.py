@@ -34,6 +34,7 @@ from ..prefs import PredefCRS
 
 from ..core.georaster import GeoRaster
 from .utils import bpyGeoRaster, exportAsMesh
+from .utils.georaster_utils import exportAsTiledMeshes, setLodRange, startLodViews, updateLodViews, updateLodRender, initLodViews
 from .utils import placeObj, adjust3Dview, showTextures, addTexture, getBBOX
 from .utils import rasterExtentToMesh, geoRastUVmap, setDisplacer
 
@@ -95,7 +96,8 @@ class IMPORTGIS_OT_georaster(Operator, ImportHelper):
 			('BKG', 'As background', "Place raster as background image"),
 			('MESH', 'On mesh', "UV map raster on an existing mesh"),
 			('DEM', 'As DEM texture', "Use DEM raster as height texture to wrap a base mesh"),
-			('DEM_RAW', 'Raw DEM', "Import a DEM as pixels points cloud with building faces")]
+			('DEM_RAW', 'Raw DEM', "Import a DEM as pixels points cloud with building faces"),
+			('DEM_TILES', 'Tiled DEM', "Import a large DEM as tiles meshes with levels of detail")]
 			)
 	#
 	objectsLst: EnumProperty(attr="obj_list", name="Objects", description="Choose object to edit", items=listObjects)
@@ -137,6 +139,10 @@ class IMPORTGIS_OT_georaster(Operator, ImportHelper):
 
 	buildFaces: BoolProperty(name="Build faces", default=True, description='Build quad faces connecting pixel point cloud')
 
+	tileSize: IntProperty(name="Tile size", default=1024, description="Tile dimension in pixels", min=16)
+
+	lods: IntProperty(name="Levels of detail", default=1, description="Number of meshes per tile, each one halving the resolution of the previous", min=1, max=8)
+
 	def draw(self, context):
 		#Function used by blender to draw the panel.
 		layout = self.layout
@@ -169,9 +175,12 @@ class IMPORTGIS_OT_georaster(Operator, ImportHelper):
 				layout.prop(self, 'step')
 			layout.prop(self, 'fillNodata')
 		#
-		if self.importMode == 'DEM_RAW':
+		if self.importMode in ['DEM_RAW', 'DEM_TILES']:
 			layout.prop(self, 'buildFaces')
 			layout.prop(self, 'step')
+			if self.importMode == 'DEM_TILES':
+				layout.prop(self, 'tileSize')
+				layout.prop(self, 'lods')
 			layout.prop(self, 'clip')
 			if self.clip:
 				if geoscn.isGeoref and len(self.objectsLst) > 0:
@@ -415,7 +424,7 @@ class IMPORTGIS_OT_georaster(Operator, ImportHelper):
 			dsp = setDisplacer(obj, grid, uvTxtLayer)
 
 		######################################
-		if self.importMode == 'DEM_RAW':
+		if self.importMode in ['DEM_RAW', 'DEM_TILES']:
 
 			# Get reference plane
 			subBox = None
@@ -444,21 +453,52 @@ class IMPORTGIS_OT_georaster(Operator, ImportHelper):
 				if rprj:
 					dx, dy = rprjToScene.pt(dx, dy)
 				geoscn.setOriginPrj(dx, dy)
-			mesh = exportAsMesh(grid, dx, dy, self.step, reproj=rprjToScene, subset=self.clip, flat=False, buildFaces=self.buildFaces)
-			obj = placeObj(mesh, name)
+			if self.importMode == 'DEM_RAW':
+				mesh = exportAsMesh(grid, dx, dy, self.step, reproj=rprjToScene, subset=self.clip, flat=False, buildFaces=self.buildFaces)
+				obj = placeObj(mesh, name)
+			else:
+				#Tiles objects are parented to an empty, lods are switched by distance to the view
+				obj = bpy.data.objects.new(name, None)
+				scn.collection.objects.link(obj)
+				tileSize, tiles = exportAsTiledMeshes(grid, dx, dy, self.tileSize, self.step, self.lods,
+					buildFaces=self.buildFaces, subset=self.clip, reproj=rprjToScene)
+				log.debug('Tiles size rounded to {} pixels'.format(tileSize))
+				#lod distances in scene units, from the extent of the built (reprojected) tiles
+				lodDist = 0
+				for col, row, lod, mesh, center, extent in tiles:
+					lodDist = max(lodDist, extent)
+					tile = bpy.data.objects.new(mesh.name, mesh)
+					tile.location = center
+					tile.parent = obj
+					scn.collection.objects.link(tile)
+					if self.lods > 1:
+						minDist = 0 if lod == 0 else lodDist * 2**(lod-1)
+						maxDist = -1 if lod == self.lods - 1 else lodDist * 2**lod
+						setLodRange(tile, minDist, maxDist)
+						tile.hide_viewport = lod > 0
+				bpy.context.view_layer.objects.active = obj
+				obj.select_set(True)
+				if self.lods > 1:
+					startLodViews()
 			#grid.unload()
 
 		######################################
 
 		#Flag if a new object as been created...
-		if self.importMode == 'PLANE' or (self.importMode == 'DEM' and not self.demOnMesh) or self.importMode == 'DEM_RAW':
+		if self.importMode == 'PLANE' or (self.importMode == 'DEM' and not self.demOnMesh) or self.importMode in ['DEM_RAW', 'DEM_TILES']:
 			newObjCreated = True
 		else:
 			newObjCreated = False
 
 		#...if so, maybee we need to adjust 3d view settings to it
 		if newObjCreated and prefs.adjust3Dview:
-			bb = getBBOX.fromObj(obj)
+			if self.importMode == 'DEM_TILES':
+				#union of the tiles bbox, the parent empty alone if there is no tile
+				bb = getBBOX.fromObj(obj)
+				for i, tile in enumerate(obj.children):
+					bb = getBBOX.fromObj(tile) if i == 0 else bb + getBBOX.fromObj(tile)
+			else:
+				bb = getBBOX.fromObj(obj)
 			adjust3Dview(context, bb)
 
 		#Force view mode with textures
@@ -471,6 +511,14 @@ class IMPORTGIS_OT_georaster(Operator, ImportHelper):
 
 def register():
 	bpy.utils.register_class(IMPORTGIS_OT_georaster)
+	bpy.app.handlers.frame_change_pre.append(updateLodRender)
+	bpy.app.handlers.load_post.append(initLodViews)
 
 def unregister():
 	bpy.utils.unregister_class(IMPORTGIS_OT_georaster)
+	if bpy.app.timers.is_registered(updateLodViews):
+		bpy.app.timers.unregister(updateLodViews)
+	if updateLodRender in bpy.app.handlers.frame_change_pre:
+		bpy.app.handlers.frame_change_pre.remove(updateLodRender)
+	if initLodViews in bpy.app.handlers.load_post:
+		bpy.app.handlers.load_post.remove(initLodViews)
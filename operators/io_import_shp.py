@@ -440,9 +440,7 @@ class IMPORTGIS_OT_shapefile(Operator):
 				self.report({'ERROR'}, "Unable to reproject data, check logs for more infos.")
 				return {'CANCELLED'}
 			if rprj.iproj == 'EPSGIO':
-				if shp.numRecords > 100:
-					self.report({'ERROR'}, "Reprojection through online epsg.io engine is limited to 100 features. \nPlease install GDAL or pyproj module.")
-					return {'CANCELLED'}
+				log.info("Reprojection through online epsg.io engine, it can be slow for {} features".format(shp.numRecords))
 
 		#Get bbox
 		bbox = BBOX(shp.bbox)
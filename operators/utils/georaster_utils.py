@@ -23,50 +23,79 @@ import os
 import numpy as np
 import bpy, bmesh
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from bpy.app.handlers import persistent
 
 import logging
 log = logging.getLogger(__name__)
 
 from ...core.georaster import GeoRaster
+from ...core import BBOX
 
 
-def _exportAsMesh(georaster, dx=0, dy=0, step=1, buildFaces=True, flat=False, subset=False, reproj=None):
-	'''Numpy test'''
+def _gridToMeshData(georef, pxx, pxy, data, noData=None, reproj=None, dx=0, dy=0, buildFaces=True, nbThreads=None):
+	'''
+	Compute vertices and quad faces arrays from a regular grid of pixels coordinates
+	data : the elevation values at each grid node, None to build a flat grid
+	Vertices are returned in row order, faces as vertices indices (-1 nodes are skipped)
+	'''
+	xx, yy = georef.geoFromPxArray(pxx, pxy)
 
-	if subset and georaster.subBoxGeo is None:
-		subset = False
-
-	if not subset:
-		georef = georaster.georef
+	#Elevations and nodata mask
+	if data is None:
+		zz = np.zeros(pxx.shape)
+		valid = np.ones(pxx.shape, dtype=bool)
 	else:
-		georef = georaster.getSubBoxGeoRef()
-
-	x0, y0 = georef.origin #pxcenter
-	pxSizeX, pxSizeY = georef.pxSize.x, georef.pxSize.y
-	w, h = georef.rSize.x, georef.rSize.y
-
-	#adjust against step
-	w, h = math.ceil(w/step), math.ceil(h/step)
-	pxSizeX, pxSizeY = pxSizeX * step, pxSizeY * step
+		valid = np.ones(data.shape, dtype=bool)
+		if np.ma.isMaskedArray(data):
+			valid &= ~np.ma.getmaskarray(data)
+			data = np.ma.getdata(data)
+		#NaN cells are never valid, whatever the nodata value
+		if np.issubdtype(data.dtype, np.floating):
+			valid &= ~np.isnan(data)
+		if noData is not None and not np.isnan(noData):
+			valid &= data != noData
+		zz = data
+
+	#Keep valid vertices only (row order) and map grid positions to vertex indices
+	verts = np.column_stack((xx[valid], yy[valid], zz[valid])).astype(np.float64)
+	if reproj is not None:
+		verts[:,:2] = reproj.ptsArray(verts[:,:2], nbThreads=nbThreads)
+	verts[:,0] -= dx
+	verts[:,1] -= dy
+	idx = np.full(valid.shape, -1, dtype=np.int64)
+	idx[valid] = np.arange(len(verts))
+
+	#Quads from bottomright to topright (anticlockwise --> face up), only if the 4 vertices are valid
+	if buildFaces and valid.shape[0] > 1 and valid.shape[1] > 1:
+		br, bl = idx[1:, 1:], idx[1:, :-1]
+		tr, tl = idx[:-1, 1:], idx[:-1, :-1]
+		quads = (br >= 0) & (bl >= 0) & (tr >= 0) & (tl >= 0)
+		faces = np.column_stack((tr[quads], tl[quads], bl[quads], br[quads]))
+	else:
+		faces = np.empty((0, 4), dtype=np.int64)
 
-	x = np.array([(x0 + (pxSizeX * i)) - dx for i in range(0, w)])
-	y = np.array([(y0 + (pxSizeY * i)) - dy for i in range(0, h)])
-	xx, yy = np.meshgrid(x, y)
-	#TODO reproj
+	return verts, faces
 
-	if flat:
-		zz = np.zeros((h, w))
-	else:
-		zz = georaster.readAsNpArray(subset=subset).data[::step,::step] #TODO raise error if multiband
 
-	verts = np.column_stack((xx.ravel(), yy.ravel(), zz.ravel()))
-	if buildFaces:
-		faces = [(x+y*w, x+y*w+1, x+y*w+1+w, x+y*w+w) for x in range(0, w-1) for y in range(0, h-1)]
-	else:
-		faces = []
-	mesh = bpy.data.meshes.new("DEM")
-	mesh.from_pydata(verts, [], faces)
-	mesh.update()
+def _meshFromData(name, verts, faces):
+	'''Feed a new mesh with bulk array apis (from_pydata is too slow with large mesh)'''
+	mesh = bpy.data.meshes.new(name)
+	mesh.vertices.add(len(verts))
+	mesh.vertices.foreach_set('co', verts.astype(np.float32).ravel())
+	nbFaces = len(faces)
+	if nbFaces:
+		mesh.loops.add(nbFaces * 4)
+		mesh.loops.foreach_set('vertex_index', faces.astype(np.int32).ravel())
+		mesh.polygons.add(nbFaces)
+		mesh.polygons.foreach_set('loop_start', np.arange(0, nbFaces * 4, 4, dtype=np.int32))
+		try:
+			mesh.polygons.foreach_set('loop_total', np.full(nbFaces, 4, dtype=np.int32))
+		except (AttributeError, TypeError):
+			pass #read only since Blender 4.0, deduced from loop_start
+	mesh.update(calc_edges=True)
+	mesh.validate()
 	return mesh
 
 
@@ -79,62 +108,171 @@ def exportAsMesh(georaster, dx=0, dy=0, step=1, buildFaces=True, subset=False, r
 	else:
 		georef = georaster.getSubBoxGeoRef()
 
-	if not flat:
-		img = georaster.readAsNpArray(subset=subset)
-		#TODO raise error if multiband
-		data = img.data
-
-	x0, y0 = georef.origin #pxcenter
-	pxSizeX, pxSizeY = georef.pxSize.x, georef.pxSize.y
 	w, h = georef.rSize.x, georef.rSize.y
 
-	#Build the mesh (Note : avoid using bmesh because it's very slow with large mesh, use from_pydata instead)
-	verts = []
-	faces = []
-	nodata = []
-	idxMap = {}
-	for py in range(0, h, step):
-		for px in range(0, w, step):
-			x = x0 + (pxSizeX * px)
-			y = y0 + (pxSizeY * py)
-
-			if reproj is not None:
-				x, y = reproj.pt(x, y)
-
-			#shift
-			x -= dx
-			y -= dy
-
-			if flat:
-				z = 0
-			else:
-				z = data[py, px]
+	#Vertices coords grid (one row/column per step)
+	pxx, pxy = np.meshgrid(np.arange(0, w, step), np.arange(0, h, step))
+
+	if flat:
+		data = None
+	else:
+		img = georaster.readAsNpArray(subset=subset)
+		#TODO raise error if multiband
+		data = img.data[::step, ::step]
+
+	verts, faces = _gridToMeshData(georef, pxx, pxy, data, georaster.noData, reproj, dx, dy, buildFaces)
+	return _meshFromData("DEM", verts, faces)
+
+
+######################################
+# Tiled DEM with levels of detail
+
+def _tileSteps(start, end, step):
+	'''Pixels indices from start to end by step, always ending on the tile border to stitch with the next tile'''
+	steps = np.arange(start, end + 1, step)
+	if steps[-1] != end:
+		steps = np.append(steps, end)
+	return steps
+
+def _buildTile(georaster, window, src, lodSteps, dx, dy, buildFaces, reproj):
+	'''
+	Compute the mesh data of each lod of a tile, run in a worker thread (no bpy call here)
+	window : the tile extent as pixels indices (xmin, ymin, xmax, ymax), borders are included
+	src : the whole raster data if the image engine cannot read by window, else None
+	'''
+	xmin, ymin, xmax, ymax = window
+	if src is None:
+		data = georaster.readWindowAsNpArray(BBOX(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)).data
+	else:
+		data = src[ymin:ymax+1, xmin:xmax+1]
+	lods = []
+	for step in lodSteps:
+		cols, rows = _tileSteps(xmin, xmax, step), _tileSteps(ymin, ymax, step)
+		pxx, pxy = np.meshgrid(cols, rows)
+		verts, faces = _gridToMeshData(georaster.georef, pxx, pxy, data[np.ix_(rows - ymin, cols - xmin)],
+			georaster.noData, reproj, dx, dy, buildFaces, nbThreads=1)
+		lods.append((verts, faces))
+	return lods
+
+def exportAsTiledMeshes(georaster, dx=0, dy=0, tileSize=1024, step=1, lods=1, buildFaces=True, subset=False, reproj=None, nbThreads=None):
+	'''
+	Build a DEM as a set of tiles meshes, so that very large rasters can be imported with a bounded memory usage
+	tileSize : tile dimension in pixels, rounded to a multiple of the coarsest lod step
+	lods : number of levels of detail per tile, each lod doubles the pixel step of the previous one
+	Adjacent tiles share their border pixels, so tiles of the same lod are seamless.
+	Tiles are read by window and computed in a worker pool, meshes are created in the calling thread.
+	Return the effective tile size and a generator of (col, row, lod, mesh, center, extent) tuples,
+	mesh vertices are relative to the tile center and extent is the largest tile side, both in output crs units.
+	'''
+	if subset and georaster.subBoxGeo is not None:
+		box = georaster.subBoxPx
+		xmin, ymin, xmax, ymax = box.xmin, box.ymin, box.xmax, box.ymax
+	else:
+		xmin, ymin = 0, 0
+		xmax, ymax = georaster.size.x - 1, georaster.size.y - 1
 
-			#vertex index
-			v1 = px + py * w #bottom right
+	lodSteps = [step * 2**i for i in range(lods)]
+	tileSize = max(1, round(tileSize / lodSteps[-1])) * lodSteps[-1]
+	windows = [(col, row, (x, y, min(x + tileSize, xmax), min(y + tileSize, ymax)))
+		for row, y in enumerate(range(ymin, ymax, tileSize) or [ymin])
+		for col, x in enumerate(range(xmin, xmax, tileSize) or [xmin])]
 
-			#Filter nodata
-			if z == georaster.noData:
-				nodata.append(v1)
-			else:
-				verts.append((x, y, z))
-				idxMap[v1] = len(verts) - 1
-
-				#build face from bottomright to topright (using only points already created)
-				if buildFaces and px > 0 and py > 0: #filter first row and column
-					v2 = v1 - step #bottom left
-					v3 = v2 - w * step #topleft
-					v4 = v3 + step #topright
-					f = [v4, v3, v2, v1] #anticlockwise --> face up
-					if not any(v in f for v in nodata): #TODO too slow ?
-						f = [idxMap[v] for v in f]
-						faces.append(f)
-
-	mesh = bpy.data.meshes.new("DEM")
-	mesh.from_pydata(verts, [], faces)
-	mesh.update()
+	if georaster.canReadWindow:
+		src = None
+	else:
+		log.warning('Image engine cannot read raster by window, the whole raster will be loaded in memory')
+		src = georaster.readAsNpArray(subset=False).data
+		#TODO raise error if multiband
 
-	return mesh
+	nbThreads = nbThreads or os.cpu_count() or 1
+	log.info('Build {} DEM tiles of {} pixels with {} lods'.format(len(windows), tileSize, lods))
+
+	def toMeshes(col, row, future):
+		for lod, (verts, faces) in enumerate(future.result()):
+			if len(verts) == 0:
+				continue
+			vmin, vmax = verts.min(axis=0), verts.max(axis=0)
+			center = (vmin + vmax) / 2
+			extent = max(vmax[0] - vmin[0], vmax[1] - vmin[1])
+			verts -= center
+			mesh = _meshFromData('DEM_{}_{}_LOD{}'.format(col, row, lod), verts, faces)
+			yield col, row, lod, mesh, tuple(center), extent
+
+	def tiles():
+		#Limit the number of pending tiles to bound memory usage when meshes creation is slower than workers
+		with ThreadPoolExecutor(max_workers=nbThreads) as pool:
+			pending = deque()
+			for col, row, window in windows:
+				pending.append((col, row, pool.submit(_buildTile, georaster, window, src, lodSteps, dx, dy, buildFaces, reproj)))
+				if len(pending) >= 2 * nbThreads:
+					yield from toMeshes(*pending.popleft())
+			while pending:
+				yield from toMeshes(*pending.popleft())
+
+	return tileSize, tiles()
+
+
+#Custom property storing the (min, max) view distance of a lod object, max < 0 means no limit
+LOD_PROP = 'bgis_lod_range'
+
+def setLodRange(obj, minDist, maxDist=-1):
+	obj[LOD_PROP] = (minDist, maxDist)
+
+def _lodVisible(obj, viewLoc):
+	minDist, maxDist = obj[LOD_PROP]
+	d = (obj.matrix_world.translation - viewLoc).length
+	return d >= minDist and (maxDist < 0 or d < maxDist)
+
+def updateLodVisibility(scene, viewLoc, render=False):
+	'''
+	Show only the lod objects whose range includes the distance to the view location
+	Return the number of lod objects in the scene
+	'''
+	n = 0
+	for obj in scene.objects:
+		if LOD_PROP not in obj:
+			continue
+		n += 1
+		hide = not _lodVisible(obj, viewLoc)
+		if render:
+			if obj.hide_render != hide:
+				obj.hide_render = hide
+		elif obj.hide_viewport != hide:
+			obj.hide_viewport = hide
+	return n
+
+def updateLodViews():
+	'''
+	Timer callback updating lods visibility against the first 3d view location
+	The timer stops itself when the scene does not contain any lod object
+	'''
+	context = bpy.context
+	if context.window_manager is None or context.scene is None:
+		return 0.5
+	for window in context.window_manager.windows:
+		for area in window.screen.areas:
+			if area.type == 'VIEW_3D':
+				viewLoc = area.spaces.active.region_3d.view_matrix.inverted().translation
+				if not updateLodVisibility(context.scene, viewLoc):
+					return None
+				return 0.5
+	return 0.5
+
+def startLodViews():
+	'''Start the lods visibility timer if needed'''
+	if not bpy.app.timers.is_registered(updateLodViews):
+		bpy.app.timers.register(updateLodViews, persistent=True)
+
+@persistent
+def initLodViews(dummy=None):
+	'''File load handler restarting the lods timer, it will stop by itself if the file has no lod'''
+	startLodViews()
+
+@persistent
+def updateLodRender(scene, depsgraph=None):
+	'''Frame change handler updating lods render visibility against the scene camera'''
+	if scene.camera is not None:
+		updateLodVisibility(scene, scene.camera.matrix_world.translation, render=True)
 
 
 def rasterExtentToMesh(name, rast, dx, dy, pxLoc='CORNER', reproj=None, subdivise=False):
@@ -161,24 +299,24 @@ def rasterExtentToMesh(name, rast, dx, dy, pxLoc='CORNER', reproj=None, subdivis
 def geoRastUVmap(obj, uvLayer, rast, dx, dy, reproj=None):
 	'''uv map a georaster texture on a given mesh'''
 	mesh = obj.data
-	#Assign uv coords
 	loc = obj.location
-	for pg in mesh.polygons:
-		for i in pg.loop_indices:
-			vertIdx = mesh.loops[i].vertex_index
-			pt = list(mesh.vertices[vertIdx].co)
-			#adjust coords against object location and shift values to retrieve original point coords
-			pt = (pt[0] + loc.x + dx, pt[1] + loc.y + dy)
-			if reproj is not None:
-				pt = reproj.pt(*pt)
-			#Compute UV coords --> pourcent from image origin (bottom left)
-			dx_px, dy_px = rast.pxFromGeo(pt[0], pt[1], reverseY=True, round2Floor=False)
-			u = dx_px / rast.size[0]
-			v = dy_px / rast.size[1]
-			#Assign coords
-			#uvLoop = uvLoopLayer.data[i]
-			#uvLoop.uv = [u,v]
-			uvLayer.data[i].uv = [u,v]
+	#Bulk read of vertices coords and loops vertex indices
+	co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+	mesh.vertices.foreach_get('co', co)
+	vertIdx = np.empty(len(mesh.loops), dtype=np.int32)
+	mesh.loops.foreach_get('vertex_index', vertIdx)
+	#Only process the vertices used by loops, each one once even if shared by several faces
+	used, loopVert = np.unique(vertIdx, return_inverse=True)
+	pts = co.reshape(-1, 3)[used, :2].astype(np.float64)
+	#adjust coords against object location and shift values to retrieve original point coords
+	pts += (loc.x + dx, loc.y + dy)
+	if reproj is not None:
+		pts = reproj.ptsArray(pts)
+	#Compute UV coords --> pourcent from image origin (bottom left)
+	dx_px, dy_px = rast.pxFromGeoArray(pts[:,0], pts[:,1], reverseY=True, round2Floor=False)
+	uvs = np.column_stack((dx_px / rast.size[0], dy_px / rast.size[1]))
+	#Assign coords
+	uvLayer.data.foreach_set('uv', uvs[loopVert].astype(np.float32).ravel())
 
 def setDisplacer(obj, rast, uvTxtLayer, mid=0):
 	#Config displacer
@@ -36,7 +36,7 @@ from gpu_extras.batch import batch_for_shader
 #core imports
 from ..core import HAS_GDAL, HAS_PIL, HAS_IMGIO
 from ..core.proj import reprojPt, reprojBbox, dd2meters, meters2dd
-from ..core.basemaps import GRIDS, SOURCES, MapService
+from ..core.basemaps import GRIDS, SOURCES, MapService, MapJob, getMapService, clearMapServices
 from ..core.settings import getSetting
 
 USER_AGENT = getSetting('user_agent')
@@ -57,6 +57,18 @@ PKG, SUBPKG = __package__.split('.', maxsplit=1) #blendergis.basemaps
 
 ####################
 
+#Custom property used to retrieve the image created by a map viewer
+VIEWER_IMG_PROP = 'bgis_viewer'
+
+def setImgPixels(img, pixels):
+	'''Set a bpy image pixels from a flat rgba float buffer'''
+	try:
+		img.pixels.foreach_set(pixels)
+	except AttributeError:
+		#bulk assignment is not available before Blender 2.83
+		img.pixels[:] = pixels
+
+
 class BaseMap(GeoScene):
 
 	"""Handle a map as background image in Blender"""
@@ -81,18 +93,18 @@ class BaseMap(GeoScene):
 		#Get resampling algo preference and set the constant
 		MapService.RESAMP_ALG = prefs.resamplAlg
 
-		#Init MapService class
-		self.srv = MapService(srckey, cacheFolder)
+		#Get the shared MapService instance (reused across viewer sessions)
+		if grdkey is None:
+			grdkey = SOURCES[srckey]['grid']
+		self.srv = getMapService(srckey, cacheFolder, grdkey)
+		self.srv.cacheMode = prefs.cacheMode
+		self.srv.cacheMaxSize = prefs.cacheMaxSize
 		self.name = srckey + '_' + laykey + '_' + grdkey
 
 		#Set destination tile matrix
-		if grdkey is None:
-			grdkey = self.srv.srcGridKey
 		if grdkey == self.srv.srcGridKey:
 			self.tm = self.srv.srcTms
 		else:
-			#Define destination grid in map service
-			self.srv.setDstGrid(grdkey)
 			self.tm = self.srv.dstTms
 
 		#Init some geoscene props if needed
@@ -107,18 +119,6 @@ class BaseMap(GeoScene):
 
 		self.lockedZoom = None
 
-		#Set path to tiles mosaic used as background image in Blender
-		#We need a format that support transparency so jpg is exclude
-		#Writing to tif is generally faster than writing to png
-		if bpy.data.is_saved:
-			folder = os.path.dirname(bpy.data.filepath) + os.sep
-			##folder = bpy.path.abspath("//"))
-		else:
-			##folder = bpy.context.preferences.filepaths.temporary_directory
-			#Blender crease a sub-directory within the temp directory, for each session, which is cleared on exit
-			folder = bpy.app.tempdir
-		self.imgPath = folder + self.name + ".tif"
-
 		#Get layer def obj
 		self.layer = self.srv.layers[laykey]
 
@@ -129,6 +129,8 @@ class BaseMap(GeoScene):
 
 		#Thread attributes
 		self.thread = None
+		self.job = None #current request to the map service
+		self.mosaic = None #last full resolution mosaic
 		#Background image attributes
 		self.img = None #bpy image
 		self.bkg = None #empty image obj
@@ -137,36 +139,58 @@ class BaseMap(GeoScene):
 		#TODO
 
 
+	@property
+	def running(self):
+		return self.job is not None and self.job.running
+
+	@property
+	def report(self):
+		return self.job.report if self.job is not None else ''
+
 	def get(self):
 		'''Launch run() function in a new thread'''
 		self.stop()
-		self.srv.start()
-		self.thread = threading.Thread(target=self.run)
+		self.job = MapJob()
+		self.thread = threading.Thread(target=self.run, args=(self.job,))
 		self.thread.start()
 
 	def stop(self):
 		'''Stop actual thread'''
-		if self.srv.running:
-			self.srv.stop()
+		if self.running:
+			self.job.cancel()
 			self.thread.join()
 
-	def run(self):
+	def run(self, job):
 		"""thread method"""
-		self.mosaic = self.request()
-		if self.srv.running and self.mosaic is not None:
-			#save image
-			self.mosaic.save(self.imgPath)
-		if self.srv.running:
-			#Place background image
-			self.place()
-		self.srv.stop()
+		try:
+			bbox = self.getBbox()
+			#Progressive rendering, display immediately a coarser mosaic built from cached tiles
+			#while the tiles of the requested zoom level are downloading
+			zoom = self.srv.getCachedZoom(self.laykey, bbox, self.zoom, toDstGrid=self.toDstGrid)
+			if zoom is not None and zoom < self.zoom:
+				preview = self.request(job, bbox, zoom, cacheMode='CACHE_ONLY')
+				if job.running and preview is not None:
+					self.place(preview)
+			self.mosaic = self.request(job, bbox)
+			if job.running and self.mosaic is not None:
+				#Place background image
+				self.place(self.mosaic)
+		except Exception:
+			log.error('Cannot build map mosaic', exc_info=True)
+		finally:
+			#never let the viewer wait on a dead job
+			job.finished.set()
 
 	def moveOrigin(self, dx, dy, useScale=True, updObjLoc=True):
 		'''Move scene origin and update props'''
 		self.moveOriginPrj(dx, dy, useScale, updObjLoc, self.synchOrj) #geoscene function
 
-	def request(self):
-		'''Request map service to build a mosaic of required tiles to cover view3d area'''
+	@property
+	def toDstGrid(self):
+		return self.srv.srcGridKey != self.grdkey
+
+	def getBbox(self):
+		'''Return the bbox of view3d area in destination tile matrix crs'''
 		#Get area dimension
 		w, h = self.area.width, self.area.height
 		#w, h = self.area3d.width, self.area3d.height #WARN return [1,1] !!!!????
@@ -200,27 +224,55 @@ class BaseMap(GeoScene):
 
 		log.debug('Bounding box request : {}'.format(bbox))
 
+		return bbox
+
+	def request(self, job=None, bbox=None, zoom=None, cacheMode=None):
+		'''Request map service to build a mosaic of required tiles to cover view3d area'''
+		if bbox is None:
+			bbox = self.getBbox()
+		if zoom is None:
+			zoom = self.zoom
+
 		#Stop thread if the request is same as previous
 		#TODO
 
-		if self.srv.srcGridKey == self.grdkey:
-			toDstGrid = False
-		else:
-			toDstGrid = True
-
-		mosaic = self.srv.getImage(self.laykey, bbox, self.zoom, toDstGrid=toDstGrid, outCRS=self.crs)
+		mosaic = self.srv.getImage(self.laykey, bbox, zoom, toDstGrid=self.toDstGrid, outCRS=self.crs, cpt=cacheMode is None, cacheMode=cacheMode, job=job, decode=False)
 
 		return mosaic
 
 
-	def place(self):
-		'''Set map as background image'''
-
-		#Get or load bpy image
+	def getImage(self):
+		'''Get the non packed image previously created by a viewer of this map, None if there is not'''
 		try:
-			self.img = [img for img in bpy.data.images if img.filepath == self.imgPath and len(img.packed_files) == 0][0]
-		except IndexError:
-			self.img = bpy.data.images.load(self.imgPath)
+			if self.img is not None and self.img.packed_file is None:
+				return self.img
+		except ReferenceError:
+			pass #datablock has been removed
+		imgs = [img for img in bpy.data.images if img.get(VIEWER_IMG_PROP) == self.name and img.packed_file is None]
+		return imgs[0] if imgs else None
+
+	def updateImage(self, mosaic):
+		"""
+		Push mosaic pixels into a persistent bpy image (without disk round trip)
+		The image is created at first call and only resized when the mosaic size change
+		"""
+		img_w, img_h = mosaic.size
+		self.img = self.getImage()
+		if self.img is None:
+			self.img = bpy.data.images.new(self.name, img_w, img_h, alpha=True)
+			self.img[VIEWER_IMG_PROP] = self.name
+		elif tuple(self.img.size) != (img_w, img_h):
+			self.img.scale(img_w, img_h)
+		setImgPixels(self.img, mosaic.toRGBAFloat())
+
+
+	def place(self, mosaic=None):
+		'''Set a mosaic as background image, default to the last full resolution mosaic'''
+		if mosaic is None:
+			mosaic = self.mosaic
+
+		#Upload the mosaic into the bpy image
+		self.updateImage(mosaic)
 
 		#Get or load background image
 		empties = [obj for obj in self.scn.objects if obj.type == 'EMPTY']
@@ -228,7 +280,7 @@ class BaseMap(GeoScene):
 		for bkg in bkgs:
 			bkg.hide_viewport = True
 		try:
-			self.bkg = [bkg for bkg in bkgs if bkg.data.filepath == self.imgPath and len(bkg.data.packed_files) == 0][0]
+			self.bkg = [bkg for bkg in bkgs if bkg.data == self.img][0]
 		except IndexError:
 			self.bkg = bpy.data.objects.new(self.name, None) #None will create an empty
 			self.bkg.empty_display_type = 'IMAGE'
@@ -239,9 +291,9 @@ class BaseMap(GeoScene):
 			self.bkg.hide_viewport = False
 
 		#Get some image props
-		img_ox, img_oy = self.mosaic.center
-		img_w, img_h = self.mosaic.size
-		res = self.mosaic.pxSize.x
+		img_ox, img_oy = mosaic.center
+		img_w, img_h = mosaic.size
+		res = mosaic.pxSize.x
 		#res = self.tm.getRes(self.zoom)
 
 		#Set background size
@@ -278,7 +330,7 @@ class BaseMap(GeoScene):
 		self.viewDstZ = zdst
 
 		#Update image drawing
-		self.bkg.data.reload()
+		self.img.update()
 
 
 
@@ -361,6 +413,9 @@ class VIEW3D_OT_map_start(Operator):
 	def listSources(self, context):
 		srcItems = []
 		for srckey, src in SOURCES.items():
+			#skip sources without imagery layers (RGB encoded elevation)
+			if all('encoding' in lay for lay in src['layers'].values()):
+				continue
 			#put each item in a tuple (key, label, tooltip)
 			srcItems.append( (srckey, src['name'], src['description']) )
 		return srcItems
@@ -381,6 +436,8 @@ class VIEW3D_OT_map_start(Operator):
 		layItems = []
 		src = SOURCES[self.src]
 		for laykey, lay in src['layers'].items():
+			if 'encoding' in lay:
+				continue
 			#put each item in a tuple (key, label, tooltip)
 			layItems.append( (laykey, lay['name'], lay['description']) )
 		return layItems
@@ -625,7 +682,7 @@ class VIEW3D_OT_map_viewer(Operator):
 
 		if event.type == 'TIMER':
 			#report thread progression
-			self.progress = self.map.srv.report
+			self.progress = self.map.report
 			return {'PASS_THROUGH'}
 
 
@@ -912,7 +969,7 @@ class VIEW3D_OT_map_viewer(Operator):
 		#EXPORT
 		if event.type == 'E' and event.value == 'PRESS':
 			#
-			if not self.map.srv.running and self.map.mosaic is not None:
+			if not self.map.running and self.map.mosaic is not None:
 				self.map.stop()
 				self.map.bkg.hide_viewport = True
 
@@ -920,14 +977,15 @@ class VIEW3D_OT_map_viewer(Operator):
 				bpy.types.SpaceView3D.draw_handler_remove(self._drawZoomBoxHandler, 'WINDOW')
 				context.area.header_text_set(None)
 
-				#Copy image to new datablock
-				bpyImg = bpy.data.images.load(self.map.imgPath) #(self.map.img.filepath)
+				#Build a new packed datablock from the last full resolution mosaic
+				rast = self.map.mosaic
 				name = 'EXPORT_' + self.map.srckey + '_' + self.map.laykey + '_' + self.map.grdkey
-				bpyImg.name = name
+				img_w, img_h = rast.size
+				bpyImg = bpy.data.images.new(name, img_w, img_h, alpha=True)
+				setImgPixels(bpyImg, rast.toRGBAFloat())
 				bpyImg.pack()
 
 				#Add new attribute to GeoRaster (used by geoRastUVmap function)
-				rast = self.map.mosaic
 				setattr(rast, 'bpyImg', bpyImg)
 
 				#Create Mesh
@@ -1026,3 +1084,4 @@ def register():
 def unregister():
 	for cls in classes:
 		bpy.utils.unregister_class(cls)
+	clearMapServices()
@@ -8,6 +8,7 @@ import addon_utils
 
 from . import bl_info
 from .core.proj.reproj import EPSGIO
+from .core.proj.crsdb import getCrsDB
 from .core.proj.srs import SRS
 from .core.checkdeps import HAS_GDAL, HAS_PYPROJ, HAS_PIL, HAS_IMGIO
 from .core.settings import getSettings, setSettings
@@ -168,6 +169,22 @@ class BGIS_PREFS(AddonPreferences):
 	lockOrigin: BoolProperty(name="Lock origin", description='Do not move scene origin when panning map', default=False)
 	lockObj: BoolProperty(name="Lock objects", description='Retain objects geolocation when moving map origin', default=True)
 
+	cacheMode: EnumProperty(
+		name = "Cache mode",
+		description = "Choose how tiles older than the cache expiry delay are served",
+		items = [ ('DEFAULT', 'Refresh expired', 'Download expired tiles again before displaying them'),
+		('STALE_WHILE_REVALIDATE', 'Stale while revalidate', 'Display expired tiles immediately and refresh them in background'),
+		('CACHE_ONLY', 'Offline', 'Never download tiles, only use the cache') ],
+		default = 'DEFAULT'
+		)
+
+	cacheMaxSize: IntProperty(
+		name = "Max cache size (Mb)",
+		description = "Maximum size of each cache database, oldest tiles are deleted when exceeded. 0 for unlimited",
+		default = 0,
+		min = 0
+		)
+
 	resamplAlg: EnumProperty(
 		name = "Resampling method",
 		description = "Choose GDAL's resampling method used for reprojection",
@@ -230,6 +247,8 @@ class BGIS_PREFS(AddonPreferences):
 		row.prop(self, "synchOrj")
 		row = box.row()
 		row.prop(self, "resamplAlg")
+		row.prop(self, "cacheMode")
+		row.prop(self, "cacheMaxSize")
 
 		#IO
 		box = layout.box()
@@ -303,14 +322,16 @@ class BGIS_OT_add_predef_crs(Operator):
 		return True
 
 	def search(self, context):
-		if not EPSGIO.ping():
-			self.report({'ERROR'}, "Cannot request epsg.io website")
-		else:
+		#search into the local crs database, only fallback to epsg.io if nothing is found
+		results = getCrsDB().search(self.query)
+		if not results and EPSGIO.ping():
 			results = EPSGIO.search(self.query)
-			self.results = json.dumps(results)
-			if results:
-				self.crs = 'EPSG:' + results[0]['code']
-				self.desc = results[0]['name']
+		self.results = json.dumps(results)
+		if results:
+			self.crs = 'EPSG:' + results[0]['code']
+			self.desc = results[0]['name']
+		else:
+			self.report({'WARNING'}, "No coordinate system found")
 
 	def updEnum(self, context):
 		crsItems = []
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+#run with : python -m unittest discover -s tests
+#(the addon root package needs bpy, so core is imported as a top level package)
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.basemaps.gpkg import GeoPackage
+from core.basemaps.mapservice import getTileMatrix
+
+NB_TILES = 1600
+TILES = [(i % 40, i // 40, 10) for i in range(NB_TILES)]
+
+
+class TestEvict(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.gpkg = GeoPackage(os.path.join(self.folder, 'cache.gpkg'), getTileMatrix('WM'))
+		#small tiles, so that rows, index and pages overhead is significant
+		self.gpkg.putTiles([(x, y, z, os.urandom(20)) for x, y, z in TILES])
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def countTiles(self):
+		return len(self.gpkg.listExistingTiles(TILES, allowExpired=True))
+
+	def test_evict_keeps_tiles(self):
+		used, free = self.gpkg.getSize()
+		#slightly over the limit
+		self.gpkg.maxSize = used * 0.95
+		n = self.gpkg.evict()
+		self.assertTrue(0 < n < NB_TILES)
+		self.assertEqual(self.countTiles(), NB_TILES - n)
+		#about 1 - 0.95 * EVICT_RATIO of the tiles must be evicted
+		self.assertLess(n, NB_TILES * 0.2)
+
+	def test_evict_under_limit(self):
+		used, free = self.gpkg.getSize()
+		self.gpkg.maxSize = used * 2
+		self.assertEqual(self.gpkg.evict(), 0)
+		self.assertEqual(self.countTiles(), NB_TILES)
+
+
+if __name__ == '__main__':
+	unittest.main()